@@ -0,0 +1,353 @@
+"""
+准入控制
+- 昂贵的请求（识别、照片上传）各有一个全局并发上限，满了以后在排队名额里最多等待
+  CATHUB_ADMISSION_QUEUE_SECONDS 秒，仍没有名额立即返回 503 + Retry-After
+- 每个 worker 同时处理（含排队）的昂贵请求也有上限（默认线程数减一）：gthread 的连接按 worker 排队，
+  全局名额都落在同一个 worker 上时，这个 worker 收到的读请求也要等；其余接口（健康检查、猫咪列表等）
+  不经过这里，每个 worker 始终有线程可用
+- 每个客户端地址每类请求一个令牌桶（速率和容量是单个客户端的 IP_MULTIPLIER 倍，同一地址后面可能有多个用户），
+  客户端自报了设备 / 上报人时再计入一个按设备的令牌桶；超过任一速率返回 429 + Retry-After（需要等待的秒数）。
+  设备标识由客户端随意设置，只能让限制更紧，换设备标识绕不过按地址的限制
+- 计数保存在本机的 SQLite 文件里（WAL，不同步落盘），同一台机器上所有 worker 进程共享；
+  CATHUB_ADMISSION_DB=memory 时保存在进程内存里（单进程运行、测试用，相当于本地的 Redis 替身）
+- 并发名额是带 pid 的租约：worker 被杀死后由其他进程回收，超过 LEASE_SECONDS 的租约也会被清理
+"""
+import hashlib
+import itertools
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from app_logging import get_logger, sampled_debug
+from metrics import ADMISSION_REJECTIONS, ADMISSION_WAIT
+
+logger = get_logger('admission')
+
+# 同时处理请求的线程总数（gunicorn worker 数 × 每个 worker 的线程数），用于计算默认上限
+_TOTAL_THREADS = int(os.environ.get('WEB_CONCURRENCY', 2)) * int(os.environ.get('GUNICORN_THREADS', 2))
+# 全局并发上限（所有 worker 合计），0 不限制；默认识别占一半线程、上传占四分之一
+RECOGNIZE_MAX_CONCURRENT = int(os.environ.get('CATHUB_RECOGNIZE_MAX_CONCURRENT', max(1, _TOTAL_THREADS // 2)))
+UPLOAD_MAX_CONCURRENT = int(os.environ.get('CATHUB_UPLOAD_MAX_CONCURRENT', max(1, _TOTAL_THREADS // 4)))
+# 排队名额（两类请求共用）：排队的请求也占着线程，默认只用剩下的线程，至少留一个给其他接口
+QUEUE_SIZE = int(os.environ.get('CATHUB_ADMISSION_QUEUE_SIZE',
+                                max(0, _TOTAL_THREADS - RECOGNIZE_MAX_CONCURRENT - UPLOAD_MAX_CONCURRENT - 1)))
+QUEUE_TIMEOUT = float(os.environ.get('CATHUB_ADMISSION_QUEUE_SECONDS', 2))
+# 每个 worker 进程同时处理（含排队）的昂贵请求数，0 不限制
+WORKER_SLOTS = int(os.environ.get('CATHUB_ADMISSION_WORKER_SLOTS',
+                                  max(1, int(os.environ.get('GUNICORN_THREADS', 2)) - 1)))
+# 每个客户端的令牌桶：每分钟补充的次数和桶容量（允许的突发），速率为 0 时不限流
+RECOGNIZE_RATE_PER_MINUTE = float(os.environ.get('CATHUB_RECOGNIZE_RATE_PER_MINUTE', 20))
+RECOGNIZE_BURST = int(os.environ.get('CATHUB_RECOGNIZE_BURST', 5))
+UPLOAD_RATE_PER_MINUTE = float(os.environ.get('CATHUB_UPLOAD_RATE_PER_MINUTE', 30))
+UPLOAD_BURST = int(os.environ.get('CATHUB_UPLOAD_BURST', 10))
+# 按客户端地址的令牌桶是单个客户端的几倍（NAT、校园网后面的多个用户共用一个地址）
+IP_MULTIPLIER = int(os.environ.get('CATHUB_ADMISSION_IP_MULTIPLIER', 5))
+# 计数文件；不设置时按数据库在临时目录里生成，同一台机器上的不同部署互不影响
+STORE = os.environ.get('CATHUB_ADMISSION_DB', '')
+# 租约的最长时间，应大于最慢请求的耗时（gunicorn 的 timeout 为 120 秒）
+LEASE_SECONDS = float(os.environ.get('CATHUB_ADMISSION_LEASE_SECONDS', 300))
+# 并发已满时建议客户端等待的秒数
+BUSY_RETRY_AFTER = 1
+# 超过这个时间没有请求的令牌桶早已补满，与不存在等价，定期删除
+BUCKET_IDLE_SECONDS = 3600
+
+# 一类请求的限制：全局并发上限、每个客户端每分钟的次数、桶容量
+Limit = namedtuple('Limit', 'max_concurrent rate_per_minute burst')
+
+class Rejected(Exception):
+    """请求没有被接纳：status 为 429（超过客户端速率）或 503（并发已满），retry_after 为建议等待的秒数"""
+
+    def __init__(self, kind, reason, status, retry_after):
+        super().__init__(f"{kind} 请求被拒绝（{reason}），{retry_after} 秒后重试")
+        self.kind = kind
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# ==================== 计数存储 ====================
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS leases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,  -- id 不复用：过期被清理的租约稍后归还时不会删掉别人的
+    name TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_leases_name ON leases(name);
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+'''
+
+class SqliteStore:
+    """本机 SQLite 文件里的租约和令牌桶，所有 worker 进程共享
+
+    每次操作是一个 BEGIN IMMEDIATE 事务，在文件锁下读取、判断和更新，进程之间不会超发名额或令牌。
+    数据只在运行期间有意义，不需要落盘同步。
+    """
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._next_cleanup = 0
+
+    def _conn(self):
+        # 每个线程一个连接；fork 出的 worker 不沿用主进程的连接
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _reap(self, conn):
+        """删除已退出进程的租约，返回删除的行数（只在 POSIX 上按 pid 判断，其他平台等租约过期）"""
+        if os.name != 'posix':
+            return 0
+        pid = os.getpid()
+        dead = [p for (p,) in conn.execute('SELECT DISTINCT pid FROM leases') if p != pid and not _alive(p)]
+        for p in dead:
+            conn.execute('DELETE FROM leases WHERE pid = ?', (p,))
+        if dead:
+            logger.info("回收已退出进程的并发名额", extra={'pids': dead})
+        return len(dead)
+
+    def prepare(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM leases WHERE expires < ?', (time.time(),))
+            self._reap(conn)
+
+    def acquire(self, name, limit):
+        """名额未满时占用一个，返回租约 id；已满返回 None"""
+        now = time.time()
+        count_sql = 'SELECT COUNT(*) FROM leases WHERE name = ?'
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM leases WHERE expires < ?', (now,))
+            if conn.execute(count_sql, (name,)).fetchone()[0] >= limit:
+                if not self._reap(conn) or conn.execute(count_sql, (name,)).fetchone()[0] >= limit:
+                    return None
+            cursor = conn.execute('INSERT INTO leases (name, pid, expires) VALUES (?, ?, ?)',
+                                  (name, os.getpid(), now + LEASE_SECONDS))
+            return cursor.lastrowid
+
+    def release(self, lease):
+        self._conn().execute('DELETE FROM leases WHERE id = ?', (lease,))
+
+    def take(self, key, rate, burst):
+        """从令牌桶取一个令牌（每秒补充 rate 个，最多 burst 个），返回还需要等待的秒数，0 表示成功"""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            if now >= self._next_cleanup:
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - BUCKET_IDLE_SECONDS,))
+                self._next_cleanup = now + 60
+        return wait
+
+    def refund(self, key, burst):
+        """归还 take 取走的令牌（请求最终没有被处理）"""
+        self._conn().execute('UPDATE buckets SET tokens = MIN(?, tokens + 1) WHERE key = ?', (burst, key))
+
+class MemoryStore:
+    """进程内存里的租约和令牌桶，语义与 SqliteStore 相同，只在单个进程内有效"""
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._leases = {}
+        self._buckets = {}
+
+    def prepare(self):
+        pass
+
+    def acquire(self, name, limit):
+        now = time.time()
+        with self._lock:
+            for lease in [k for k, (_, expires) in self._leases.items() if expires < now]:
+                del self._leases[lease]
+            if sum(1 for n, _ in self._leases.values() if n == name) >= limit:
+                return None
+            lease = next(self._ids)
+            self._leases[lease] = (name, now + LEASE_SECONDS)
+            return lease
+
+    def release(self, lease):
+        with self._lock:
+            self._leases.pop(lease, None)
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > 10000:
+                for k in [k for k, (_, t) in self._buckets.items() if t < now - BUCKET_IDLE_SECONDS]:
+                    del self._buckets[k]
+        return wait
+
+    def refund(self, key, burst):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(burst, tokens + 1), updated)
+
+def default_path(database):
+    """按数据库（SQLite 路径或 PostgreSQL URL）在临时目录里生成计数文件的路径"""
+    digest = hashlib.sha1(database.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'cathub_admission_{digest}.db')
+
+def create_store(path):
+    """path 为 memory 时使用进程内存，否则使用该路径的 SQLite 文件"""
+    if path == 'memory':
+        return MemoryStore()
+    return SqliteStore(path)
+
+# ==================== 准入 ====================
+class AdmissionControl:
+    """一个应用的准入控制：limits 为 {请求类别: Limit}，没有列出的类别不受限制"""
+
+    def __init__(self, store, limits, queue_size=QUEUE_SIZE, queue_timeout=QUEUE_TIMEOUT,
+                 worker_slots=WORKER_SLOTS, ip_multiplier=IP_MULTIPLIER):
+        self.store = store
+        self.limits = dict(limits)
+        self.ip_multiplier = max(1, ip_multiplier)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # 本进程的名额；gunicorn 预加载时在主进程创建，fork 出的 worker 各有一份（fork 时没有被占用）
+        self._worker_slots = threading.BoundedSemaphore(worker_slots) if worker_slots > 0 else None
+
+    def prepare(self):
+        """清理过期和已退出进程的租约（启动时调用）"""
+        self.store.prepare()
+
+    def _reject(self, kind, reason, status, retry_after, client):
+        retry_after = max(1, int(math.ceil(retry_after)))
+        ADMISSION_REJECTIONS.inc(kind=kind, reason=reason)
+        if status == 503:
+            logger.warning("并发已满，拒绝请求", extra={'kind': kind, 'client': client})
+        else:
+            sampled_debug(logger, "超过客户端速率，拒绝请求", extra={'kind': kind, 'client': client})
+        raise Rejected(kind, reason, status, retry_after)
+
+    def _take(self, kind, limit, client, device):
+        """从客户端地址和设备的令牌桶各取一个令牌，返回取到的 [(桶, 容量)]；任一个不够时归还已取的并拒绝"""
+        rate = limit.rate_per_minute / 60.0
+        buckets = [(f'{kind}:ip:{client}', rate * self.ip_multiplier, limit.burst * self.ip_multiplier)]
+        if device:
+            buckets.append((f'{kind}:device:{device}', rate, limit.burst))
+        taken = []
+        for bucket, bucket_rate, burst in buckets:
+            wait = self.store.take(bucket, bucket_rate, burst)
+            if wait:
+                self._refund(taken)
+                self._reject(kind, 'rate_limited', 429, wait, device or client)
+            taken.append((bucket, burst))
+        return taken
+
+    def _refund(self, taken):
+        for bucket, burst in taken:
+            self.store.refund(bucket, burst)
+
+    def acquire(self, kind, client, device=None):
+        """接纳一个 kind 类请求，返回租约（处理完交给 release）；不接纳时抛出 Rejected
+
+        client 为客户端地址，总是计入按地址的令牌桶；device 为客户端自报的设备标识（可以为空），
+        另外计入一个更紧的按设备的令牌桶。先检查速率，再占用并发名额；并发已满被拒绝时归还令牌，
+        客户端按 Retry-After 重试不会被限流。
+        """
+        limit = self.limits.get(kind)
+        if limit is None:
+            return None
+        taken = []
+        if limit.rate_per_minute > 0:
+            taken = self._take(kind, limit, client, device)
+        if limit.max_concurrent <= 0:
+            return None
+        lease = None
+        # 先占本进程的名额（不等待），排队时也一直占着：排队的请求同样占着线程
+        if self._worker_slots is None or self._worker_slots.acquire(blocking=False):
+            try:
+                lease = self.store.acquire(kind, limit.max_concurrent)
+                if lease is None:
+                    lease = self._wait(kind, limit.max_concurrent)
+            finally:
+                if lease is None and self._worker_slots is not None:
+                    self._worker_slots.release()
+        if lease is None:
+            self._refund(taken)
+            self._reject(kind, 'busy', 503, BUSY_RETRY_AFTER, device or client)
+        return lease
+
+    def _wait(self, kind, max_concurrent):
+        """占一个排队名额，最多等待 queue_timeout 秒；排队名额也满了立即返回 None"""
+        if self.queue_size <= 0 or self.queue_timeout <= 0:
+            return None
+        ticket = self.store.acquire('queue', self.queue_size)
+        if ticket is None:
+            return None
+        started = time.perf_counter()
+        deadline = started + self.queue_timeout
+        delay = 0.01
+        lease = None
+        try:
+            while lease is None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.1)
+                lease = self.store.acquire(kind, max_concurrent)
+        finally:
+            self.store.release(ticket)
+            ADMISSION_WAIT.observe(time.perf_counter() - started, kind=kind,
+                                   outcome='admitted' if lease is not None else 'timeout')
+        return lease
+
+    def release(self, lease):
+        if lease is not None:
+            try:
+                self.store.release(lease)
+            finally:
+                if self._worker_slots is not None:
+                    self._worker_slots.release()
@@ -3,77 +3,144 @@ AI 识别模块 - 支持多种 AI 服务
 - Google Gemini (国外)
 - 阿里云通义千问 (国内推荐)
 - 百度文心一言 (国内)
+
+每个调用都有同步版本（WSGI，gunicorn 线程）和协程版本（*_async，ASGI 入口 asgi.py），
+两者共用提示词、请求构造、结果解析和熔断/重试状态。
+服务商默认取自 AI_PROVIDER，各函数也可以传入 provider（应用配置 Config.ai_provider），
+同一个进程里的多个应用可以使用不同的服务商。
+测试和基准测试用 register_provider 注入不联网的替身（见 benchmarks/mock_ai.py），
+生产代码里没有模拟服务商，AI_PROVIDER 只能选择真实的服务。
 """
+import asyncio
+import functools
 import os
 import json
 import base64
+import threading
+import time
 from PIL import Image
 
+from ai_resilience import CircuitOpenError, get_guard, resilience_status
+from app_logging import get_logger, sampled_debug
+from tracing import span
+
+logger = get_logger('ai')
+
 # 检测使用哪个 AI 服务
 AI_PROVIDER = os.environ.get('AI_PROVIDER', 'gemini').lower()  # gemini, qwen, ernie
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
 QWEN_API_KEY = os.environ.get('DASHSCOPE_API_KEY', '')  # 阿里云通义千问
 ERNIE_API_KEY = os.environ.get('ERNIE_API_KEY', '')  # 百度文心一言
-
-# 调试信息
-print(f"🔍 环境变量检测:")
-print(f"   AI_PROVIDER = '{AI_PROVIDER}'")
-print(f"   DASHSCOPE_API_KEY = {'已设置 (长度: ' + str(len(QWEN_API_KEY)) + ')' if QWEN_API_KEY else '未设置'}")
-print(f"   GEMINI_API_KEY = {'已设置' if GEMINI_API_KEY else '未设置'}")
-print(f"   ERNIE_API_KEY = {'已设置' if ERNIE_API_KEY else '未设置'}")
+# AI 比较的相似度（百分比）超过这个值才算匹配
+AI_MATCH_THRESHOLD = 50
 
 model = None
-ai_service = None
 
-# 配置 Gemini
-if AI_PROVIDER == 'gemini' and GEMINI_API_KEY:
-    try:
-        import google.generativeai as genai
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        ai_service = 'gemini'
-        print("✅ Google Gemini API 已配置")
-    except Exception as e:
-        print(f"❌ Gemini 配置失败: {str(e)}")
+# SDK 导入和客户端构造推迟到第一次 AI 调用时执行（见 init_ai_client），
+# 这样 import 本模块很便宜，gunicorn --preload 时也不会在 fork 前创建网络客户端
+_client_lock = threading.Lock()
+# 服务商 -> 初始化结果（配置失败时为 None），每个服务商只初始化一次
+_clients = {}
+# register_provider 注册的服务商：名称 -> (call, call_async)
+_registered = {}
 
-# 配置阿里云通义千问
-elif AI_PROVIDER == 'qwen' and QWEN_API_KEY:
-    try:
-        import dashscope
-        dashscope.api_key = QWEN_API_KEY
-        ai_service = 'qwen'
-        print("✅ 阿里云通义千问 API 已配置")
-    except Exception as e:
-        print(f"❌ 通义千问配置失败: {str(e)}")
+def register_provider(name, call, call_async=None, display_name=None):
+    """注册一个服务商（测试和基准测试的替身）
 
-# 配置百度文心一言
-elif AI_PROVIDER == 'ernie' and ERNIE_API_KEY:
-    try:
-        import requests
-        ai_service = 'ernie'
-        print("✅ 百度文心一言 API 已配置")
-    except Exception as e:
-        print(f"❌ 文心一言配置失败: {str(e)}")
+    call(prompt, image_paths, timeout) 返回解析后的 JSON 结果；call_async 为协程版本，
+    没有时在线程池里执行 call。调用经过与内置服务商相同的熔断、重试和指标路径。
+    """
+    name = name.lower()
+    _registered[name] = (call, call_async)
+    PROVIDER_NAMES[name] = display_name or name
+    _clients.pop(name, None)
+
+def unregister_provider(name):
+    name = name.lower()
+    _registered.pop(name, None)
+    _clients.pop(name, None)
+
+def _configured_provider(provider=None):
+    """判断要使用的服务商（不导入任何 SDK）：provider 默认取 AI_PROVIDER，没有配置 API Key 时返回 None"""
+    provider = (provider or AI_PROVIDER).lower()
+    if provider == 'gemini' and GEMINI_API_KEY:
+        return 'gemini'
+    if provider == 'qwen' and QWEN_API_KEY:
+        return 'qwen'
+    if provider == 'ernie' and ERNIE_API_KEY:
+        return 'ernie'
+    if provider in _registered:
+        return provider
+    return None
 
-else:
-    print(f"⚠️ 未配置 AI API Key，AI 识别功能不可用")
-    print(f"   当前 AI_PROVIDER: {AI_PROVIDER}")
-    print(f"   支持的服务: gemini (国外), qwen (阿里云), ernie (百度)")
+def print_ai_config(provider=None):
+    """打印 AI 相关环境变量（调试用，启动时调用一次）"""
+    logger.info("AI 环境变量检测", extra={
+        'ai_provider': provider or AI_PROVIDER,
+        'dashscope_api_key': f'已设置 (长度: {len(QWEN_API_KEY)})' if QWEN_API_KEY else '未设置',
+        'gemini_api_key': '已设置' if GEMINI_API_KEY else '未设置',
+        'ernie_api_key': '已设置' if ERNIE_API_KEY else '未设置',
+    })
+    if not _configured_provider(provider):
+        logger.warning("未配置 AI API Key，AI 识别功能不可用（支持的服务: gemini, qwen, ernie）",
+                       extra={'ai_provider': provider or AI_PROVIDER})
+
+def init_ai_client(provider=None):
+    """按需导入 SDK 并配置客户端，返回可用的服务商名称（不可用时为 None）"""
+    global model
+    provider = _configured_provider(provider)
+    if provider is None or provider in _clients:
+        return _clients.get(provider)
+
+    with _client_lock:
+        if provider in _clients:
+            return _clients[provider]
+
+        ai_service = None
+
+        # 配置 Gemini
+        if provider == 'gemini':
+            try:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                model = genai.GenerativeModel('gemini-1.5-flash')
+                ai_service = 'gemini'
+                logger.info("Google Gemini API 已配置")
+            except Exception as e:
+                logger.error("Gemini 配置失败: %s", e)
+
+        # 配置阿里云通义千问
+        elif provider == 'qwen':
+            try:
+                import dashscope
+                dashscope.api_key = QWEN_API_KEY
+                ai_service = 'qwen'
+                logger.info("阿里云通义千问 API 已配置")
+            except Exception as e:
+                logger.error("通义千问配置失败: %s", e)
+
+        # 配置百度文心一言
+        elif provider == 'ernie':
+            try:
+                import requests
+                ai_service = 'ernie'
+                logger.info("百度文心一言 API 已配置")
+            except Exception as e:
+                logger.error("文心一言配置失败: %s", e)
+
+        elif provider in _registered:
+            ai_service = provider
+            logger.info("使用注册的 AI 服务", extra={'provider': provider})
+
+        _clients[provider] = ai_service
+    return ai_service
 
 def encode_image_base64(image_path):
     """将图片编码为 base64"""
     with open(image_path, 'rb') as f:
         return base64.b64encode(f.read()).decode('utf-8')
 
-def describe_cat_features(image_path):
-    """
-    使用 AI 描述猫咪特征
-    返回结构化的特征描述
-    """
-    if not ai_service:
-        return None
-
-    prompt = """
+DESCRIBE_PROMPT = """
     请详细描述这只猫咪的特征。请用 JSON 格式返回，包含以下字段：
 
     {
@@ -88,258 +155,260 @@ def describe_cat_features(image_path):
     只返回 JSON，不要其他文字。
     """
 
-    try:
-        if ai_service == 'gemini':
-            return _describe_with_gemini(image_path, prompt)
-        elif ai_service == 'qwen':
-            return _describe_with_qwen(image_path, prompt)
-        elif ai_service == 'ernie':
-            return _describe_with_ernie(image_path, prompt)
-    except Exception as e:
-        print(f"❌ AI 特征提取失败: {str(e)}")
-        return None
+COMPARE_PROMPT = """
+    请判断这两张照片是否是同一只猫。
+
+    请从以下方面比较：
+    1. 花色和斑纹图案是否一致
+    2. 斑纹的位置和分布是否相同
+    3. 体型是否相似
+    4. 其他显著特征
+
+    请用 JSON 格式返回：
+    {
+        "is_same_cat": true/false,
+        "similarity": 0-100 的数字,
+        "reason": "判断理由",
+        "confidence": "high/medium/low"
+    }
 
-def _describe_with_gemini(image_path, prompt):
-    """使用 Gemini 描述"""
-    img = Image.open(image_path)
-    response = model.generate_content([prompt, img])
-    text = response.text.strip()
+    只返回 JSON，不要其他文字。
+    """
 
-    # 移除 markdown 代码块标记
+PROVIDER_NAMES = {'gemini': 'Gemini', 'qwen': '通义千问', 'ernie': '百度文心一言'}
+
+def _strip_code_fence(text):
+    """移除 markdown 代码块标记"""
+    text = text.strip()
     if text.startswith('```json'):
         text = text[7:]
     if text.startswith('```'):
         text = text[3:]
     if text.endswith('```'):
         text = text[:-3]
-    text = text.strip()
+    return text.strip()
 
-    features = json.loads(text)
-    print(f"✅ Gemini 特征提取成功: {features.get('overall_description', '')}")
-    return features
+def _gemini_contents(prompt, image_paths):
+    return [prompt] + [Image.open(path) for path in image_paths]
 
-def _describe_with_qwen(image_path, prompt, max_retries=3):
-    """使用阿里云通义千问描述
+def _call_gemini(contents):
+    """调用 Gemini（经过熔断、自适应超时和退避重试），返回模型输出的文本"""
+    def attempt(timeout):
+        response = model.generate_content(contents, request_options={'timeout': timeout})
+        return response.text
 
-    Args:
-        image_path: 图片路径
-        prompt: 提示词
-        max_retries: 最大重试次数（默认 3 次）
+    return get_guard('gemini').call(attempt)
+
+async def _call_gemini_async(contents):
+    """_call_gemini 的协程版本（SDK 的 generate_content_async）"""
+    async def attempt(timeout):
+        response = await model.generate_content_async(contents, request_options={'timeout': timeout})
+        return response.text
+
+    return await get_guard('gemini').call_async(attempt)
+
+def _qwen_messages(prompt, image_paths):
+    content = [{'image': f'data:image/jpeg;base64,{encode_image_base64(path)}'} for path in image_paths]
+    content.append({'text': prompt})
+    return [{'role': 'user', 'content': content}]
+
+def _qwen_text(response, elapsed, timeout):
+    logger.info("通义千问 API 响应", extra={'elapsed_s': round(elapsed, 2), 'timeout_s': round(timeout, 1)})
+    if response.status_code != 200:
+        raise Exception(f"API 调用失败: {response.status_code} {getattr(response, 'message', '')}")
+    return response.output.choices[0].message.content[0]['text']
+
+def _call_qwen(messages):
+    """调用通义千问多模态接口（经过熔断、自适应超时和退避重试）
+
+    返回模型输出的文本；失败时抛出异常（熔断时为 CircuitOpenError）。
     """
     from dashscope import MultiModalConversation
-    import time
-
-    # 读取图片并转为 base64
-    image_base64 = encode_image_base64(image_path)
-
-    messages = [{
-        'role': 'user',
-        'content': [
-            {'image': f'data:image/jpeg;base64,{image_base64}'},
-            {'text': prompt}
-        ]
-    }]
-
-    # 重试机制
-    for attempt in range(max_retries + 1):
-        try:
-            print(f"🤖 调用通义千问 API (尝试 {attempt + 1}/{max_retries + 1})...")
-            start_time = time.time()
-
-            response = MultiModalConversation.call(
-                model='qwen-vl-plus',  # 使用 qwen-vl-plus（准确度和速度平衡）
-                messages=messages,
-                timeout=90  # 90 秒超时
-            )
-
-            elapsed = time.time() - start_time
-            print(f"⏱️ API 响应时间: {elapsed:.2f} 秒")
-
-            if response.status_code == 200:
-                break
-            else:
-                print(f"⚠️ API 返回错误状态码: {response.status_code}")
-                if attempt < max_retries:
-                    print(f"🔄 等待 2 秒后重试...")
-                    time.sleep(2)
-                    continue
-                else:
-                    raise Exception(f"API 调用失败: {response.status_code}")
-
-        except Exception as e:
-            if attempt < max_retries:
-                print(f"⚠️ API 调用失败: {str(e)}, 等待 2 秒后重试...")
-                time.sleep(2)
-                continue
-            else:
-                raise
-
-    if response.status_code == 200:
-        text = response.output.choices[0].message.content[0]['text'].strip()
-
-        # 移除 markdown 代码块标记
-        if text.startswith('```json'):
-            text = text[7:]
-        if text.startswith('```'):
-            text = text[3:]
-        if text.endswith('```'):
-            text = text[:-3]
-        text = text.strip()
-
-        features = json.loads(text)
-        print(f"✅ 通义千问特征提取成功: {features.get('overall_description', '')}")
-        return features
-    else:
-        print(f"❌ 通义千问调用失败: {response.message}")
-        return None
 
-def _describe_with_ernie(image_path, prompt):
-    """使用百度文心一言描述"""
+    def attempt(timeout):
+        start_time = time.time()
+        response = MultiModalConversation.call(
+            model='qwen-vl-plus',  # 使用 qwen-vl-plus（准确度和速度平衡）
+            messages=messages,
+            timeout=timeout
+        )
+        return _qwen_text(response, time.time() - start_time, timeout)
+
+    return get_guard('qwen').call(attempt)
+
+async def _call_qwen_async(messages):
+    """_call_qwen 的协程版本
+
+    SDK 提供 AioMultiModalConversation 时直接 await；旧版本 SDK 没有异步接口，
+    退回到默认线程池里执行同步调用（等待期间占用一个线程）。
+    """
+    try:
+        from dashscope import AioMultiModalConversation
+    except ImportError:
+        AioMultiModalConversation = None
+        from dashscope import MultiModalConversation
+
+    async def attempt(timeout):
+        start_time = time.time()
+        if AioMultiModalConversation is not None:
+            response = await AioMultiModalConversation.call(model='qwen-vl-plus', messages=messages, timeout=timeout)
+        else:
+            call = functools.partial(MultiModalConversation.call, model='qwen-vl-plus', messages=messages,
+                                     timeout=timeout)
+            response = await asyncio.get_running_loop().run_in_executor(None, call)
+        return _qwen_text(response, time.time() - start_time, timeout)
+
+    return await get_guard('qwen').call_async(attempt)
+
+def _call_registered(ai_service, prompt, image_paths):
+    """调用注册的服务商（经过熔断、自适应超时和退避重试）"""
+    call, _ = _registered[ai_service]
+    return get_guard(ai_service).call(lambda timeout: call(prompt, image_paths, timeout))
+
+async def _call_registered_async(ai_service, prompt, image_paths):
+    call, call_async = _registered[ai_service]
+
+    async def attempt(timeout):
+        if call_async is not None:
+            return await call_async(prompt, image_paths, timeout)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(call, prompt, image_paths, timeout))
+
+    return await get_guard(ai_service).call_async(attempt)
+
+def _ask(ai_service, prompt, image_paths):
+    """把提示词和照片发给服务商，返回解析后的 JSON"""
+    if ai_service == 'gemini':
+        return json.loads(_strip_code_fence(_call_gemini(_gemini_contents(prompt, image_paths))))
+    elif ai_service == 'qwen':
+        return json.loads(_strip_code_fence(_call_qwen(_qwen_messages(prompt, image_paths))))
+    elif ai_service in _registered:
+        return _call_registered(ai_service, prompt, image_paths)
     # TODO: 实现百度文心一言接口
-    print("⚠️ 百度文心一言接口待实现")
+    logger.warning("百度文心一言接口待实现")
     return None
 
-def compare_cat_images(image1_path, image2_path):
+async def _ask_async(ai_service, prompt, image_paths):
+    """_ask 的协程版本：等待服务商响应时不占用线程"""
+    if ai_service == 'gemini':
+        return json.loads(_strip_code_fence(await _call_gemini_async(_gemini_contents(prompt, image_paths))))
+    elif ai_service == 'qwen':
+        return json.loads(_strip_code_fence(await _call_qwen_async(_qwen_messages(prompt, image_paths))))
+    elif ai_service in _registered:
+        return await _call_registered_async(ai_service, prompt, image_paths)
+    logger.warning("百度文心一言接口待实现")
+    return None
+
+def _log_features(ai_service, features):
+    if features:
+        logger.info("%s特征提取成功", PROVIDER_NAMES.get(ai_service, ai_service),
+                    extra={'description': features.get('overall_description', '')})
+    return features
+
+def _log_comparison(ai_service, result):
+    if result:
+        sampled_debug(logger, f"{PROVIDER_NAMES.get(ai_service, ai_service)}比较完成",
+                      extra={'similarity': result.get('similarity', 0)})
+    return result
+
+def describe_cat_features(image_path, provider=None):
     """
-    使用 AI 比较两张猫咪照片
-    返回相似度和判断理由
+    使用 AI 描述猫咪特征
+    返回结构化的特征描述
     """
+    ai_service = init_ai_client(provider)
     if not ai_service:
         return None
 
-    prompt = """
-    请判断这两张照片是否是同一只猫。
+    try:
+        return _log_features(ai_service, _ask(ai_service, DESCRIBE_PROMPT, [image_path]))
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error("AI 特征提取失败: %s", e)
+        return None
 
-    请从以下方面比较：
-    1. 花色和斑纹图案是否一致
-    2. 斑纹的位置和分布是否相同
-    3. 体型是否相似
-    4. 其他显著特征
+async def describe_cat_features_async(image_path, provider=None):
+    """describe_cat_features 的协程版本（调用方需先在线程里执行 init_ai_client）"""
+    ai_service = init_ai_client(provider)
+    if not ai_service:
+        return None
 
-    请用 JSON 格式返回：
-    {
-        "is_same_cat": true/false,
-        "similarity": 0-100 的数字,
-        "reason": "判断理由",
-        "confidence": "high/medium/low"
-    }
+    try:
+        return _log_features(ai_service, await _ask_async(ai_service, DESCRIBE_PROMPT, [image_path]))
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error("AI 特征提取失败: %s", e)
+        return None
 
-    只返回 JSON，不要其他文字。
+def compare_cat_images(image1_path, image2_path, provider=None):
     """
+    使用 AI 比较两张猫咪照片
+    返回相似度和判断理由
+    """
+    ai_service = init_ai_client(provider)
+    if not ai_service:
+        return None
 
     try:
-        if ai_service == 'gemini':
-            return _compare_with_gemini(image1_path, image2_path, prompt)
-        elif ai_service == 'qwen':
-            return _compare_with_qwen(image1_path, image2_path, prompt)
-        elif ai_service == 'ernie':
-            return _compare_with_ernie(image1_path, image2_path, prompt)
+        return _log_comparison(ai_service, _ask(ai_service, COMPARE_PROMPT, [image1_path, image2_path]))
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        print(f"❌ AI 比较失败: {str(e)}")
+        logger.error("AI 比较失败: %s", e)
         return None
 
-def _compare_with_gemini(image1_path, image2_path, prompt):
-    """使用 Gemini 比较"""
-    img1 = Image.open(image1_path)
-    img2 = Image.open(image2_path)
-    response = model.generate_content([prompt, img1, img2])
-
-    text = response.text.strip()
-    if text.startswith('```json'):
-        text = text[7:]
-    if text.startswith('```'):
-        text = text[3:]
-    if text.endswith('```'):
-        text = text[:-3]
-    text = text.strip()
-
-    result = json.loads(text)
-    print(f"✅ Gemini 比较完成: 相似度 {result.get('similarity', 0)}%")
-    return result
-
-def _compare_with_qwen(image1_path, image2_path, prompt, max_retries=3):
-    """使用阿里云通义千问比较
+async def compare_cat_images_async(image1_path, image2_path, provider=None):
+    """compare_cat_images 的协程版本"""
+    ai_service = init_ai_client(provider)
+    if not ai_service:
+        return None
 
-    Args:
-        image1_path: 第一张图片路径
-        image2_path: 第二张图片路径
-        prompt: 提示词
-        max_retries: 最大重试次数（默认 3 次）
-    """
-    from dashscope import MultiModalConversation
-    import time
-
-    image1_base64 = encode_image_base64(image1_path)
-    image2_base64 = encode_image_base64(image2_path)
-
-    messages = [{
-        'role': 'user',
-        'content': [
-            {'image': f'data:image/jpeg;base64,{image1_base64}'},
-            {'image': f'data:image/jpeg;base64,{image2_base64}'},
-            {'text': prompt}
-        ]
-    }]
-
-    # 重试机制
-    for attempt in range(max_retries + 1):
-        try:
-            print(f"🤖 调用通义千问比较 API (尝试 {attempt + 1}/{max_retries + 1})...")
-            start_time = time.time()
-
-            response = MultiModalConversation.call(
-                model='qwen-vl-plus',  # 使用 qwen-vl-plus（准确度和速度平衡）
-                messages=messages,
-                timeout=90  # 90 秒超时
-            )
-
-            elapsed = time.time() - start_time
-            print(f"⏱️ API 响应时间: {elapsed:.2f} 秒")
-
-            if response.status_code == 200:
-                break
-            else:
-                print(f"⚠️ API 返回错误状态码: {response.status_code}")
-                if attempt < max_retries:
-                    print(f"🔄 等待 2 秒后重试...")
-                    time.sleep(2)
-                    continue
-                else:
-                    raise Exception(f"API 调用失败: {response.status_code}")
-
-        except Exception as e:
-            if attempt < max_retries:
-                print(f"⚠️ API 调用失败: {str(e)}, 等待 2 秒后重试...")
-                time.sleep(2)
-                continue
-            else:
-                raise
-
-    if response.status_code == 200:
-        text = response.output.choices[0].message.content[0]['text'].strip()
-
-        if text.startswith('```json'):
-            text = text[7:]
-        if text.startswith('```'):
-            text = text[3:]
-        if text.endswith('```'):
-            text = text[:-3]
-        text = text.strip()
-
-        result = json.loads(text)
-        print(f"✅ 通义千问比较完成: 相似度 {result.get('similarity', 0)}%")
-        return result
-    else:
-        print(f"❌ 通义千问调用失败: {response.message}")
+    try:
+        return _log_comparison(ai_service, await _ask_async(ai_service, COMPARE_PROMPT, [image1_path, image2_path]))
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.error("AI 比较失败: %s", e)
         return None
 
-def _compare_with_ernie(image1_path, image2_path, prompt):
-    """使用百度文心一言比较"""
-    # TODO: 实现百度文心一言接口
-    print("⚠️ 百度文心一言接口待实现")
+def _comparable_photos(cat):
+    """猫咪可以用来比较的照片路径（跳过没有路径或文件不存在的照片）"""
+    paths = []
+    for i, photo in enumerate(cat['photos']):
+        photo_path = photo.get('path')
+        if not photo_path:
+            sampled_debug(logger, "照片没有路径", extra={'cat_id': cat.get('id'), 'photo_index': i})
+            continue
+        if not os.path.exists(photo_path):
+            logger.warning("照片不存在", extra={'cat_id': cat.get('id'), 'path': photo_path})
+            continue
+        paths.append(photo_path)
+    return paths
+
+def _best_match(cat, results, threshold):
+    """取一只猫所有照片比较结果中相似度最高的，超过阈值时返回匹配项"""
+    max_similarity = 0
+    best_reason = ""
+    for result in results:
+        if result:
+            similarity = result.get('similarity', 0)
+            if similarity > max_similarity:
+                max_similarity = similarity
+                best_reason = result.get('reason', '')
+
+    # 如果相似度超过阈值，添加到匹配列表
+    if max_similarity > threshold:
+        sampled_debug(logger, "AI 匹配成功", extra={'cat_id': cat.get('id'), 'similarity': max_similarity})
+        return {
+            'cat': cat,
+            'similarity': max_similarity,
+            'reason': best_reason
+        }
     return None
 
-def recognize_cat_from_database(upload_image_path, cats_data):
+def recognize_cat_from_database(upload_image_path, cats_data, provider=None, threshold=AI_MATCH_THRESHOLD):
     """
     使用 AI 从数据库中识别猫咪
 
@@ -355,91 +424,130 @@ def recognize_cat_from_database(upload_image_path, cats_data):
                 },
                 ...
             ]
+        provider: 服务商，默认取 AI_PROVIDER
+        threshold: 相似度超过多少（百分比）才算匹配
 
     返回:
         匹配的猫咪列表，按相似度排序
+        服务商熔断时抛出 CircuitOpenError，由调用方降级到本地匹配
     """
+    ai_service = init_ai_client(provider)
     if not ai_service:
-        print("❌ AI 服务未配置")
+        logger.error("AI 服务未配置")
         return []
 
-    print(f"🤖 开始 AI 识别 (服务商: {ai_service})")
+    logger.info("开始 AI 识别", extra={'provider': ai_service, 'candidates': len(cats_data)})
     
     try:
         # 1. 描述上传的猫咪
-        print(f"📸 分析上传的照片: {upload_image_path}")
-        upload_features = describe_cat_features(upload_image_path)
+        with span('ai.describe'):
+            upload_features = describe_cat_features(upload_image_path, ai_service)
         if not upload_features:
-            print("❌ 无法提取上传照片的特征")
+            logger.error("无法提取上传照片的特征")
             return []
 
-        print(f"✅ 上传照片特征: {upload_features.get('overall_description', '')}")
+        logger.info("上传照片特征", extra={'description': upload_features.get('overall_description', '')})
 
         matches = []
 
         # 2. 与每只猫咪的照片比较
-        print(f"🔍 开始与 {len(cats_data)} 只猫咪比较...")
         for cat in cats_data:
             if not cat.get('photos'):
-                print(f"  ⚠️ {cat.get('name', 'Unknown')} 没有照片，跳过")
+                sampled_debug(logger, "猫咪没有照片，跳过", extra={'cat_id': cat.get('id')})
                 continue
 
-            max_similarity = 0
-            best_reason = ""
-
-            print(f"  📷 比较猫咪: {cat.get('name', 'Unknown')} ({len(cat['photos'])} 张照片)")
-
             # 与该猫咪的每张照片比较
-            for i, photo in enumerate(cat['photos']):
-                photo_path = photo.get('path')
-                if not photo_path:
-                    print(f"    ⚠️ 照片 {i+1} 没有路径")
-                    continue
-                if not os.path.exists(photo_path):
-                    print(f"    ⚠️ 照片 {i+1} 不存在: {photo_path}")
-                    continue
-
-                print(f"    🔄 比较照片 {i+1}: {photo_path}")
-
-                # 使用 AI 比较
-                result = compare_cat_images(upload_image_path, photo_path)
-                if result:
-                    similarity = result.get('similarity', 0)
-                    print(f"    ✅ 相似度: {similarity}%")
-                    if similarity > max_similarity:
-                        max_similarity = similarity
-                        best_reason = result.get('reason', '')
-                else:
-                    print(f"    ❌ 比较失败")
-
-            # 如果相似度超过阈值，添加到匹配列表
-            if max_similarity > 50:  # 50% 阈值
-                print(f"  ✅ 匹配成功: {cat.get('name', 'Unknown')} (相似度: {max_similarity}%)")
-                matches.append({
-                    'cat': cat,
-                    'similarity': max_similarity,
-                    'reason': best_reason
-                })
-            else:
-                print(f"  ❌ 相似度不足: {cat.get('name', 'Unknown')} (相似度: {max_similarity}%)")
+            results = []
+            for photo_path in _comparable_photos(cat):
+                with span('ai.compare', cat_id=cat.get('id')):
+                    results.append(compare_cat_images(upload_image_path, photo_path, ai_service))
+            match = _best_match(cat, results, threshold)
+            if match:
+                matches.append(match)
         
         # 按相似度排序
         matches.sort(key=lambda x: x['similarity'], reverse=True)
         
-        print(f"✅ AI 识别完成，找到 {len(matches)} 个匹配")
+        logger.info("AI 识别完成", extra={'matches': len(matches)})
         return matches
-        
+
+    except CircuitOpenError:
+        # 交给调用方降级到本地哈希匹配
+        raise
     except Exception as e:
-        print(f"❌ AI 识别失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("AI 识别失败")
         return []
 
-def is_ai_available():
-    """检查 AI 功能是否可用"""
-    return ai_service is not None
+async def recognize_cat_from_database_async(upload_image_path, cats_data, provider=None,
+                                            threshold=AI_MATCH_THRESHOLD):
+    """recognize_cat_from_database 的协程版本（ASGI 入口使用）
 
-def get_ai_provider():
-    """获取当前使用的 AI 服务商"""
-    return ai_service
+    比较的顺序、阈值和返回值与同步版本相同；等待服务商响应时不占用线程，
+    一个进程可以同时进行大量识别。
+    """
+    ai_service = init_ai_client(provider)
+    if not ai_service:
+        logger.error("AI 服务未配置")
+        return []
+
+    logger.info("开始 AI 识别", extra={'provider': ai_service, 'candidates': len(cats_data)})
+
+    try:
+        with span('ai.describe'):
+            upload_features = await describe_cat_features_async(upload_image_path, ai_service)
+        if not upload_features:
+            logger.error("无法提取上传照片的特征")
+            return []
+
+        logger.info("上传照片特征", extra={'description': upload_features.get('overall_description', '')})
+
+        matches = []
+        for cat in cats_data:
+            if not cat.get('photos'):
+                sampled_debug(logger, "猫咪没有照片，跳过", extra={'cat_id': cat.get('id')})
+                continue
+
+            results = []
+            for photo_path in _comparable_photos(cat):
+                with span('ai.compare', cat_id=cat.get('id')):
+                    results.append(await compare_cat_images_async(upload_image_path, photo_path, ai_service))
+            match = _best_match(cat, results, threshold)
+            if match:
+                matches.append(match)
+
+        matches.sort(key=lambda x: x['similarity'], reverse=True)
+
+        logger.info("AI 识别完成", extra={'matches': len(matches)})
+        return matches
+
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.exception("AI 识别失败")
+        return []
 
+def is_ai_available(provider=None):
+    """检查 AI 功能是否可用（客户端尚未初始化时只检查配置，不导入 SDK）"""
+    return get_ai_provider(provider) is not None
+
+def get_ai_provider(provider=None):
+    """获取实际使用的 AI 服务商（provider 默认取 AI_PROVIDER）"""
+    provider = _configured_provider(provider)
+    if provider in _clients:
+        return _clients[provider]
+    return provider
+
+def is_ai_circuit_open(provider=None):
+    """服务商的熔断器是否打开（打开时应降级到本地匹配）"""
+    provider = get_ai_provider(provider)
+    if not provider:
+        return False
+    return get_guard(provider).breaker.is_open()
+
+def get_ai_status(provider=None):
+    """AI 服务状态（服务商、熔断器、自适应超时），用于健康检查"""
+    status = resilience_status()
+    status['provider'] = get_ai_provider(provider)
+    status['client_initialized'] = _configured_provider(provider) in _clients
+    status['circuit_open'] = is_ai_circuit_open(provider)
+    return status
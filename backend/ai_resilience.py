@@ -0,0 +1,362 @@
+"""
+AI 服务弹性层
+- 每个服务商独立的熔断器（Circuit Breaker）
+- 基于延迟分位数的自适应超时
+- 带抖动的指数退避
+- 全局重试预算（防止重试风暴）
+- 同步（call）和协程（call_async）两种调用方式共用同一套状态
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from metrics import AI_CALL_DURATION, AI_CIRCUIT_REJECTIONS, AI_ERRORS, AI_RETRIES
+from app_logging import get_logger
+from tracing import span
+
+logger = get_logger('ai.resilience')
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+# 可通过环境变量调整的参数
+BREAKER_FAILURE_THRESHOLD = _env_int('AI_BREAKER_FAILURE_THRESHOLD', 5)    # 连续失败多少次后熔断
+BREAKER_RECOVERY_SECONDS = _env_float('AI_BREAKER_RECOVERY_SECONDS', 30)   # 熔断后多久允许试探
+TIMEOUT_MIN_SECONDS = _env_float('AI_TIMEOUT_MIN_SECONDS', 10)             # 自适应超时下限
+TIMEOUT_MAX_SECONDS = _env_float('AI_TIMEOUT_MAX_SECONDS', 60)             # 自适应超时上限
+TIMEOUT_PERCENTILE = _env_float('AI_TIMEOUT_PERCENTILE', 95)               # 参考的延迟分位数
+TIMEOUT_MULTIPLIER = _env_float('AI_TIMEOUT_MULTIPLIER', 2.0)              # 分位数延迟的倍数
+MAX_RETRIES = _env_int('AI_MAX_RETRIES', 2)                                # 单次调用最多重试次数
+BACKOFF_BASE_SECONDS = _env_float('AI_BACKOFF_BASE_SECONDS', 0.5)          # 退避基数
+BACKOFF_MAX_SECONDS = _env_float('AI_BACKOFF_MAX_SECONDS', 8)              # 单次退避上限
+CALL_DEADLINE_SECONDS = _env_float('AI_CALL_DEADLINE_SECONDS', 90)         # 单次调用（含重试）总时限
+RETRY_BUDGET_RATIO = _env_float('AI_RETRY_BUDGET_RATIO', 0.2)              # 重试次数占请求数的比例上限
+RETRY_BUDGET_MIN_PER_WINDOW = _env_int('AI_RETRY_BUDGET_MIN', 5)           # 每个窗口至少允许的重试次数
+RETRY_BUDGET_WINDOW_SECONDS = _env_float('AI_RETRY_BUDGET_WINDOW_SECONDS', 60)
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，调用被直接拒绝"""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"AI 服务 {provider} 已熔断，{retry_after:.0f} 秒后重试")
+        self.provider = provider
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """熔断器：closed -> open -> half_open -> closed"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 recovery_seconds=BREAKER_RECOVERY_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_open_in_flight = False
+        self._total_failures = 0
+        self._total_successes = 0
+        self._total_rejections = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_seconds:
+            self._state = self.HALF_OPEN
+            self._half_open_in_flight = False
+        return self._state
+
+    def is_open(self):
+        """熔断器是否拒绝新调用（half_open 状态下试探请求进行中也视为打开）"""
+        with self._lock:
+            state = self._current_state()
+            return state == self.OPEN or (state == self.HALF_OPEN and self._half_open_in_flight)
+
+    def retry_after(self):
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self.recovery_seconds - (time.monotonic() - self._opened_at))
+
+    def allow(self):
+        """申请一次调用；不允许时抛出 CircuitOpenError"""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._half_open_in_flight:
+                # 只放行一个试探请求
+                self._half_open_in_flight = True
+                return
+            self._total_rejections += 1
+            retry_after = max(0.0, self.recovery_seconds - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+            self._half_open_in_flight = False
+            self._total_successes += 1
+
+    def record_failure(self):
+        with self._lock:
+            self._total_failures += 1
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning("AI 服务熔断", extra={'provider': self.name,
+                                                         'consecutive_failures': self._consecutive_failures})
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._half_open_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state()
+            retry_after = 0.0
+            if state == self.OPEN:
+                retry_after = max(0.0, self.recovery_seconds - (time.monotonic() - self._opened_at))
+            return {
+                'state': state,
+                'consecutive_failures': self._consecutive_failures,
+                'total_failures': self._total_failures,
+                'total_successes': self._total_successes,
+                'total_rejections': self._total_rejections,
+                'retry_after_seconds': round(retry_after, 1),
+            }
+
+class AdaptiveTimeout:
+    """根据最近成功调用的延迟分位数计算超时时间"""
+
+    def __init__(self, initial=TIMEOUT_MAX_SECONDS, minimum=TIMEOUT_MIN_SECONDS,
+                 maximum=TIMEOUT_MAX_SECONDS, percentile=TIMEOUT_PERCENTILE,
+                 multiplier=TIMEOUT_MULTIPLIER, window=50, min_samples=5):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def latency_percentile(self, percentile=None):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        p = self.percentile if percentile is None else percentile
+        index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def timeout(self):
+        with self._lock:
+            enough = len(self._samples) >= self.min_samples
+        if not enough:
+            return self.initial
+        value = self.latency_percentile() * self.multiplier
+        return min(self.maximum, max(self.minimum, value))
+
+    def snapshot(self):
+        with self._lock:
+            count = len(self._samples)
+        p50 = self.latency_percentile(50)
+        p95 = self.latency_percentile(95)
+        return {
+            'timeout_seconds': round(self.timeout(), 2),
+            'samples': count,
+            'p50_seconds': round(p50, 2) if p50 is not None else None,
+            'p95_seconds': round(p95, 2) if p95 is not None else None,
+        }
+
+class RetryBudget:
+    """全局重试预算：一个时间窗口内重试次数不超过请求数的一定比例"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_per_window=RETRY_BUDGET_MIN_PER_WINDOW,
+                 window_seconds=RETRY_BUDGET_WINDOW_SECONDS):
+        self.ratio = ratio
+        self.min_per_window = min_per_window
+        self.window_seconds = window_seconds
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        cutoff = now - self.window_seconds
+        while self._requests and self._requests[0] < cutoff:
+            self._requests.popleft()
+        while self._retries and self._retries[0] < cutoff:
+            self._retries.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_acquire_retry(self):
+        """尝试消耗一次重试额度，成功返回 True"""
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            allowed = max(self.min_per_window, int(len(self._requests) * self.ratio))
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return {
+                'requests_in_window': len(self._requests),
+                'retries_in_window': len(self._retries),
+                'window_seconds': self.window_seconds,
+            }
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """带完全抖动（full jitter）的指数退避时间"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class ProviderGuard:
+    """为单个 AI 服务商封装熔断、自适应超时和重试"""
+
+    def __init__(self, name, budget):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.timeouts = AdaptiveTimeout()
+        self.budget = budget
+
+    def call(self, fn, max_retries=MAX_RETRIES, deadline=CALL_DEADLINE_SECONDS):
+        """执行 fn(timeout)，失败时按退避策略重试
+
+        fn 接收本次调用应使用的超时时间（秒），返回结果或抛出异常。
+        熔断器打开、重试预算耗尽或超过总时限时立即放弃。
+        """
+        started = time.monotonic()
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            timeout = self._begin_attempt(started, deadline)
+            call_started = time.monotonic()
+            try:
+                with span('ai.call', provider=self.name, attempt=attempt, timeout_s=round(timeout, 1)):
+                    result = fn(timeout)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, started, call_started, deadline, max_retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._record_success(call_started)
+            return result
+
+    async def call_async(self, fn, max_retries=MAX_RETRIES, deadline=CALL_DEADLINE_SECONDS):
+        """call 的协程版本：fn(timeout) 返回 awaitable，退避等待时不占用线程（ASGI 入口使用）"""
+        started = time.monotonic()
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            timeout = self._begin_attempt(started, deadline)
+            call_started = time.monotonic()
+            try:
+                with span('ai.call', provider=self.name, attempt=attempt, timeout_s=round(timeout, 1)):
+                    result = await fn(timeout)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, started, call_started, deadline, max_retries)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._record_success(call_started)
+            return result
+
+    def _begin_attempt(self, started, deadline):
+        """申请一次调用，返回本次调用的超时时间；熔断时抛出 CircuitOpenError"""
+        try:
+            self.breaker.allow()
+        except CircuitOpenError:
+            AI_CIRCUIT_REJECTIONS.inc(provider=self.name)
+            raise
+        remaining = deadline - (time.monotonic() - started)
+        return max(1.0, min(self.timeouts.timeout(), remaining))
+
+    def _retry_delay(self, error, attempt, started, call_started, deadline, max_retries):
+        """记录一次失败，返回重试前的等待时间；应当放弃时返回 None"""
+        AI_CALL_DURATION.observe(time.monotonic() - call_started, provider=self.name, outcome='error')
+        AI_ERRORS.inc(provider=self.name)
+        self.breaker.record_failure()
+        delay = backoff_delay(attempt)
+        elapsed = time.monotonic() - started
+        if attempt >= max_retries or self.breaker.is_open():
+            return None
+        if elapsed + delay >= deadline:
+            logger.warning("调用已超过总时限，放弃重试", extra={'provider': self.name, 'deadline_s': deadline})
+            return None
+        if not self.budget.try_acquire_retry():
+            logger.warning("重试预算已用尽，放弃重试", extra={'provider': self.name})
+            return None
+        logger.warning("AI 调用失败，稍后重试: %s", error, extra={
+            'provider': self.name, 'delay_s': round(delay, 2), 'attempt': attempt + 1, 'max_retries': max_retries})
+        AI_RETRIES.inc(provider=self.name)
+        return delay
+
+    def _record_success(self, call_started):
+        latency = time.monotonic() - call_started
+        AI_CALL_DURATION.observe(latency, provider=self.name, outcome='success')
+        self.timeouts.observe(latency)
+        self.breaker.record_success()
+
+    def snapshot(self):
+        data = self.breaker.snapshot()
+        data.update(self.timeouts.snapshot())
+        return data
+
+_retry_budget = RetryBudget()
+_guards = {}
+_guards_lock = threading.Lock()
+
+def get_guard(provider):
+    """获取（或创建）服务商对应的 ProviderGuard"""
+    with _guards_lock:
+        guard = _guards.get(provider)
+        if guard is None:
+            guard = ProviderGuard(provider, _retry_budget)
+            _guards[provider] = guard
+        return guard
+
+def resilience_status():
+    """所有服务商的熔断/超时状态，用于 /api/health"""
+    with _guards_lock:
+        guards = list(_guards.values())
+    return {
+        'providers': {g.name: g.snapshot() for g in guards},
+        'retry_budget': _retry_budget.snapshot(),
+    }
@@ -0,0 +1,95 @@
+"""
+结构化日志
+- JSON Lines 输出（LOG_FORMAT=text 时输出便于本地阅读的文本）
+- 日志级别由 LOG_LEVEL 控制，默认 INFO
+- 每条日志自动带上当前请求的 request_id（取自 X-Request-ID 请求头或自动生成）
+- 逐条（每只猫、每张照片）的调试日志用 sampled_debug 输出：
+  默认 INFO 级别下完全关闭，开启 DEBUG 后按 LOG_SAMPLE_RATE 抽样
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+# LogRecord 自带的属性，其余的都是通过 extra= 传入的结构化字段
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+def set_request_id(request_id):
+    """设置当前上下文的 request_id，返回用于 reset_request_id 的 token"""
+    return _request_id.set(request_id)
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+def get_request_id():
+    return _request_id.get()
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        request_id = _request_id.get()
+        if request_id:
+            entry['request_id'] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        request_id = _request_id.get()
+        prefix = time.strftime('%H:%M:%S', time.localtime(record.created))
+        line = f"{prefix} {record.levelname:<7} {record.name}"
+        if request_id:
+            line += f" [{request_id}]"
+        line += f" {record.getMessage()}"
+        fields = {k: v for k, v in record.__dict__.items() if k not in _RESERVED and not k.startswith('_')}
+        if fields:
+            line += ' ' + ' '.join(f'{k}={v}' for k, v in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+_configured = False
+
+def configure():
+    """配置 cathub 日志（幂等）"""
+    global _configured
+    if _configured:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(TextFormatter() if LOG_FORMAT == 'text' else JsonFormatter())
+    root = logging.getLogger('cathub')
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    _configured = True
+
+def get_logger(name):
+    configure()
+    return logging.getLogger(f'cathub.{name}')
+
+def sampled_debug(logger, msg, *args, **kwargs):
+    """热点循环中的调试日志：DEBUG 未开启时几乎零开销，开启后按 LOG_SAMPLE_RATE 抽样"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        logger.debug(msg, *args, **kwargs)
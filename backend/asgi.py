@@ -0,0 +1,285 @@
+"""
+ASGI 入口（uvicorn，或 gunicorn + UvicornWorker）
+- POST /api/recognize 用协程实现：AI 服务商的调用直接 await，等待期间不占用线程，
+  一个进程可以同时进行数百个识别；解析上传、保存照片、查询候选、哈希匹配和写入这些阻塞操作
+  放进线程池（CATHUB_ASGI_THREADS）
+- SSE（GET /api/events/stream）是异步生成器：在事件循环里等待 EventFeed 的新事件，空闲连接不占线程，
+  默认不限制每个进程的连接数（设置了 CATHUB_SSE_MAX_SUBSCRIBERS 时以环境变量为准）
+- 其他接口通过 a2wsgi 的 WSGIMiddleware 原样交给 Flask 应用（server.create_app 创建），在同一个线程池里按 WSGI 方式执行
+- Flask 的 before_request / after_request（请求 ID、指标、追踪、CORS、压缩）对识别和普通接口照常执行；
+  SSE 不经过 Flask，响应头与 WSGI 版本相同（CORS 允许任意来源）
+- WSGI 入口 server:app 和 gunicorn.conf.py 的默认部署方式不变
+- 准入控制（admission.py）的默认并发上限按 gunicorn 线程数计算，这里改为按协程和线程池计算：
+  识别等待 AI 时不占线程，可以同时进行更多；设置了对应的环境变量时以环境变量为准
+
+用法:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+    gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+
+需要安装 uvicorn 和 a2wsgi（pip install -r requirements-asgi.txt，版本已固定），不依赖其他 ASGI 框架。
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import Body, build_environ
+from flask import jsonify
+
+import metrics
+import server
+from config import Config
+from ai_recognition import recognize_cat_from_database_async
+from ai_resilience import CircuitOpenError
+from app_logging import get_logger
+from tracing import span
+
+logger = get_logger('asgi')
+
+# 执行阻塞操作（数据库、图像处理、普通 Flask 接口）的线程数；AI 等待不占用这些线程
+ASGI_THREADS = int(os.environ.get('CATHUB_ASGI_THREADS', 32))
+RECOGNIZE_PATH = '/api/recognize'
+EVENTS_STREAM_PATH = '/api/events/stream'
+# 所有 worker 合计同时进行的识别数和上传数（没有设置 CATHUB_RECOGNIZE_MAX_CONCURRENT 等环境变量时）
+ASGI_RECOGNIZE_MAX_CONCURRENT = 256
+ASGI_UPLOAD_MAX_CONCURRENT = max(1, ASGI_THREADS // 4)
+
+def _config():
+    config = Config.from_env()
+    if 'CATHUB_RECOGNIZE_MAX_CONCURRENT' not in os.environ:
+        config = config.replace(recognize_max_concurrent=ASGI_RECOGNIZE_MAX_CONCURRENT)
+    if 'CATHUB_UPLOAD_MAX_CONCURRENT' not in os.environ:
+        config = config.replace(upload_max_concurrent=ASGI_UPLOAD_MAX_CONCURRENT)
+    if 'CATHUB_ADMISSION_WORKER_SLOTS' not in os.environ:
+        # 识别不占线程、上传已有全局上限，不再按 gunicorn 线程数限制每个 worker
+        config = config.replace(admission_worker_slots=0)
+    if 'CATHUB_SSE_MAX_SUBSCRIBERS' not in os.environ:
+        # SSE 连接在事件循环里等待，不占线程
+        config = config.replace(sse_max_subscribers=0)
+    return config
+
+flask_app = server.create_app(_config())
+
+# ==================== 普通接口 ====================
+# 普通接口交给 a2wsgi 的 WSGI 适配层（逐块发送响应，请求体按需读取），与识别共用它的线程池；
+# ThreadPoolExecutor 在第一次提交任务时才启动线程，gunicorn 预加载时主进程里不会有线程
+wsgi_app = WSGIMiddleware(flask_app, workers=ASGI_THREADS)
+
+async def run_sync(fn, *args):
+    """在线程池里执行阻塞函数，沿用当前协程的上下文（请求 ID、Flask 请求、追踪 span）"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        wsgi_app.executor, functools.partial(context.run, fn, *args))
+
+# ==================== 识别 ====================
+async def match_candidates(upload_path, cats, use_ai):
+    """server.match_candidates 的协程版本：AI 调用 await，其余步骤在线程池里执行"""
+    if await run_sync(server.recognition_method, use_ai) == 'ai':
+        state = server.current_state()
+        cats_data, photos_by_id = await run_sync(server.ai_candidates, cats)
+        try:
+            with span('ai_match', provider=state.ai_provider, candidates=len(cats)):
+                results = await recognize_cat_from_database_async(
+                    upload_path, cats_data, provider=state.config.ai_provider,
+                    threshold=state.config.ai_match_threshold)
+            return await run_sync(server.ai_matches, results, photos_by_id), 'ai'
+        except CircuitOpenError as e:
+            logger.warning("%s，降级为本地哈希识别", e)
+
+    return await run_sync(server.hash_matches, upload_path, cats)
+
+async def recognize_cat():
+    """POST /api/recognize 的协程实现，响应与 server.recognize_cat 相同"""
+    try:
+        params, error = await run_sync(server.parse_recognition_request)
+        if error:
+            return error
+
+        # 先在附近的猫里识别，没有匹配时再扩大到其余的猫
+        matches = []
+        method = 'hash'
+        scope = 'all'
+        candidates = 0
+        index = 0
+        nearby_ids = None
+        while True:
+            tier, nearby_ids = await run_sync(server.fetch_candidate_tier, index, params, nearby_ids)
+            if tier is None:
+                break
+            index += 1
+            scope, cats = tier
+            candidates += len(cats)
+            matches, method = await match_candidates(params['upload_path'], cats, params['use_ai'])
+            if matches is None:
+                return jsonify({"error": "Failed to process image"}), 500
+            if matches:
+                break
+
+        return await run_sync(server.recognition_response, params, matches, method, scope, candidates)
+
+    except Exception as e:
+        logger.exception("识别失败")
+        return jsonify({"error": str(e)}), 500
+
+def _open_request(environ):
+    """推入 Flask 请求上下文并执行 before_request，返回 (上下文, 提前返回的响应或 None)"""
+    request_context = flask_app.request_context(environ)
+    request_context.push()
+    try:
+        return request_context, flask_app.preprocess_request()
+    except Exception as e:
+        return request_context, flask_app.handle_user_exception(e)
+
+def _close_request(request_context, rv):
+    """执行 after_request、生成完整的响应并弹出请求上下文（teardown_request），返回 (状态码, 响应头, 响应体)"""
+    error = None
+    try:
+        try:
+            response = flask_app.finalize_request(rv)
+        except Exception as e:
+            error = e
+            response = flask_app.handle_exception(e)
+        try:
+            body = b''.join(response.iter_encoded())
+            headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                       for name, value in response.headers.to_wsgi_list()]
+            return response.status_code, headers, body
+        finally:
+            response.close()
+    finally:
+        request_context.pop(error)
+
+async def _serve_recognize(scope, receive, send):
+    """识别接口：与 Flask 的 wsgi_app 相同的流程，只是视图函数是协程
+
+    三个阶段在同一个 contextvars 上下文里先后执行（不会并发），Flask 请求上下文、请求 ID 和追踪
+    在线程池和事件循环之间保持一致。environ 与普通接口一样由 a2wsgi 构造，请求体在线程里解析表单时按需读取；
+    识别结果是一个 JSON，整体生成后一次发送。
+    """
+    loop = asyncio.get_running_loop()
+    environ = build_environ(scope, Body(loop, receive))
+    context = contextvars.copy_context()
+    executor = wsgi_app.executor
+
+    request_context, rv = await loop.run_in_executor(executor, context.run, _open_request, environ)
+    if rv is None:
+        # 任务在创建时复制 context，能读到上面推入的请求上下文
+        task = context.run(asyncio.ensure_future, recognize_cat())
+        rv = await task
+
+    status, headers, body = await loop.run_in_executor(
+        executor, functools.partial(context.run, _close_request, request_context, rv))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+# ==================== 事件推送（SSE） ====================
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def _serve_events(scope, receive, send):
+    """GET /api/events/stream 的协程实现，推送的内容与 server.stream_events 相同
+
+    等待新事件和心跳都在事件循环里进行，只有订阅（第一次时读取最大事件 id）和落后于缓冲区时的补查进线程池。
+    """
+    state = flask_app.extensions['cathub']
+    event_feed = state.event_feed
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    if not await run_sync(event_feed.subscribe):
+        await send({'type': 'http.response.start', 'status': 503, 'headers': [
+            (b'content-type', b'application/json'), (b'retry-after', str(server.SSE_BUSY_RETRY_AFTER).encode()),
+            (b'access-control-allow-origin', b'*')]})
+        await send({'type': 'http.response.body', 'body': json.dumps(
+            {"error": "too many event streams, retry later", "retry_after": server.SSE_BUSY_RETRY_AFTER}).encode()})
+        return
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        last_id = _int_or_none(headers.get('last-event-id'))
+        if last_id is None:
+            last_id = _int_or_none((query.get('since_id') or [None])[0])
+        if last_id is None:
+            last_id = await run_sync(event_feed.latest_id)
+
+        response_headers = [(b'content-type', b'text/event-stream; charset=utf-8'),
+                            (b'access-control-allow-origin', b'*')]
+        response_headers += [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                             for name, value in server.SSE_HEADERS.items()]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+        await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + server.SSE_MAX_SECONDS
+        while loop.time() < deadline:
+            waiter = asyncio.ensure_future(event_feed.wait_for_async(last_id, server.SSE_HEARTBEAT_SECONDS))
+            await asyncio.wait({waiter, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                waiter.cancel()
+                return
+            events = waiter.result()
+            if events is None:
+                # 落后于内存缓冲区，直接从数据库补齐
+                events = await run_sync(server.fetch_events_since, last_id, server.EVENTS_MAX_LIMIT, state.database)
+            if not events:
+                chunk = ': keepalive\n\n'
+            else:
+                chunk = ''.join(server.sse_message(event) for event in events)
+                last_id = events[-1]['id']
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        event_feed.unsubscribe()
+
+# ==================== 生命周期 ====================
+def _startup():
+    # 每个 worker 各自执行：已退出进程的快照并入累计值，不影响已经启动的其他 worker
+    server.prepare(flask_app)
+    metrics.collect_exited()
+    logger.info("ASGI worker 已启动", extra={'pid': os.getpid(), 'threads': ASGI_THREADS})
+
+def _shutdown():
+    # 与 gunicorn.conf.py 的 worker_exit 相同：刷完写后队列，写最后一次指标快照并入累计值
+    server.shutdown(flask_app)
+    metrics.flush()
+    metrics.retire()
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await run_sync(_startup)
+            except Exception as e:
+                logger.exception("ASGI worker 启动失败")
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_sync(_shutdown)
+            wsgi_app.executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http':
+        path = scope['path'][len(scope.get('root_path', '')):]
+        if scope['method'] == 'POST' and path == RECOGNIZE_PATH:
+            await _serve_recognize(scope, receive, send)
+        elif scope['method'] == 'GET' and path == EVENTS_STREAM_PATH:
+            await _serve_events(scope, receive, send)
+        else:
+            await wsgi_app(scope, receive, send)
+    else:
+        # 不支持 WebSocket
+        await send({'type': 'websocket.close', 'code': 1000})
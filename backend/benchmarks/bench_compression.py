@@ -0,0 +1,117 @@
+"""
+响应压缩基准测试
+- 用合成猫群（默认 5000 只）生成 /api/cats 的完整响应和 fields=summary 响应
+- 对每种编码和压缩级别测量：压缩耗时（CPU）、压缩后大小、压缩率、吞吐量
+- 以及命中压缩缓存时的耗时（计算摘要 + 查表）
+
+用法:
+    python benchmarks/bench_compression.py [--cats 5000] [--photos 3] [--output compression.json]
+
+没有安装 brotli 时只测试 gzip。
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+BACKEND_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BACKEND_DIR)
+
+import colony  # noqa: E402
+
+GZIP_LEVELS = (1, 6, 9)
+BROTLI_QUALITIES = (1, 4, 6, 11)
+
+def cpu_ms(fn, min_time=0.5, min_rounds=3):
+    """重复运行 fn，返回每次调用的 CPU 耗时中位数（毫秒）"""
+    fn()  # 预热
+    samples = []
+    total_start = time.perf_counter()
+    while len(samples) < min_rounds or time.perf_counter() - total_start < min_time:
+        start = time.process_time()
+        fn()
+        samples.append(time.process_time() - start)
+    return round(statistics.median(samples) * 1000, 3)
+
+def bench_body(name, data, brotli, min_time):
+    encoders = [(f'gzip-{level}', lambda d, level=level: gzip.compress(d, compresslevel=level, mtime=0))
+                for level in GZIP_LEVELS]
+    if brotli is not None:
+        encoders += [(f'br-{q}', lambda d, q=q: brotli.compress(d, quality=q)) for q in BROTLI_QUALITIES]
+
+    results = {}
+    for label, encode in encoders:
+        print(f'▶ {name} {label}', file=sys.stderr)
+        size = len(encode(data))
+        ms = cpu_ms(lambda: encode(data), min_time=min_time)
+        results[label] = {
+            'cpu_ms': ms,
+            'bytes': size,
+            'ratio': round(size / len(data), 4),
+            'saved_bytes': len(data) - size,
+            'mb_per_s': round(len(data) / 1e6 / (ms / 1000), 1) if ms else None,
+        }
+    return {'raw_bytes': len(data), 'encodings': results}
+
+def main():
+    parser = argparse.ArgumentParser(description='Cathub 响应压缩基准测试')
+    parser.add_argument('--cats', type=int, default=5000)
+    parser.add_argument('--photos', type=int, default=3, help='每只猫的照片数')
+    parser.add_argument('--min-time', type=float, default=0.5, help='每个用例至少运行的秒数')
+    parser.add_argument('--output', help='把 JSON 结果写入文件')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cathub_gzip_')
+    os.environ.update({
+        'CATHUB_DATABASE': os.path.join(workdir, 'cathub.db'),
+        'CATHUB_UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'CATHUB_BLOB_CACHE_DIR': os.path.join(workdir, 'blob_cache'),
+        'CATHUB_METRICS_DIR': os.path.join(workdir, 'metrics'),
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+    import server
+    import compression
+
+    try:
+        colony.generate(args.cats, args.photos, n_records=0)
+        client = server.app.test_client()
+        # 不带 Accept-Encoding，拿到未压缩的响应体
+        bodies = {
+            'cats_all': client.get('/api/cats', base_url='http://bench.local').get_data(),
+            'cats_summary': client.get('/api/cats?fields=summary', base_url='http://bench.local').get_data(),
+        }
+        results = {name: bench_body(name, data, compression.brotli, args.min_time) for name, data in bodies.items()}
+
+        data = bodies['cats_all']
+        encoding = next(iter(compression.ENCODERS))
+        compression.compress(data, encoding)
+        results['cats_all']['cache_hit_cpu_ms'] = cpu_ms(lambda: compression.compress(data, encoding),
+                                                         min_time=args.min_time)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'cats': args.cats,
+            'photos_per_cat': args.photos,
+            'brotli': compression.brotli is not None,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+图片和序列化热点的微基准测试
+- save_photo（解码 + 缩放 + JPEG 编码）
+- compute_image_hash（未缓存 / 缓存命中）
+- hamming_distance / calculate_similarity
+- convert_photo_paths_to_urls
+- serialize_cat（get_cats 中每一行的 JSON 映射）
+
+用法:
+    python benchmarks/bench_hotpaths.py [--only save_photo,hash_uncached] [--output hot.json]
+    python benchmarks/bench_hotpaths.py --profile --profile-dir profiles/
+
+--profile 时每个用例额外：
+- 用 cProfile 运行，写出 <用例>.prof 并打印累计耗时前 15 的函数
+- 安装了 pyinstrument 时写出 <用例>.pyinstrument.txt
+- 用 tracemalloc 记录分配快照，写出 <用例>.alloc.txt（分配最多的 15 处）
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+BACKEND_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BACKEND_DIR)
+
+import colony  # noqa: E402
+
+def measure(fn, min_time=0.5, min_rounds=5):
+    """重复运行 fn 直到总耗时超过 min_time，返回每次调用的耗时统计（微秒）"""
+    fn()  # 预热
+    samples = []
+    total_start = time.perf_counter()
+    while len(samples) < min_rounds or time.perf_counter() - total_start < min_time:
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    us = [s * 1e6 for s in samples]
+    return {
+        'rounds': len(us),
+        'mean_us': round(statistics.mean(us), 2),
+        'median_us': round(statistics.median(us), 2),
+        'min_us': round(min(us), 2),
+        'stdev_us': round(statistics.stdev(us), 2) if len(us) > 1 else 0.0,
+    }
+
+def build_cases(server, workdir, args):
+    """返回 {用例名: 无参可调用对象}"""
+    from werkzeug.datastructures import FileStorage
+
+    rng = random.Random(1)
+    big_photo = colony.jpeg_bytes(
+        colony.base_image(1, size=args.photo_size).resize((args.photo_size, args.photo_size * 3 // 4)),
+        quality=90)
+    small_photo_path = os.path.join(workdir, 'small.jpg')
+    with open(small_photo_path, 'wb') as f:
+        f.write(colony.jpeg_bytes(colony.base_image(2)))
+
+    def save_photo():
+        key = server.save_photo(FileStorage(io.BytesIO(big_photo), filename='bench.jpg'))
+        server.current_state().storage.delete(key)
+
+    def hash_uncached():
+        server._compute_image_hash(small_photo_path)
+
+    server.compute_image_hash(small_photo_path)
+
+    def hash_cached():
+        server.compute_image_hash(small_photo_path)
+
+    hashes = [''.join(rng.choice('01') for _ in range(64)) for _ in range(256)]
+
+    def similarity():
+        # 模拟一次识别中上传照片与 256 张档案照片比较
+        upload = hashes[0]
+        for h in hashes:
+            server.calculate_similarity(upload, h)
+
+    def hamming():
+        upload = hashes[0]
+        for h in hashes:
+            server.hamming_distance(upload, h)
+
+    photos = [{'path': f'/srv/uploads/{i}_photo.jpg', 'uploaded_at': i} for i in range(args.photos)]
+
+    def photo_urls():
+        with server.app.test_request_context('/api/cats', base_url='http://bench.local'):
+            server.convert_photo_paths_to_urls(photos)
+
+    colony.generate(args.cats, args.photos, n_records=0)
+    conn = server.get_db()
+    rows = conn.execute('SELECT * FROM cats').fetchall()
+    conn.close()
+
+    def serialize_cats():
+        with server.app.test_request_context('/api/cats', base_url='http://bench.local'):
+            for row in rows:
+                server.serialize_cat(row)
+
+    return {
+        'save_photo': save_photo,
+        'hash_uncached': hash_uncached,
+        'hash_cached': hash_cached,
+        'hamming_distance_x256': hamming,
+        'calculate_similarity_x256': similarity,
+        'convert_photo_paths_to_urls': photo_urls,
+        f'serialize_cat_x{len(rows)}': serialize_cats,
+    }
+
+def profile_case(name, fn, out_dir, rounds):
+    os.makedirs(out_dir, exist_ok=True)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for _ in range(rounds):
+        fn()
+    profiler.disable()
+    prof_path = os.path.join(out_dir, f'{name}.prof')
+    profiler.dump_stats(prof_path)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(15)
+    print(f'\n===== cProfile: {name} ({rounds} 次) =====', file=sys.stderr)
+    print(stream.getvalue(), file=sys.stderr)
+
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+    if Profiler is not None:
+        p = Profiler()
+        p.start()
+        for _ in range(rounds):
+            fn()
+        p.stop()
+        with open(os.path.join(out_dir, f'{name}.pyinstrument.txt'), 'w', encoding='utf-8') as f:
+            f.write(p.output_text(unicode=True, color=False))
+
+    tracemalloc.start(25)
+    before = tracemalloc.take_snapshot()
+    for _ in range(rounds):
+        fn()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'lineno')
+    with open(os.path.join(out_dir, f'{name}.alloc.txt'), 'w', encoding='utf-8') as f:
+        f.write(f'peak traced memory: {peak / 1024:.1f} KiB over {rounds} rounds\n')
+        for stat in stats[:15]:
+            f.write(f'{stat}\n')
+    return {'cprofile': prof_path, 'peak_kib': round(peak / 1024, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Cathub 热点函数微基准测试')
+    parser.add_argument('--only', default='', help='只运行这些用例（逗号分隔，前缀匹配）')
+    parser.add_argument('--cats', type=int, default=500, help='serialize_cat 用例的行数')
+    parser.add_argument('--photos', type=int, default=5, help='每只猫的照片数')
+    parser.add_argument('--photo-size', type=int, default=2000, help='save_photo 输入图片的宽度')
+    parser.add_argument('--min-time', type=float, default=0.5, help='每个用例至少运行的秒数')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--profile-dir', default='profiles')
+    parser.add_argument('--profile-rounds', type=int, default=20)
+    parser.add_argument('--output', help='把 JSON 结果写入文件')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cathub_hot_')
+    os.environ.update({
+        'CATHUB_DATABASE': os.path.join(workdir, 'cathub.db'),
+        'CATHUB_UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'CATHUB_BLOB_CACHE_DIR': os.path.join(workdir, 'blob_cache'),
+        'CATHUB_METRICS_DIR': os.path.join(workdir, 'metrics'),
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+    import server
+
+    only = [o.strip() for o in args.only.split(',') if o.strip()]
+    results = {}
+    try:
+        for name, fn in build_cases(server, workdir, args).items():
+            if only and not any(name.startswith(o) for o in only):
+                continue
+            print(f'▶ {name}', file=sys.stderr)
+            results[name] = measure(fn, min_time=args.min_time)
+            if args.profile:
+                results[name]['profile'] = profile_case(name, fn, args.profile_dir, args.profile_rounds)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {'timestamp': int(time.time()), 'python': platform.python_version()},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""
+后端负载测试
+- 生成合成猫群（见 colony.py），分别通过 Flask 测试客户端、真实 gunicorn 进程和 ASGI 入口（asgi.py）压测
+- 场景：/api/cats（全部字段和 summary）、/api/events、附近的猫和事件、/api/recognize（哈希和 mock AI 两种模式）、照片上传，
+  以及几个客户端持续发送 mock AI 识别时 /api/health 的延迟（health_under_recognize_flood）
+- 默认关闭准入控制（admission.py），各场景的吞吐可以与之前的结果对比；--admission 按环境变量开启
+- 输出每个场景的 p50/p95/p99 延迟、吞吐量和错误数（JSON），便于跨提交对比
+
+用法:
+    python benchmarks/bench_load.py --cats 100 --photos 3 --records 1000 \\
+        --targets testclient,gunicorn --output load.json
+
+mock AI 模式使用 mock_ai.py 注册的模拟服务商（AI_PROVIDER=mock），不访问网络，延迟由 --mock-latency-ms 控制；
+gunicorn 和 ASGI 目标通过 mock_server:app / mock_asgi:app 入口在导入应用前注册。
+对比 WSGI 和 ASGI 入口在大量并发识别下的表现（需要安装 uvicorn 和 a2wsgi）:
+    python benchmarks/bench_load.py --targets gunicorn,asgi --scenarios recognize_mock_ai \
+        --cats 20 --photos 1 --concurrency 200 --recognize-requests 400 --mock-latency-ms 200
+对比准入控制开启前后识别洪峰下健康检查的延迟:
+    python benchmarks/bench_load.py --targets gunicorn --scenarios health_under_recognize_flood \
+        --concurrency 16 --mock-latency-ms 500 [--admission]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+BACKEND_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BACKEND_DIR)
+
+import colony  # noqa: E402
+import mock_ai  # noqa: E402
+
+# ==================== 压测目标 ====================
+class TestClientTarget:
+    """进程内 Flask 测试客户端（不含网络和 WSGI 服务器开销）"""
+    name = 'testclient'
+
+    def __init__(self):
+        import server
+        # 单独创建一个应用：缓存从空开始，与新启动的 gunicorn 进程可比
+        self.app = server.create_app()
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client
+
+    def get(self, path):
+        return self._client().get(path).status_code
+
+    def post_file(self, path, field, content, form=None, headers=None):
+        import io
+        data = dict(form or {})
+        data[field] = (io.BytesIO(content), 'photo.jpg')
+        return self._client().post(path, data=data, content_type='multipart/form-data',
+                                   headers=headers).status_code
+
+    def close(self):
+        # 刷完写后队列，下一个目标恢复数据库快照、结束时删除目录之前不再有写入
+        import server
+        server.shutdown(self.app)
+
+class GunicornTarget:
+    """真实 gunicorn 进程（使用 gunicorn.conf.py，经过网络栈）"""
+    name = 'gunicorn'
+    app = 'mock_server:app'
+    worker_args = []
+
+    def __init__(self, env, workers=None, threads=None):
+        import requests
+        self._requests = requests
+        self.port = _free_port()
+        self.base = f'http://127.0.0.1:{self.port}'
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+               '--bind', f'127.0.0.1:{self.port}', '--pythonpath', BENCH_DIR] + self.worker_args + [self.app]
+        if workers:
+            cmd += ['--workers', str(workers)]
+        if threads:
+            cmd += ['--threads', str(threads)]
+        self.proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._local = threading.local()
+        self._wait_ready()
+
+    def _wait_ready(self, timeout=30):
+        start = time.time()
+        while time.time() - start < timeout:
+            try:
+                if self._requests.get(self.base + '/api/health', timeout=1).status_code == 200:
+                    return
+            except self._requests.RequestException:
+                time.sleep(0.05)
+        raise RuntimeError('gunicorn 未能启动')
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        return session
+
+    def get(self, path):
+        return self._session().get(self.base + path, timeout=300).status_code
+
+    def post_file(self, path, field, content, form=None, headers=None):
+        files = {field: ('photo.jpg', content, 'image/jpeg')}
+        return self._session().post(self.base + path, data=form or {}, files=files, headers=headers,
+                                    timeout=300).status_code
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait(timeout=10)
+
+class AsgiTarget(GunicornTarget):
+    """ASGI 入口（asgi.py，gunicorn + UvicornWorker，需要安装 uvicorn 和 a2wsgi），识别时 AI 调用不占用线程"""
+    name = 'asgi'
+    app = 'mock_asgi:app'
+    worker_args = ['-k', 'uvicorn.workers.UvicornWorker']
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# ==================== 场景 ====================
+def build_scenarios(args, n_cats):
+    rng = random.Random(7)
+    queries = [colony.query_image(rng.randrange(n_cats), seed=i) for i in range(16)]
+    upload = colony.jpeg_bytes(colony.base_image(999_999))
+
+    def recognize(use_ai, clients=None):
+        def run(target, i):
+            # clients 个设备轮流发送（洪峰场景模拟少数几个客户端）
+            headers = {'X-Device-ID': f'bench-{i % clients}'} if clients else None
+            return target.post_file('/api/recognize', 'photo', queries[i % len(queries)],
+                                    form={'use_ai': use_ai, 'location': '基准测试'}, headers=headers)
+        return run
+
+    points = [(colony.CENTER_LAT + rng.uniform(-0.03, 0.03), colony.CENTER_LNG + rng.uniform(-0.03, 0.03))
+              for _ in range(32)]
+
+    def nearby(path):
+        def run(target, i):
+            lat, lng = points[i % len(points)]
+            return target.get(f'{path}?lat={lat}&lng={lng}&radius_m=1000&limit=20')
+        return run
+
+    return [
+        ('cats_list', args.requests, lambda t, i: t.get('/api/cats')),
+        ('cats_list_summary', args.requests, lambda t, i: t.get('/api/cats?fields=summary')),
+        ('events_list', args.requests, lambda t, i: t.get('/api/events?limit=20')),
+        ('cats_nearby', args.requests, nearby('/api/cats/nearby')),
+        ('events_nearby', args.requests, nearby('/api/events/nearby')),
+        ('recognize_hash', args.recognize_requests, recognize('false')),
+        ('recognize_mock_ai', args.recognize_requests, recognize('true')),
+        # 上传放在最后：会往第一只猫的档案里追加照片，影响后续识别的候选集
+        ('photo_upload', args.requests, lambda t, i: t.post_file('/api/cats/1/photos', 'photo', upload)),
+        # 3 个客户端以 --concurrency 个线程持续识别，同时测量健康检查
+        ('health_under_recognize_flood', args.requests,
+         Flood(recognize('true', clients=3), lambda t, i: t.get('/api/health'))),
+    ]
+
+class Flood:
+    """后台持续发送 flood 请求，同时用 PROBE_CONCURRENCY 个线程测量 probe 请求的延迟"""
+    PROBE_CONCURRENCY = 2
+    WARMUP_SECONDS = 0.5
+
+    def __init__(self, flood, probe):
+        self.flood = flood
+        self.probe = probe
+
+    def run(self, target, n_requests, concurrency):
+        stop = threading.Event()
+        statuses = {}
+        lock = threading.Lock()
+
+        def send(worker):
+            i = worker
+            while not stop.is_set():
+                try:
+                    status = self.flood(target, i)
+                except Exception:
+                    status = 599
+                with lock:
+                    statuses[status] = statuses.get(status, 0) + 1
+                i += concurrency
+
+        threads = [threading.Thread(target=send, args=(w,), daemon=True) for w in range(concurrency)]
+        for t in threads:
+            t.start()
+        time.sleep(self.WARMUP_SECONDS)
+        try:
+            result = run_scenario(target, self.probe, n_requests, self.PROBE_CONCURRENCY)
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        # 洪峰请求的状态码分布：准入控制开启时多出 429（限流）和 503（并发已满）
+        result['flood_statuses'] = {str(k): v for k, v in sorted(statuses.items())}
+        return result
+
+def run_scenario(target, fn, n_requests, concurrency):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            status = fn(target, i)
+        except Exception:
+            status = 599
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors += 1
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(n_requests)))
+    wall = time.perf_counter() - wall_start
+    return summarize(latencies, wall, errors)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies, wall, errors):
+    values = sorted(latencies)
+    ms = lambda v: round(v * 1000, 2) if v is not None else None
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / wall, 2) if wall > 0 else None,
+        'mean_ms': ms(statistics.mean(values)) if values else None,
+        'p50_ms': ms(percentile(values, 50)),
+        'p95_ms': ms(percentile(values, 95)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# ==================== 主流程 ====================
+def main():
+    parser = argparse.ArgumentParser(description='Cathub 后端负载测试')
+    parser.add_argument('--cats', type=int, default=100)
+    parser.add_argument('--photos', type=int, default=3, help='每只猫的照片数')
+    parser.add_argument('--records', type=int, default=1000, help='目击/投喂/健康/事件各多少条')
+    parser.add_argument('--requests', type=int, default=200, help='轻量场景的请求数')
+    parser.add_argument('--recognize-requests', type=int, default=20, help='识别场景的请求数')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--targets', default='testclient,gunicorn')
+    parser.add_argument('--scenarios', default='', help='只运行这些场景（逗号分隔）')
+    parser.add_argument('--mock-latency-ms', type=float, default=5)
+    parser.add_argument('--workers', type=int, help='gunicorn worker 数（默认取 gunicorn.conf.py）')
+    parser.add_argument('--threads', type=int, help='gunicorn 每个 worker 的线程数')
+    parser.add_argument('--admission', action='store_true',
+                        help='开启准入控制（并发上限和限流按环境变量，默认关闭以便与之前的结果对比）')
+    parser.add_argument('--keep-data', action='store_true', help='保留生成的临时数据目录')
+    parser.add_argument('--output', help='把 JSON 结果写入文件')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cathub_load_')
+    env = dict(os.environ)
+    env.update({
+        'CATHUB_DATABASE': os.path.join(workdir, 'cathub.db'),
+        'CATHUB_UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'CATHUB_BLOB_CACHE_DIR': os.path.join(workdir, 'blob_cache'),
+        'CATHUB_METRICS_DIR': os.path.join(workdir, 'metrics'),
+        'CATHUB_ADMISSION_DB': os.path.join(workdir, 'admission.db'),
+        'AI_PROVIDER': 'mock',
+        'AI_MOCK_LATENCY_MS': str(args.mock_latency_ms),
+        'LOG_LEVEL': env.get('LOG_LEVEL', 'WARNING'),
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    if not args.admission:
+        env.update({name: '0' for name in ('CATHUB_RECOGNIZE_MAX_CONCURRENT', 'CATHUB_UPLOAD_MAX_CONCURRENT',
+                                           'CATHUB_ADMISSION_WORKER_SLOTS', 'CATHUB_RECOGNIZE_RATE_PER_MINUTE',
+                                           'CATHUB_UPLOAD_RATE_PER_MINUTE')})
+    # 测试客户端在本进程内导入 server，环境变量和模拟服务商必须在导入前设置
+    os.environ.update(env)
+    mock_ai.install(latency_ms=args.mock_latency_ms)
+
+    wanted = {s.strip() for s in args.scenarios.split(',') if s.strip()}
+    results = {}
+    try:
+        dataset = colony.generate(args.cats, args.photos, args.records)
+        snapshot = os.path.join(workdir, 'snapshot.db')
+        shutil.copy(env['CATHUB_DATABASE'], snapshot)
+
+        for target_name in [t.strip() for t in args.targets.split(',') if t.strip()]:
+            # 每个目标从同一份数据开始
+            shutil.copy(snapshot, env['CATHUB_DATABASE'])
+            if target_name == 'testclient':
+                target = TestClientTarget()
+            elif target_name == 'gunicorn':
+                target = GunicornTarget(env, args.workers, args.threads)
+            elif target_name == 'asgi':
+                target = AsgiTarget(env, args.workers)
+            else:
+                raise SystemExit(f'未知目标: {target_name}')
+            try:
+                results[target_name] = {}
+                for name, n, fn in build_scenarios(args, args.cats):
+                    if wanted and name not in wanted:
+                        continue
+                    print(f'▶ {target_name} / {name} ({n} 个请求, 并发 {args.concurrency})', file=sys.stderr)
+                    if isinstance(fn, Flood):
+                        results[target_name][name] = fn.run(target, n, args.concurrency)
+                    else:
+                        results[target_name][name] = run_scenario(target, fn, n, args.concurrency)
+            finally:
+                target.close()
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'dataset': dataset,
+            'concurrency': args.concurrency,
+            'mock_latency_ms': args.mock_latency_ms,
+            'admission': args.admission,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
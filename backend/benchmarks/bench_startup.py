@@ -0,0 +1,118 @@
+"""
+启动时间基准测试
+- import server 的耗时（多次运行取中位数）
+- 从启动进程到第一个 /api/health 返回 200 的耗时（gunicorn 和 Flask 开发服务器）
+
+用法:
+    python benchmarks/bench_startup.py [--runs 5] [--output startup.json]
+
+每次运行都使用全新的临时数据库和上传目录，结果以 JSON 输出，便于跨提交对比。
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import server; "
+    "print(time.perf_counter() - t)"
+)
+
+def _fresh_env():
+    """每次运行使用独立的数据库和上传目录"""
+    workdir = tempfile.mkdtemp(prefix='cathub_bench_')
+    env = dict(os.environ)
+    env['CATHUB_DATABASE'] = os.path.join(workdir, 'cathub.db')
+    env['CATHUB_UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    env['CATHUB_BLOB_CACHE_DIR'] = os.path.join(workdir, 'blob_cache')
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return workdir, env
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def measure_import(runs):
+    """在子进程中测量 import server 的耗时（秒）"""
+    samples = []
+    for _ in range(runs):
+        workdir, env = _fresh_env()
+        try:
+            out = subprocess.run(
+                [sys.executable, '-c', IMPORT_SNIPPET],
+                cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            samples.append(float(out.strip().splitlines()[-1]))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return samples
+
+def measure_first_health(runs, server_kind, timeout=60):
+    """测量从启动进程到 /api/health 第一次返回 200 的耗时（秒）"""
+    samples = []
+    for _ in range(runs):
+        workdir, env = _fresh_env()
+        port = _free_port()
+        if server_kind == 'gunicorn':
+            cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                   '--bind', f'127.0.0.1:{port}', 'server:app']
+        else:
+            env['PORT'] = str(port)
+            cmd = [sys.executable, 'server.py']
+
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = f'http://127.0.0.1:{port}/api/health'
+            while True:
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError(f'{server_kind} 在 {timeout} 秒内没有响应')
+                try:
+                    with urllib.request.urlopen(url, timeout=1) as resp:
+                        if resp.status == 200:
+                            break
+                except OSError:
+                    time.sleep(0.01)
+            samples.append(time.perf_counter() - start)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+            shutil.rmtree(workdir, ignore_errors=True)
+    return samples
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'median_ms': round(statistics.median(samples) * 1000, 1),
+        'min_ms': round(min(samples) * 1000, 1),
+        'max_ms': round(max(samples) * 1000, 1),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cathub 启动时间基准测试')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--servers', default='gunicorn,flask',
+                        help='要测量的服务器，逗号分隔（gunicorn, flask）')
+    parser.add_argument('--output', help='把 JSON 结果写入文件')
+    args = parser.parse_args()
+
+    results = {'import_server': summarize(measure_import(args.runs))}
+    for kind in [k.strip() for k in args.servers.split(',') if k.strip()]:
+        results[f'first_health_{kind}'] = summarize(measure_first_health(args.runs, kind))
+
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
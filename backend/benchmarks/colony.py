@@ -0,0 +1,117 @@
+"""
+合成猫群数据，供基准测试使用
+- N 只猫 × 每只 M 张合成照片（同一只猫的照片是同一底图加轻微扰动，便于哈希匹配）
+- K 条目击、投喂、健康上报和事件记录
+
+数据库和上传目录由调用方通过 CATHUB_DATABASE（或 CATHUB_DATABASE_URL）/ CATHUB_UPLOAD_FOLDER 指定，
+本模块在导入 server 之前不会读取这两个环境变量。
+"""
+import io
+import json
+import random
+import time
+
+from PIL import Image, ImageDraw
+
+# 合成坐标围绕的中心点（上海）
+CENTER_LAT = 31.2304
+CENTER_LNG = 121.4737
+
+PATTERNS = ['三花', '橘猫', '黑白', '狸花', '纯黑', '纯白', '玳瑁', '奶牛']
+AREAS = ['小区东门', '停车场', '食堂后面', '图书馆', '花园', '教学楼', '宿舍楼下', '篮球场']
+PERSONALITY = ['温顺', '胆小', '亲人', '高冷', '贪吃', '活泼']
+FOODS = ['鸡胸肉', '幼猫粮', '成猫粮', '罐头', '冻干']
+EVENT_TYPES = ['sighting', 'health_report', 'new_cat']
+
+def base_image(seed, size=256):
+    """为一只猫生成底图：随机色块"""
+    rng = random.Random(seed)
+    img = Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        x1, y1 = x0 + rng.randrange(20, size // 2), y0 + rng.randrange(20, size // 2)
+        draw.ellipse((x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return img
+
+def variant(img, seed):
+    """同一只猫的另一张照片：轻微平移和亮度扰动"""
+    rng = random.Random(seed)
+    dx, dy = rng.randrange(-8, 9), rng.randrange(-8, 9)
+    shifted = Image.new('RGB', img.size, (128, 128, 128))
+    shifted.paste(img, (dx, dy))
+    factor = 0.9 + rng.random() * 0.2
+    return shifted.point(lambda p: min(255, int(p * factor)))
+
+def jpeg_bytes(img, quality=75):
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+def query_image(cat_index, seed=0):
+    """用于识别请求的照片：第 cat_index 只猫的新变体（JPEG 字节）"""
+    return jpeg_bytes(variant(base_image(cat_index), 10_000 + seed))
+
+def generate(n_cats=100, photos_per_cat=3, n_records=1000, seed=42):
+    """在 server.app 的数据库和照片存储中生成合成数据，返回统计信息"""
+    import server
+
+    server.ensure_db()
+    rng = random.Random(seed)
+    now = int(time.time())
+
+    cat_rows = []
+    for i in range(n_cats):
+        base = base_image(i)
+        photos = []
+        for j in range(photos_per_cat):
+            key = f'synthetic_{i}_{j}.jpg'
+            server.current_state().storage.put(key, jpeg_bytes(variant(base, i * 100 + j)))
+            photos.append({'path': key, 'uploaded_at': now})
+        lat = CENTER_LAT + rng.uniform(-0.05, 0.05)
+        lng = CENTER_LNG + rng.uniform(-0.05, 0.05)
+        cat_rows.append((
+            f'猫咪{i}', rng.choice(['male', 'female']), rng.randrange(1, 120), rng.choice(PATTERNS),
+            json.dumps(rng.sample(AREAS, 2), ensure_ascii=False),
+            json.dumps(rng.sample(PERSONALITY, 2), ensure_ascii=False),
+            json.dumps(rng.sample(FOODS, 2), ensure_ascii=False),
+            '少量多餐', f'合成数据 {i}',
+            json.dumps(photos, ensure_ascii=False), json.dumps([]),
+            'benchmark', now - rng.randrange(86400 * 365), now,
+            (now - rng.randrange(86400 * 30)) * 1000, rng.choice(AREAS), lat, lng,
+        ))
+
+    conn = server.get_db()
+    conn.executemany('''INSERT INTO cats
+        (name, sex, age_months, pattern, activity_areas, personality, food_preferences,
+         feeding_tips, notes, photos, embeddings, created_by, created_at, updated_at,
+         last_seen_at, last_seen_location, last_seen_latitude, last_seen_longitude)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', cat_rows)
+    cat_ids = [r[0] for r in conn.execute('SELECT id FROM cats').fetchall()]
+
+    def ts():
+        return now - rng.randrange(86400 * 90)
+
+    conn.executemany('''INSERT INTO sightings (cat_id, photo, location, similarity, device, reporter, ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        [(rng.choice(cat_ids), None, rng.choice(AREAS), rng.random(), 'bench', f'user{rng.randrange(50)}', ts())
+         for _ in range(n_records)])
+    conn.executemany('''INSERT INTO feed_logs (cat_id, food, qty, note, reporter, ts)
+        VALUES (?, ?, ?, ?, ?, ?)''',
+        [(rng.choice(cat_ids), rng.choice(FOODS), '50g', '', f'user{rng.randrange(50)}', ts())
+         for _ in range(n_records)])
+    conn.executemany('''INSERT INTO health_reports (cat_id, type, severity, note, photos, reporter, ts, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        [(rng.choice(cat_ids), rng.choice(['injury', 'sick', 'neutered', 'other']),
+          rng.choice(['low', 'medium', 'high']), '合成上报', '[]', f'user{rng.randrange(50)}', ts(), 'pending')
+         for _ in range(n_records)])
+    conn.executemany('''INSERT INTO events
+        (event_type, cat_id, cat_name, title, description, location, latitude, longitude, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        [(rng.choice(EVENT_TYPES), cid, f'猫咪{cid}', f'猫咪{cid} 的事件', '合成事件', rng.choice(AREAS),
+          CENTER_LAT + rng.uniform(-0.05, 0.05), CENTER_LNG + rng.uniform(-0.05, 0.05), ts() * 1000)
+         for cid in (rng.choice(cat_ids) for _ in range(n_records))])
+    conn.commit()
+    conn.close()
+
+    return {'cats': n_cats, 'photos': n_cats * photos_per_cat, 'records_per_table': n_records}
@@ -0,0 +1,78 @@
+"""
+不联网的模拟 AI 服务商（只用于基准测试和测试）
+- install() 通过 ai_recognition.register_provider 注册为 mock，之后 AI_PROVIDER=mock / Config.ai_provider='mock'
+  的应用使用它；调用经过与真实服务商相同的熔断、重试和指标路径
+- 固定延迟（AI_MOCK_LATENCY_MS，默认 50ms）后返回确定性的结果：描述按文件内容生成特征，
+  比较时内容相同的照片相似度 95，其余由两张照片的摘要确定性地生成 0-60
+- 需要在导入 server 之前调用 install()（应用创建时判断 AI 是否可用）；gunicorn 压测使用
+  mock_server:app / mock_asgi:app（--pythonpath benchmarks），先注册再导入应用
+"""
+import asyncio
+import hashlib
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+import ai_recognition  # noqa: E402
+
+NAME = 'mock'
+LATENCY_MS = float(os.environ.get('AI_MOCK_LATENCY_MS', 50))
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def features(image_path):
+    """描述：根据文件内容返回确定性的特征"""
+    digest = _file_digest(image_path)
+    return {
+        'pattern': '模拟花色',
+        'primary_color': digest[:6],
+        'markings': '',
+        'body_type': '中等',
+        'distinctive_features': [],
+        'overall_description': f'模拟特征 {digest[:8]}',
+    }
+
+def comparison(image1_path, image2_path):
+    """比较：内容相同的照片相似度 95，其余确定性地生成 0-60"""
+    digest1 = _file_digest(image1_path)
+    digest2 = _file_digest(image2_path)
+    if digest1 == digest2:
+        similarity = 95
+    else:
+        pair = hashlib.md5((min(digest1, digest2) + max(digest1, digest2)).encode()).hexdigest()
+        similarity = int(pair[:4], 16) % 61
+    return {
+        'is_same_cat': similarity > 50,
+        'similarity': similarity,
+        'reason': '模拟比较结果',
+        'confidence': 'low',
+    }
+
+def _result(image_paths):
+    # 一张照片是描述请求，两张是比较请求
+    return features(*image_paths) if len(image_paths) == 1 else comparison(*image_paths)
+
+def call(prompt, image_paths, timeout, latency_ms=None):
+    time.sleep(min((LATENCY_MS if latency_ms is None else latency_ms) / 1000.0, timeout))
+    return _result(image_paths)
+
+async def call_async(prompt, image_paths, timeout, latency_ms=None):
+    await asyncio.sleep(min((LATENCY_MS if latency_ms is None else latency_ms) / 1000.0, timeout))
+    return _result(image_paths)
+
+def install(name=NAME, latency_ms=None):
+    """注册模拟服务商；latency_ms 默认取 AI_MOCK_LATENCY_MS"""
+    ai_recognition.register_provider(
+        name,
+        lambda prompt, paths, timeout: call(prompt, paths, timeout, latency_ms),
+        lambda prompt, paths, timeout: call_async(prompt, paths, timeout, latency_ms),
+        display_name='mock')
+
+def uninstall(name=NAME):
+    ai_recognition.unregister_provider(name)
@@ -0,0 +1,6 @@
+"""ASGI 压测入口：注册模拟 AI 服务商后导出 asgi:app（gunicorn --pythonpath benchmarks -k uvicorn.workers.UvicornWorker mock_asgi:app）"""
+import mock_ai
+
+mock_ai.install()
+
+from asgi import app  # noqa: E402,F401
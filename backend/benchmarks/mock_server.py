@@ -0,0 +1,6 @@
+"""gunicorn 压测入口：注册模拟 AI 服务商后导出 server:app（gunicorn --pythonpath benchmarks mock_server:app）"""
+import mock_ai
+
+mock_ai.install()
+
+from server import app  # noqa: E402,F401
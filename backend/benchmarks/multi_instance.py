@@ -0,0 +1,401 @@
+"""
+多实例一致性测试（横向扩展模式，见 PERFORMANCE_OPTIMIZATION.md）
+- 启动两个独立的 gunicorn 实例 A、B（各自的 worker、指标目录和照片本地缓存），
+  共享同一个 PostgreSQL 数据库和照片存储，模拟负载均衡后面的两台机器
+- 没有指定 --database-url 时，用 PATH（或 --pg-bin）里的 initdb / pg_ctl 在临时目录启动一个一次性的
+  PostgreSQL 作为共享数据库，不需要 docker；指定时在该服务器上新建一个临时数据库，结束后删除
+- 照片存储默认是两个实例共用的本地目录（代替共享的对象存储）；环境变量里设置了 CATHUB_STORAGE=s3 等时照常使用
+- 检查：
+  1. read_your_writes：在一个实例上写入，立即在另一个实例上读到
+  2. concurrent_writes：两个实例并发写入，id 不重复，两边读到的明细和统计一致
+  3. idempotency：同一个幂等键同时发给两个实例，只写入一次，两边返回同一个 id
+  4. photos：在 A 上传的照片在 B 上可以下载，在 B 重复上传时去重
+  5. cats_cache：B 缓存猫咪列表后在 A 修改，B 立即返回新数据（跨实例缓存失效）
+  6. sync_and_events：两个实例并发写入时，在 B 上按 token 增量同步、按 since_id 拉取事件和 SSE 推送，不漏不重
+- 任一检查失败时退出码为 1
+
+用法:
+    python benchmarks/multi_instance.py
+    python benchmarks/multi_instance.py --database-url postgresql://postgres@127.0.0.1:5432/postgres
+    python benchmarks/multi_instance.py --sqlite        # 对照：同一台机器上两个实例共享 SQLite 文件
+
+需要安装 psycopg（pip install "psycopg[binary]"）；PostgreSQL 不能以 root 运行，root 下请使用 --database-url。
+"""
+import argparse
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.abspath(os.path.dirname(__file__))
+BACKEND_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# ==================== 共享数据库 ====================
+class TemporaryPostgres:
+    """临时目录里的一次性 PostgreSQL 服务器"""
+
+    def __init__(self, workdir, pg_bin=None):
+        initdb = shutil.which('initdb', path=pg_bin)
+        self._pg_ctl = shutil.which('pg_ctl', path=pg_bin)
+        if not initdb or not self._pg_ctl:
+            raise SystemExit('找不到 initdb / pg_ctl：把 PostgreSQL 的 bin 目录加入 PATH、使用 --pg-bin，'
+                             '或用 --database-url 指定已有的服务器')
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise SystemExit('PostgreSQL 不能以 root 运行：请用普通用户执行，或用 --database-url 指定已有的服务器')
+        self.data = os.path.join(workdir, 'pgdata')
+        port = _free_port()
+        subprocess.run([initdb, '-D', self.data, '-U', 'postgres', '--auth=trust', '--encoding=UTF8', '--no-locale'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([self._pg_ctl, '-D', self.data, '-l', os.path.join(workdir, 'postgres.log'), '-w',
+                        '-o', f'-p {port} -k {workdir} -c listen_addresses=127.0.0.1', 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        self.url = f'postgresql://postgres@127.0.0.1:{port}/postgres'
+
+    def close(self):
+        subprocess.run([self._pg_ctl, '-D', self.data, '-m', 'fast', '-w', 'stop'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+class ScratchDatabase:
+    """在服务器上新建一个临时数据库（UTF8），结束时删除"""
+
+    def __init__(self, server_url):
+        import psycopg
+        self._psycopg = psycopg
+        self._server_url = server_url
+        self.name = f'cathub_multi_{uuid.uuid4().hex[:8]}'
+        with psycopg.connect(server_url, autocommit=True) as conn:
+            conn.execute(f"CREATE DATABASE {self.name} ENCODING 'UTF8' TEMPLATE template0")
+        self.url = re.sub(r'/[^/?]*(\?|$)', f'/{self.name}\\1', server_url.split('://', 1)[1], count=1)
+        self.url = server_url.split('://', 1)[0] + '://' + self.url
+
+    def close(self):
+        with self._psycopg.connect(self._server_url, autocommit=True) as conn:
+            conn.execute(f'DROP DATABASE IF EXISTS {self.name} WITH (FORCE)')
+
+# ==================== 应用实例 ====================
+class Instance:
+    """一个独立的 gunicorn 实例（使用 gunicorn.conf.py）"""
+
+    def __init__(self, name, env, workdir, workers, threads):
+        self.name = name
+        self.port = _free_port()
+        self.base = f'http://127.0.0.1:{self.port}'
+        env = dict(env)
+        env.update({
+            'CATHUB_BLOB_CACHE_DIR': os.path.join(workdir, f'blob_cache_{name}'),
+            'CATHUB_METRICS_DIR': os.path.join(workdir, f'metrics_{name}'),
+        })
+        self.log_path = os.path.join(workdir, f'instance_{name}.log')
+        self._log = open(self.log_path, 'wb')
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{self.port}',
+               '--workers', str(workers), '--threads', str(threads), 'server:app']
+        self.proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+        self._local = threading.local()
+        self._wait_ready()
+
+    def _wait_ready(self, timeout=60):
+        start = time.time()
+        while time.time() - start < timeout:
+            if self.proc.poll() is not None:
+                break
+            try:
+                if requests.get(self.base + '/api/health', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError(f'实例 {self.name} 未能启动，日志见 {self.log_path}')
+
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', 60)
+        return self.session().request(method, self.base + path, **kwargs)
+
+    def json(self, method, path, expect=200, **kwargs):
+        response = self.request(method, path, **kwargs)
+        if response.status_code != expect:
+            raise AssertionError(f'{self.name} {method} {path}: {response.status_code} {response.text[:200]}')
+        return response.json()
+
+    def close(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self._log.close()
+
+# ==================== 检查 ====================
+def _new_cat(instance, name):
+    return instance.json('POST', '/api/cats', expect=201, json={'name': name, 'pattern': '狸花'})['id']
+
+def check_read_your_writes(a, b, args):
+    mismatches = 0
+    for i in range(args.rounds):
+        writer, reader = (a, b) if i % 2 == 0 else (b, a)
+        cat_id = _new_cat(writer, f'跨实例{i}')
+        if reader.json('GET', f'/api/cats/{cat_id}')['name'] != f'跨实例{i}':
+            mismatches += 1
+        writer.json('PUT', f'/api/cats/{cat_id}', json={'name': f'跨实例{i}-改'})
+        if reader.json('GET', f'/api/cats/{cat_id}')['name'] != f'跨实例{i}-改':
+            mismatches += 1
+    return mismatches == 0, {'rounds': args.rounds, 'mismatches': mismatches}
+
+def check_concurrent_writes(a, b, args):
+    cat_id = _new_cat(a, '并发投喂')
+    total = args.writers * args.rounds
+
+    def write(i):
+        instance = a if i % 2 == 0 else b
+        return instance.json('POST', '/api/feed_logs', expect=201, json={'cat_id': cat_id, 'food': f'f{i}'})['id']
+
+    with ThreadPoolExecutor(args.writers) as pool:
+        ids = list(pool.map(write, range(total)))
+    seen = [{log['id'] for log in instance.json('GET', f'/api/feed_logs?cat_id={cat_id}')} for instance in (a, b)]
+    counts = []
+    for instance in (a, b):
+        series = instance.json('GET', f'/api/stats?metric=feed&cat_id={cat_id}&from=0&to={int(time.time()) + 86400}')
+        counts.append(sum(item['count'] for item in series['series']))
+    ok = len(set(ids)) == total and seen[0] == seen[1] == set(ids) and counts == [total, total]
+    return ok, {'writes': total, 'unique_ids': len(set(ids)), 'rows_a': len(seen[0]), 'rows_b': len(seen[1]),
+                'stats_a': counts[0], 'stats_b': counts[1]}
+
+def check_idempotency(a, b, args):
+    cat_id = _new_cat(a, '幂等')
+    prefix = uuid.uuid4().hex
+    results = []
+
+    def post(instance, key, barrier):
+        barrier.wait()
+        body = instance.json('POST', '/api/feed_logs/batch',
+                             json=[{'cat_id': cat_id, 'food': 'retry', 'idempotency_key': key}])
+        return body['results'][0]
+
+    with ThreadPoolExecutor(2) as pool:
+        for i in range(args.rounds):
+            barrier = threading.Barrier(2)
+            key = f'{prefix}-{i}'
+            futures = [pool.submit(post, instance, key, barrier) for instance in (a, b)]
+            results.append([f.result() for f in futures])
+    created = sum(1 for pair in results for r in pair if r['status'] == 'created')
+    same_id = all(pair[0]['id'] == pair[1]['id'] for pair in results)
+    rows = len(b.json('GET', f'/api/feed_logs?cat_id={cat_id}'))
+    ok = created == args.rounds and same_id and rows == args.rounds
+    return ok, {'keys': args.rounds, 'created': created, 'same_id': same_id, 'rows': rows}
+
+def _jpeg(seed):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), ((seed * 37) % 256, (seed * 91) % 256, 128)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def check_photos(a, b, args):
+    cat_id = _new_cat(a, '照片')
+    content = _jpeg(int(time.time()))
+    upload = a.json('POST', f'/api/cats/{cat_id}/photos', files={'photo': ('cat.jpg', content, 'image/jpeg')})
+    download = b.request('GET', '/uploads/' + upload['path'], allow_redirects=True)
+    again = b.json('POST', f'/api/cats/{cat_id}/photos', files={'photo': ('cat.jpg', content, 'image/jpeg')})
+    served = download.status_code == 200 and len(download.content) > 0
+    ok = served and again['duplicate'] and again['path'] == upload['path']
+    return ok, {'path': upload['path'], 'served_by_b': served, 'deduplicated_on_b': again['duplicate']}
+
+def check_cats_cache(a, b, args):
+    cat_id = _new_cat(a, '缓存')
+    first = b.request('GET', '/api/cats?fields=summary')
+    etag = first.headers.get('ETag')
+    cached = b.request('GET', '/api/cats?fields=summary', headers={'If-None-Match': etag})
+    a.json('PUT', f'/api/cats/{cat_id}', json={'name': '缓存-改'})
+    after = b.request('GET', '/api/cats?fields=summary', headers={'If-None-Match': etag})
+    names = {cat['id']: cat['name'] for cat in after.json()} if after.status_code == 200 else {}
+    ok = cached.status_code == 304 and after.status_code == 200 and names.get(cat_id) == '缓存-改'
+    return ok, {'revalidated': cached.status_code, 'after_write_on_a': after.status_code,
+                'etag_changed': after.headers.get('ETag') != etag}
+
+def _read_sse(instance, since_id, expected, timeout, out):
+    """从 instance 的 SSE 读取 since_id 之后的事件 id，读到 expected 里的全部 id 或超时为止"""
+    deadline = time.time() + timeout
+    try:
+        with instance.session().get(instance.base + f'/api/events/stream?since_id={since_id}',
+                                    stream=True, timeout=(5, 5)) as response:
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith('id: '):
+                    out.append(int(line[4:]))
+                if expected.is_set() and set(expected.ids) <= set(out) or time.time() > deadline:
+                    return
+    except requests.RequestException:
+        pass
+
+def check_sync_and_events(a, b, args):
+    cat_id = _new_cat(a, '同步')
+    token = b.json('GET', '/api/sync?limit=1')['token']
+    while True:
+        page = b.json('GET', f'/api/sync?since={token}&limit=2000')
+        token = page['token']
+        if not page['has_more']:
+            break
+    events = b.json('GET', '/api/events?limit=1')
+    event_cursor = events[0]['id'] if events else 0
+
+    expected = threading.Event()
+    expected.ids = []
+    sse_ids = []
+    sse = threading.Thread(target=_read_sse, args=(b, event_cursor, expected, 60, sse_ids), daemon=True)
+    sse.start()
+
+    done = threading.Event()
+    synced, event_ids = {}, []
+
+    def poll():
+        nonlocal token, event_cursor
+        page = b.json('GET', f'/api/sync?since={token}&limit=200')
+        for report in page['upserts'].get('health_reports', []):
+            synced[report['id']] = synced.get(report['id'], 0) + 1
+        token = page['token']
+        for event in b.json('GET', f'/api/events?since_id={event_cursor}&limit=200'):
+            event_ids.append(event['id'])
+            event_cursor = event['id']
+        return page['has_more']
+
+    def reader():
+        while not done.is_set():
+            poll()
+            time.sleep(0.01)
+
+    def write(i):
+        instance = a if i % 2 == 0 else b
+        return instance.json('POST', '/api/health_reports', expect=201,
+                             json={'cat_id': cat_id, 'type': 'sick', 'severity': 'low', 'note': f'n{i}'})['id']
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    with ThreadPoolExecutor(args.writers) as pool:
+        report_ids = list(pool.map(write, range(args.writers * args.rounds)))
+    done.set()
+    reader_thread.join()
+    while poll():
+        pass
+    poll()
+
+    own_events = [e['id'] for e in b.json('GET', f'/api/events?limit={min(500, len(report_ids) * 2)}')
+                  if e['cat_id'] == cat_id and e['event_type'] == 'health_report']
+    expected.ids = own_events
+    expected.set()
+    sse.join(timeout=70)
+
+    missing_sync = set(report_ids) - set(synced)
+    missing_events = set(own_events) - set(event_ids)
+    duplicate_events = len(event_ids) - len(set(event_ids))
+    missing_sse = set(own_events) - set(sse_ids)
+    ok = (not missing_sync and not missing_events and duplicate_events == 0 and not missing_sse
+          and len(own_events) == len(report_ids) and event_ids == sorted(event_ids))
+    return ok, {'writes': len(report_ids), 'missing_in_sync': len(missing_sync),
+                'missing_in_since_id': len(missing_events), 'duplicate_events': duplicate_events,
+                'missing_in_sse': len(missing_sse)}
+
+CHECKS = [
+    ('read_your_writes', check_read_your_writes),
+    ('concurrent_writes', check_concurrent_writes),
+    ('idempotency', check_idempotency),
+    ('photos', check_photos),
+    ('cats_cache', check_cats_cache),
+    ('sync_and_events', check_sync_and_events),
+]
+
+# ==================== 主流程 ====================
+def main():
+    parser = argparse.ArgumentParser(description='Cathub 多实例一致性测试')
+    parser.add_argument('--database-url', help='已有的 PostgreSQL 服务器（在上面新建临时数据库）')
+    parser.add_argument('--pg-bin', help='initdb / pg_ctl 所在目录（默认从 PATH 查找）')
+    parser.add_argument('--sqlite', action='store_true', help='两个实例共享一个 SQLite 文件（只适用于同一台机器）')
+    parser.add_argument('--workers', type=int, default=2, help='每个实例的 gunicorn worker 数')
+    parser.add_argument('--threads', type=int, default=4, help='每个 worker 的线程数')
+    parser.add_argument('--writers', type=int, default=8, help='并发写入的线程数')
+    parser.add_argument('--rounds', type=int, default=20, help='每个检查的轮数（每个写线程的写入数）')
+    parser.add_argument('--checks', default='', help='只运行这些检查（逗号分隔）')
+    parser.add_argument('--keep-data', action='store_true', help='保留临时目录（日志、数据库）')
+    parser.add_argument('--output', help='把 JSON 结果写入文件')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cathub_multi_')
+    env = dict(os.environ)
+    env.update({
+        'CATHUB_UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'AI_PROVIDER': 'none',
+        'LOG_LEVEL': env.get('LOG_LEVEL', 'WARNING'),
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    resources = []
+    instances = []
+    results = {}
+    try:
+        if args.sqlite:
+            env.pop('CATHUB_DATABASE_URL', None)
+            env['CATHUB_DATABASE'] = os.path.join(workdir, 'cathub.db')
+            database = 'sqlite'
+        else:
+            server_url = args.database_url
+            if not server_url:
+                server = TemporaryPostgres(workdir, args.pg_bin)
+                resources.append(server)
+                server_url = server.url
+            scratch = ScratchDatabase(server_url)
+            resources.append(scratch)
+            env['CATHUB_DATABASE_URL'] = scratch.url
+            database = 'postgres'
+
+        print(f'启动实例 A、B（{database}，各 {args.workers} 个 worker × {args.threads} 线程）', file=sys.stderr)
+        instances = [Instance(name, env, workdir, args.workers, args.threads) for name in ('a', 'b')]
+        wanted = {c.strip() for c in args.checks.split(',') if c.strip()}
+        for name, check in CHECKS:
+            if wanted and name not in wanted:
+                continue
+            start = time.time()
+            try:
+                ok, detail = check(instances[0], instances[1], args)
+            except Exception as e:
+                ok, detail = False, {'error': f'{type(e).__name__}: {e}'}
+            detail['seconds'] = round(time.time() - start, 2)
+            results[name] = {'ok': ok, **detail}
+            print(f"{'PASS' if ok else 'FAIL'} {name} {json.dumps(detail, ensure_ascii=False)}", file=sys.stderr)
+    finally:
+        for instance in instances:
+            instance.close()
+        for resource in reversed(resources):
+            if not args.keep_data:
+                resource.close()
+        if args.keep_data:
+            print(f'临时目录: {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'database': database, 'workers': args.workers, 'threads': args.threads,
+              'ok': bool(results) and all(r['ok'] for r in results.values()), 'checks': results}
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    sys.exit(0 if report['ok'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+"""
+照片存储后端（CATHUB_STORAGE）
+- local：本地目录 CATHUB_UPLOAD_FOLDER（默认）
+- s3：S3 兼容的对象存储（AWS S3、MinIO、Cloudflare R2 等），多个实例共享同一个桶，
+  Render / Zeabur 重新部署不会丢照片；用 requests 发送 SigV4 签名的请求，不需要 boto3
+- memory：进程内的假实现，除了不持久化外与 s3 行为相同（包括本地缓存），用于测试和基准测试
+- 数据库里只保存键（相对路径：ab/cd/{sha256}.jpg，旧照片为文件名），与存储位置无关
+- 远程存储的照片读取时先下载到本地缓存目录（read-through），识别和感知哈希读本地文件；
+  键对应的内容写入后不会变，缓存不需要失效，超过 CATHUB_BLOB_CACHE_MB 时删除最久未用的文件
+- /uploads/<键> 对 s3 返回 302 到预签名 URL（设置了 CATHUB_S3_PUBLIC_URL 时为公开 URL），照片流量不经过 worker
+"""
+import hashlib
+import hmac
+import mimetypes
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlsplit
+
+from werkzeug.security import safe_join
+
+from app_logging import get_logger
+from metrics import record_cache
+
+logger = get_logger('blob_storage')
+
+STORAGE = os.environ.get('CATHUB_STORAGE', 'local').lower()
+CACHE_MAX_BYTES = int(os.environ.get('CATHUB_BLOB_CACHE_MB', 512)) * 1024 * 1024
+
+S3_ENDPOINT = os.environ.get('CATHUB_S3_ENDPOINT', 'https://s3.amazonaws.com')
+S3_BUCKET = os.environ.get('CATHUB_S3_BUCKET', '')
+S3_REGION = os.environ.get('CATHUB_S3_REGION', 'us-east-1')
+S3_PREFIX = os.environ.get('CATHUB_S3_PREFIX', '')
+S3_ACCESS_KEY = os.environ.get('CATHUB_S3_ACCESS_KEY', os.environ.get('AWS_ACCESS_KEY_ID', ''))
+S3_SECRET_KEY = os.environ.get('CATHUB_S3_SECRET_KEY', os.environ.get('AWS_SECRET_ACCESS_KEY', ''))
+S3_TIMEOUT = float(os.environ.get('CATHUB_S3_TIMEOUT', 10))
+# 预签名 URL 的有效期（秒）
+PRESIGN_SECONDS = int(os.environ.get('CATHUB_S3_PRESIGN_SECONDS', 3600))
+# 桶（或前面的 CDN）可以公开读取时设置，/uploads 直接跳转到这里
+S3_PUBLIC_URL = os.environ.get('CATHUB_S3_PUBLIC_URL', '')
+# 设为 0 时 /uploads 不跳转，由 worker 从本地缓存发送（客户端访问不到桶时）
+S3_REDIRECT = os.environ.get('CATHUB_S3_REDIRECT', '1') != '0'
+
+_S3_NS = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+
+class StorageError(Exception):
+    """存储后端返回了意外的错误"""
+
+def check_key(key):
+    """键必须是不含 . / .. 的相对路径（URL 里传入的键），否则抛出 ValueError"""
+    parts = key.split('/') if key else []
+    if not parts or '\\' in key or any(part in ('', '.', '..') for part in parts):
+        raise ValueError(f'invalid storage key: {key!r}')
+    return key
+
+def content_type(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+def _atomic_write(path, data):
+    """先写临时文件再改名，读取方不会读到写了一半的文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class LocalStorage:
+    """本地目录：键就是相对路径"""
+
+    name = 'local'
+    is_local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def prepare(self):
+        """创建上传目录（应用启动时调用；写入时也会按需创建子目录）"""
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        path = safe_join(self.root, check_key(key))
+        if path is None:
+            raise ValueError(f'invalid storage key: {key!r}')
+        return path
+
+    def put(self, key, data):
+        _atomic_write(self.path(key), data)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def stat(self, key):
+        """返回 (大小, 修改时间)，不存在时返回 None"""
+        try:
+            st = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def touch(self, key):
+        """更新修改时间（垃圾回收按修改时间判断是否还在使用），不存在时返回 False"""
+        try:
+            os.utime(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def scan(self):
+        """遍历内容寻址的两级目录，产出 (键, 大小, 修改时间)，包括写入中断留下的临时文件"""
+        if not os.path.isdir(self.root):
+            return
+        for first in sorted(os.listdir(self.root)):
+            first_path = os.path.join(self.root, first)
+            if len(first) != 2 or not os.path.isdir(first_path):
+                continue
+            for second in sorted(os.listdir(first_path)):
+                second_path = os.path.join(first_path, second)
+                if len(second) != 2 or not os.path.isdir(second_path):
+                    continue
+                for name in os.listdir(second_path):
+                    try:
+                        st = os.stat(os.path.join(second_path, name))
+                    except FileNotFoundError:
+                        continue
+                    yield f'{first}/{second}/{name}', st.st_size, st.st_mtime
+
+    def local_path(self, key):
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def url(self, key):
+        """本地存储由 Flask 发送"""
+        return None
+
+class _CachedStorage:
+    """远程存储的公共部分：写入和读取都经过本地缓存目录"""
+
+    is_local = False
+
+    def __init__(self, cache_dir, cache_max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self._cache_lock = threading.Lock()
+        self._cached_bytes = None
+
+    def prepare(self):
+        """创建本地缓存目录（应用启动时调用）"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_path(self, key):
+        path = safe_join(self.cache_dir, check_key(key))
+        if path is None:
+            raise ValueError(f'invalid storage key: {key!r}')
+        return path
+
+    def put(self, key, data):
+        self._put(key, data)
+        # 刚上传的照片通常马上要读（识别、计算哈希），顺便写入缓存
+        self._cache_put(self._cache_path(key), data)
+
+    def delete(self, key):
+        try:
+            os.remove(self._cache_path(key))
+        except FileNotFoundError:
+            pass
+        return self._delete(key)
+
+    def local_path(self, key):
+        """本地缓存中的路径，没有缓存时先下载；对象不存在时返回 None"""
+        path = self._cache_path(key)
+        try:
+            os.utime(path)  # 淘汰按修改时间，最近用过的留下
+            record_cache('blob', True)
+            return path
+        except FileNotFoundError:
+            pass
+        record_cache('blob', False)
+        data = self.get(key)
+        if data is None:
+            return None
+        self._cache_put(path, data)
+        return path
+
+    def _cache_put(self, path, data):
+        _atomic_write(path, data)
+        with self._cache_lock:
+            if self._cached_bytes is None:
+                self._cached_bytes = sum(size for _, size, _ in self._cache_files())
+            else:
+                self._cached_bytes += len(data)
+            if self._cached_bytes > self.cache_max_bytes:
+                self._evict()
+
+    def _cache_files(self):
+        for dirpath, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        """删除最久未用的缓存文件，直到总大小降到上限的 80%（调用方持有 _cache_lock）"""
+        files = sorted(self._cache_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        target = self.cache_max_bytes * 0.8
+        removed = 0
+        for path, size, _ in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self._cached_bytes = total
+        logger.info("照片缓存淘汰", extra={'removed': removed, 'cached_mb': round(total / 1024 / 1024, 1)})
+
+class MemoryStorage(_CachedStorage):
+    """进程内的假存储：对象保存在字典里，读取同样经过本地缓存，用于测试"""
+
+    name = 'memory'
+
+    def __init__(self, cache_dir, cache_max_bytes=CACHE_MAX_BYTES):
+        super().__init__(cache_dir, cache_max_bytes)
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def _put(self, key, data):
+        with self._lock:
+            self._objects[check_key(key)] = (bytes(data), time.time())
+
+    def get(self, key):
+        with self._lock:
+            obj = self._objects.get(key)
+        return obj[0] if obj else None
+
+    def stat(self, key):
+        with self._lock:
+            obj = self._objects.get(key)
+        return (len(obj[0]), obj[1]) if obj else None
+
+    def touch(self, key):
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                return False
+            self._objects[key] = (obj[0], time.time())
+            return True
+
+    def _delete(self, key):
+        with self._lock:
+            return self._objects.pop(key, None) is not None
+
+    def scan(self):
+        with self._lock:
+            items = list(self._objects.items())
+        for key, (data, mtime) in sorted(items):
+            yield key, len(data), mtime
+
+    def url(self, key):
+        return None
+
+class S3Storage(_CachedStorage):
+    """S3 兼容的对象存储（路径风格：{endpoint}/{bucket}/{prefix}{键}，MinIO 默认也是这种）"""
+
+    name = 's3'
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, cache_dir, region='us-east-1', prefix='',
+                 public_url='', redirect=True, presign_seconds=PRESIGN_SECONDS, timeout=S3_TIMEOUT,
+                 cache_max_bytes=CACHE_MAX_BYTES):
+        super().__init__(cache_dir, cache_max_bytes)
+        parts = urlsplit(endpoint.rstrip('/'))
+        self.scheme, self.host, self.base_path = parts.scheme, parts.netloc, parts.path
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.public_url = public_url.rstrip('/')
+        self.redirect = redirect
+        self.presign_seconds = presign_seconds
+        self.timeout = timeout
+        self._local = threading.local()
+
+    # ---------- SigV4 签名 ----------
+    def _object_path(self, key=None):
+        path = f'{self.base_path}/{self.bucket}'
+        if key is not None:
+            path += '/' + quote(self.prefix + check_key(key), safe='/')
+        return path
+
+    def _signature(self, method, path, query, headers, payload_hash, amz_date):
+        """返回 (签名, 参与签名的头)；headers 的键为小写"""
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method,
+            path,
+            '&'.join(f"{quote(k, safe='')}={quote(v, safe='')}" for k, v in sorted(query.items())),
+            ''.join(f'{k}:{str(headers[k]).strip()}\n' for k in sorted(headers)),
+            signed_headers,
+            payload_hash,
+        ])
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()])
+        signing_key = ('AWS4' + self.secret_key).encode()
+        for part in (amz_date[:8], self.region, 's3', 'aws4_request'):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return signature, signed_headers, scope
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests  # 只有使用 s3 时才需要
+            session = self._local.session = requests.Session()
+        return session
+
+    def _request(self, method, key=None, query=None, headers=None, data=b''):
+        query = query or {}
+        amz_date = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        payload_hash = hashlib.sha256(data).hexdigest()
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        headers.update({'host': self.host, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+        path = self._object_path(key)
+        signature, signed_headers, scope = self._signature(method, path, query, headers, payload_hash, amz_date)
+        headers['authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={signed_headers}, Signature={signature}')
+        del headers['host']  # 由 requests 按 URL 填写，与签名时相同
+        url = f'{self.scheme}://{self.host}{path}'
+        response = self._session().request(method, url, params=query, headers=headers, data=data,
+                                           timeout=self.timeout)
+        if response.status_code >= 300 and response.status_code != 404:
+            raise StorageError(f'S3 {method} {key or ""} -> {response.status_code}: {response.text[:200]}')
+        return response
+
+    def presign(self, key, expires=None, now=None):
+        """GET 对象的预签名 URL
+
+        签名时间按有效期的一半取整：同一时间段内同一张照片的 URL 不变，浏览器和 CDN 可以缓存，
+        URL 至少还能用一半有效期。
+        """
+        expires = expires or self.presign_seconds
+        window = max(1, expires // 2)
+        now = int(now if now is not None else time.time())
+        signed_at = now - now % window
+        amz_date = datetime.fromtimestamp(signed_at, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        path = self._object_path(key)
+        query = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f'{self.access_key}/{amz_date[:8]}/{self.region}/s3/aws4_request',
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        signature, _, _ = self._signature('GET', path, query, {'host': self.host}, 'UNSIGNED-PAYLOAD', amz_date)
+        query['X-Amz-Signature'] = signature
+        qs = '&'.join(f"{quote(k, safe='')}={quote(v, safe='')}" for k, v in sorted(query.items()))
+        return f'{self.scheme}://{self.host}{path}?{qs}', signed_at + expires - now
+
+    # ---------- 对象操作 ----------
+    def _put(self, key, data):
+        self._request('PUT', key, headers={'Content-Type': content_type(key)}, data=data)
+
+    def get(self, key):
+        response = self._request('GET', key)
+        return None if response.status_code == 404 else response.content
+
+    def stat(self, key):
+        response = self._request('HEAD', key)
+        if response.status_code == 404:
+            return None
+        mtime = parsedate_to_datetime(response.headers['Last-Modified']).timestamp()
+        return int(response.headers.get('Content-Length', 0)), mtime
+
+    def touch(self, key):
+        """复制到自身（替换元数据）以更新 Last-Modified"""
+        response = self._request('PUT', key, headers={
+            'Content-Type': content_type(key),
+            'x-amz-copy-source': quote(f'/{self.bucket}/{self.prefix}{key}', safe='/'),
+            'x-amz-metadata-directive': 'REPLACE',
+        })
+        if response.status_code == 404:
+            return False
+        # CopyObject 失败时也可能返回 200，错误在响应体里
+        if b'<Error>' in response.content:
+            raise StorageError(f'S3 copy {key} failed: {response.text[:200]}')
+        return True
+
+    def _delete(self, key):
+        self._request('DELETE', key)
+        return True
+
+    def scan(self):
+        """ListObjectsV2 分页列出前缀下的全部对象"""
+        query = {'list-type': '2', 'prefix': self.prefix}
+        while True:
+            root = ET.fromstring(self._request('GET', query=query).content)
+            for item in root.iter(f'{_S3_NS}Contents'):
+                key = item.findtext(f'{_S3_NS}Key')[len(self.prefix):]
+                modified = datetime.fromisoformat(item.findtext(f'{_S3_NS}LastModified').replace('Z', '+00:00'))
+                yield key, int(item.findtext(f'{_S3_NS}Size')), modified.timestamp()
+            token = root.findtext(f'{_S3_NS}NextContinuationToken')
+            if root.findtext(f'{_S3_NS}IsTruncated') != 'true' or not token:
+                break
+            query = {**query, 'continuation-token': token}
+
+    def url(self, key):
+        """/uploads 跳转的目标：(URL, 有效秒数)，公开 URL 不会过期（None）；不跳转时返回 None"""
+        if not self.redirect:
+            return None
+        if self.public_url:
+            return f'{self.public_url}/{quote(self.prefix + check_key(key), safe="/")}', None
+        return self.presign(key)
+
+def create(kind, upload_folder, cache_dir):
+    """创建 kind（local / s3 / memory）存储后端，s3 的连接参数取自 CATHUB_S3_* 环境变量"""
+    if kind == 'local':
+        return LocalStorage(upload_folder)
+    if kind == 'memory':
+        return MemoryStorage(cache_dir)
+    if kind == 's3':
+        if not S3_BUCKET:
+            raise ValueError('CATHUB_STORAGE=s3 requires CATHUB_S3_BUCKET')
+        return S3Storage(S3_ENDPOINT, S3_BUCKET, S3_ACCESS_KEY, S3_SECRET_KEY, cache_dir, region=S3_REGION,
+                         prefix=S3_PREFIX, public_url=S3_PUBLIC_URL, redirect=S3_REDIRECT)
+    raise ValueError(f'unknown CATHUB_STORAGE: {kind}')
@@ -0,0 +1,94 @@
+"""
+JSON 响应压缩
+- 按 Accept-Encoding 协商 br（安装了 brotli 时）或 gzip，只压缩超过 MIN_BYTES 的 JSON 响应；
+  猫咪列表、事件列表里重复的字段名和上传 URL 压缩率很高
+- 压缩结果按 (编码, 响应体摘要) 放进本进程的 LRU 缓存：同一份热点响应（列表没有变化时）
+  只压缩一次，之后只需计算一次摘要（比压缩快一个数量级）
+- SSE、文件下载等流式响应和已经带 Content-Encoding 的响应不处理
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from metrics import record_cache
+
+try:
+    import brotli
+except ImportError:  # 可选依赖，没有安装时只使用 gzip
+    brotli = None
+
+COMPRESSION_ENABLED = os.environ.get('CATHUB_COMPRESSION', '1') != '0'
+MIN_BYTES = int(os.environ.get('CATHUB_COMPRESSION_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('CATHUB_GZIP_LEVEL', 6))
+# brotli 最高质量 11 对动态响应太慢，4-5 通常比 gzip 6 更小也更快
+BROTLI_QUALITY = int(os.environ.get('CATHUB_BROTLI_QUALITY', 4))
+CACHE_SIZE = int(os.environ.get('CATHUB_COMPRESSION_CACHE_SIZE', 64))
+# 超过这个大小的响应不放进缓存，避免少数大响应占满内存
+CACHE_MAX_BYTES = int(os.environ.get('CATHUB_COMPRESSION_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+
+COMPRESSIBLE_MIMETYPES = ('application/json',)
+
+def _gzip(data):
+    # mtime=0 让相同输入得到相同输出
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+def _brotli(data):
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+# 服务端偏好顺序，客户端 q 值相同时选前面的
+ENCODERS = OrderedDict()
+if brotli is not None:
+    ENCODERS['br'] = _brotli
+ENCODERS['gzip'] = _gzip
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def negotiate(accept_encodings):
+    """从 werkzeug 的 request.accept_encodings 中选出编码，不接受压缩时返回 None"""
+    best, best_quality = None, 0
+    for encoding in ENCODERS:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(data, encoding):
+    """压缩 data，相同内容命中缓存时直接返回之前的结果"""
+    if len(data) > CACHE_MAX_BYTES or CACHE_SIZE <= 0:
+        return ENCODERS[encoding](data)
+    key = (encoding, len(data), hashlib.sha256(data).digest())
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+    record_cache('compression', cached is not None)
+    if cached is not None:
+        return cached
+    compressed = ENCODERS[encoding](data)
+    with _cache_lock:
+        _cache[key] = compressed
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compressed
+
+def compress_response(response, accept_encodings):
+    """满足条件时就地压缩 Flask 响应"""
+    if (not COMPRESSION_ENABLED or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    # 是否压缩取决于请求头，缓存代理需要区分
+    response.vary.add('Accept-Encoding')
+    if response.status_code < 200 or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return response
+    encoding = negotiate(accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
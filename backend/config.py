@@ -0,0 +1,115 @@
+"""
+应用配置
+- Config 汇总一个应用实例的可调参数：数据库、照片存储、连接池和缓存大小、识别阈值、AI 服务商、并发限制和限流
+- Config.from_env() 按环境变量生成（与 .env.example 相同的 CATHUB_* / AI_PROVIDER），
+  部署时不需要改代码；server.create_app(config) 按它创建应用
+- 测试和基准测试可以用 replace() 改几个字段，在同一个进程里创建互相隔离的多个应用（各自的数据库、存储和缓存）
+- 日志、压缩、写后队列等进程级的设置仍由各模块的环境变量控制；指标快照目录随应用启动设置（每个进程一个）
+"""
+import dataclasses
+import os
+from dataclasses import dataclass
+
+import admission
+import blob_storage
+import db
+import event_feed
+import metrics
+import photo_serving
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+@dataclass(frozen=True)
+class Config:
+    # 数据库：database_url 为 postgresql://... 时使用 PostgreSQL，否则使用 database 指定的 SQLite 文件
+    database: str = db.DATABASE
+    database_url: str = ''
+    db_pool_size: int = db.POOL_SIZE
+    # 照片存储：local（upload_folder）、s3、memory；远程存储在 blob_cache_dir 里保留本地读缓存
+    storage: str = 'local'
+    upload_folder: str = os.path.join(BASE_DIR, 'uploads')
+    blob_cache_dir: str = os.path.join(BASE_DIR, 'blob_cache')
+    max_content_length: int = 16 * 1024 * 1024
+    # 感知哈希缓存（张）和猫咪列表响应缓存（份），0 关闭猫咪列表缓存
+    hash_cache_size: int = 4096
+    cats_cache_size: int = 16
+    # 猫咪列表不带 fields 参数时返回的字段；默认 all 兼容现有客户端，客户端都改为按需请求后可以改成 summary
+    cats_default_fields: str = 'all'
+    # 识别：相似度超过阈值（百分比）才算匹配；位置先验的半径，0 关闭先验
+    hash_match_threshold: float = 30.0
+    ai_match_threshold: float = 50.0
+    recognition_prior_radius_m: float = 500.0
+    # AI 服务商：gemini、qwen、ernie（或 ai_recognition.register_provider 注册的替身）；none 关闭 AI 识别，只用本地哈希匹配
+    ai_provider: str = 'gemini'
+    # 每个进程同时保持的 SSE 连接数（同步 worker 里每个连接占一个线程），超出时返回 503；0 不限制
+    sse_max_subscribers: int = event_feed.MAX_SUBSCRIBERS
+    # 每个进程同时发送照片的线程数（0 不限制），以及等待名额的最长秒数（超时返回 503）
+    photo_max_concurrent: int = photo_serving.MAX_CONCURRENT
+    photo_queue_seconds: float = photo_serving.QUEUE_TIMEOUT
+    # 准入控制（见 admission.py）：识别和上传的全局并发上限（0 不限制）、排队名额和等待秒数
+    recognize_max_concurrent: int = admission.RECOGNIZE_MAX_CONCURRENT
+    upload_max_concurrent: int = admission.UPLOAD_MAX_CONCURRENT
+    admission_queue_size: int = admission.QUEUE_SIZE
+    admission_queue_seconds: float = admission.QUEUE_TIMEOUT
+    # 每个 worker 进程同时处理（含排队）的识别和上传数，0 不限制
+    admission_worker_slots: int = admission.WORKER_SLOTS
+    # 每个客户端每分钟的识别 / 上传次数和允许的突发，速率为 0 时不限流
+    recognize_rate_per_minute: float = admission.RECOGNIZE_RATE_PER_MINUTE
+    recognize_burst: int = admission.RECOGNIZE_BURST
+    upload_rate_per_minute: float = admission.UPLOAD_RATE_PER_MINUTE
+    upload_burst: int = admission.UPLOAD_BURST
+    # 按客户端地址的令牌桶是单个客户端（设备）的几倍；设备标识只能让限制更紧
+    admission_ip_multiplier: int = admission.IP_MULTIPLIER
+    # 计数文件路径，memory 为进程内存；'' 按数据库在临时目录里生成
+    admission_db: str = admission.STORE
+    # 前面的反向代理层数，限流按 X-Forwarded-For 里最后一层代理看到的地址区分客户端；0 使用连接的地址
+    proxy_hops: int = 0
+    # 指标快照目录（同一部署的 worker 共享），'' 按数据库在临时目录里生成
+    metrics_dir: str = metrics.DIRECTORY
+
+    @classmethod
+    def from_env(cls):
+        """按环境变量生成配置，没有设置的使用默认值"""
+        return cls(
+            database=db.DATABASE,
+            database_url=db.DATABASE_URL,
+            db_pool_size=db.POOL_SIZE,
+            storage=blob_storage.STORAGE,
+            upload_folder=os.environ.get('CATHUB_UPLOAD_FOLDER', cls.upload_folder),
+            blob_cache_dir=os.environ.get('CATHUB_BLOB_CACHE_DIR', cls.blob_cache_dir),
+            max_content_length=_env_int('CATHUB_MAX_UPLOAD_MB', 16) * 1024 * 1024,
+            hash_cache_size=_env_int('CATHUB_HASH_CACHE_SIZE', cls.hash_cache_size),
+            cats_cache_size=_env_int('CATHUB_CATS_CACHE_SIZE', cls.cats_cache_size),
+            cats_default_fields=os.environ.get('CATHUB_CATS_DEFAULT_FIELDS', cls.cats_default_fields),
+            hash_match_threshold=_env_float('CATHUB_HASH_MATCH_THRESHOLD', cls.hash_match_threshold),
+            ai_match_threshold=_env_float('CATHUB_AI_MATCH_THRESHOLD', cls.ai_match_threshold),
+            recognition_prior_radius_m=_env_float('CATHUB_RECOGNITION_PRIOR_RADIUS_M',
+                                                  cls.recognition_prior_radius_m),
+            ai_provider=os.environ.get('AI_PROVIDER', cls.ai_provider).lower(),
+            sse_max_subscribers=event_feed.MAX_SUBSCRIBERS,
+            photo_max_concurrent=photo_serving.MAX_CONCURRENT,
+            photo_queue_seconds=photo_serving.QUEUE_TIMEOUT,
+            recognize_max_concurrent=admission.RECOGNIZE_MAX_CONCURRENT,
+            upload_max_concurrent=admission.UPLOAD_MAX_CONCURRENT,
+            admission_queue_size=admission.QUEUE_SIZE,
+            admission_queue_seconds=admission.QUEUE_TIMEOUT,
+            admission_worker_slots=admission.WORKER_SLOTS,
+            recognize_rate_per_minute=admission.RECOGNIZE_RATE_PER_MINUTE,
+            recognize_burst=admission.RECOGNIZE_BURST,
+            upload_rate_per_minute=admission.UPLOAD_RATE_PER_MINUTE,
+            upload_burst=admission.UPLOAD_BURST,
+            admission_ip_multiplier=admission.IP_MULTIPLIER,
+            admission_db=admission.STORE,
+            proxy_hops=_env_int('CATHUB_PROXY_HOPS', 0),
+            metrics_dir=metrics.DIRECTORY,
+        )
+
+    def replace(self, **changes):
+        """返回修改了部分字段的新配置"""
+        return dataclasses.replace(self, **changes)
@@ -0,0 +1,513 @@
+"""
+数据库访问层
+- 默认使用 SQLite（CATHUB_DATABASE 指定的文件）；设置 CATHUB_DATABASE_URL=postgresql://... 时使用 PostgreSQL，
+  多台机器上的实例共享同一个数据库（横向扩展，见 PERFORMANCE_OPTIMIZATION.md）
+- 两种后端的连接接口相同：execute / executemany / cursor / commit / rollback / close，
+  行可以按位置和列名访问（与 sqlite3.Row 相同）；SQL 统一使用 ? 占位符，PostgreSQL 下自动转换为 %s
+- 每条语句记录耗时指标和追踪 span
+- 方言差异集中在这里：写事务、插入后取 id、并发控制、表结构版本、初始化锁、触发器；
+  各模块里无法共用的 SQL（全文索引、JSON 函数等）按连接的 dialect 分支
+- PostgreSQL 连接按进程复用（close() 时回滚未提交的事务并放回连接池）；
+  psycopg 为可选依赖，只在使用 PostgreSQL 时导入
+- Database 表示一个数据库及其连接池，每个应用实例一个（见 server.create_app）；
+  模块级的 connect() 等函数使用按环境变量创建的 default
+"""
+import functools
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+
+from metrics import DB_QUERY_DURATION, sql_labels
+from tracing import span
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地开发
+    fcntl = None
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+DATABASE = os.environ.get('CATHUB_DATABASE', os.path.join(BASE_DIR, 'cathub.db'))
+DATABASE_URL = os.environ.get('CATHUB_DATABASE_URL', '')
+# 每个进程保留的空闲 PostgreSQL 连接数（并发超过时临时新建，用完关闭）
+POOL_SIZE = int(os.environ.get('CATHUB_DB_POOL_SIZE', 8))
+
+def advisory_key(name):
+    """PostgreSQL advisory lock 的键（由名字得到的固定整数）"""
+    return zlib.crc32(f'cathub:{name}'.encode())
+
+INIT_LOCK_KEY = advisory_key('init')
+
+# ==================== SQLite ====================
+
+class _TimedCursor(sqlite3.Cursor):
+    """记录每条语句耗时的游标"""
+
+    def execute(self, sql, parameters=()):
+        op, table = sql_labels(sql)
+        with DB_QUERY_DURATION.time(op=op, table=table), span(f'db.{op}', table=table):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        op, table = sql_labels(sql)
+        with DB_QUERY_DURATION.time(op=op, table=table), span(f'db.{op}', table=table):
+            return super().executemany(sql, seq_of_parameters)
+
+class _TimedConnection(sqlite3.Connection):
+    dialect = 'sqlite'
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# ==================== PostgreSQL ====================
+
+_psycopg = None
+
+def _import_psycopg():
+    global _psycopg
+    if _psycopg is None:
+        try:
+            import psycopg
+        except ImportError as e:
+            raise RuntimeError('CATHUB_DATABASE_URL 指向 PostgreSQL，需要安装 psycopg：'
+                               'pip install "psycopg[binary]"') from e
+        _psycopg = psycopg
+    return _psycopg
+
+class Row:
+    """可以按位置和列名访问的行（与 sqlite3.Row 相同的用法：row[0]、row['id']、dict(row)、解包）"""
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._index[key]]
+        return self._values[key]
+
+    def keys(self):
+        return list(self._index)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        return isinstance(other, Row) and self._index == other._index and self._values == other._values
+
+    def __repr__(self):
+        return f'Row({dict(zip(self._index, self._values))!r})'
+
+def _row_factory(cursor):
+    description = cursor.description
+    if description is None:
+        return tuple
+    index = {}
+    for i, column in enumerate(description):
+        # 与 sqlite3.Row 一致：重名的列取第一个
+        index.setdefault(column.name, i)
+    return lambda values: Row(index, values)
+
+_AUTOINCREMENT = re.compile(r'\bINTEGER PRIMARY KEY AUTOINCREMENT\b', re.I)
+_FOREIGN_KEY = re.compile(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)', re.I)
+
+def _postgres_ddl(sql):
+    """CREATE TABLE 语句的 SQLite 类型改为 PostgreSQL 类型
+
+    整数列一律为 BIGINT（毫秒时间戳超出 32 位），REAL 为双精度；
+    外键不建约束，与 SQLite（未开启 foreign_keys）的行为一致。
+    """
+    sql = _AUTOINCREMENT.sub('BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY', sql)
+    sql = _FOREIGN_KEY.sub('', sql)
+    sql = re.sub(r'\bINTEGER\b', 'BIGINT', sql, flags=re.I)
+    sql = re.sub(r'\bREAL\b', 'DOUBLE PRECISION', sql, flags=re.I)
+    return re.sub(r'\)\s*WITHOUT ROWID\s*$', ')', sql, flags=re.I)
+
+@functools.lru_cache(maxsize=2048)
+def _postgres_sql(sql):
+    """? 占位符转换为 %s，% 转义为 %%；字符串、带引号的标识符和 $$ 函数体里的 ? 不转换"""
+    if sql.lstrip()[:12].upper() == 'CREATE TABLE':
+        sql = _postgres_ddl(sql)
+    out = []
+    i, n = 0, len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch in ("'", '"'):
+            end = i + 1
+            while end < n:
+                if sql[end] == ch:
+                    if end + 1 < n and sql[end + 1] == ch:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            out.append(sql[i:end + 1].replace('%', '%%'))
+            i = end + 1
+        elif ch == '$':
+            match = re.match(r'\$\w*\$', sql[i:])
+            if match:
+                tag = match.group(0)
+                end = sql.find(tag, i + len(tag))
+                end = n if end < 0 else end + len(tag)
+                out.append(sql[i:end].replace('%', '%%'))
+                i = end
+            else:
+                out.append(ch)
+                i += 1
+        elif ch == '?':
+            out.append('%s')
+            i += 1
+        elif ch == '%':
+            out.append('%%')
+            i += 1
+        else:
+            out.append(ch)
+            i += 1
+    return ''.join(out)
+
+class _PostgresCursor:
+    """记录每条语句耗时的游标，接口与 sqlite3.Cursor 相同"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, parameters=()):
+        op, table = sql_labels(sql)
+        with DB_QUERY_DURATION.time(op=op, table=table), span(f'db.{op}', table=table):
+            self._cursor.execute(_postgres_sql(sql), parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters, returning=False):
+        op, table = sql_labels(sql)
+        with DB_QUERY_DURATION.time(op=op, table=table), span(f'db.{op}', table=table):
+            self._cursor.executemany(_postgres_sql(sql), seq_of_parameters, returning=returning)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def nextset(self):
+        return self._cursor.nextset()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+class _PostgresConnection:
+    dialect = 'postgres'
+
+    def __init__(self, raw, pool):
+        self.raw = raw
+        self._pool = pool
+
+    def cursor(self):
+        return _PostgresCursor(self.raw.cursor())
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        """回滚未提交的事务并放回连接池（不在连接池里的连接直接关闭）"""
+        raw, self.raw = self.raw, None
+        if raw is None:
+            return
+        if self._pool is None:
+            raw.close()
+        else:
+            self._pool.release(raw)
+
+class _Pool:
+    """每个进程的空闲连接列表
+
+    fork 出的子进程（gunicorn worker）不使用父进程的连接：只丢弃引用、不关闭，
+    关闭会在共享的套接字上发送断开消息，影响父进程。
+    """
+
+    def __init__(self, url, size):
+        self._url = url
+        self._size = size
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self._inherited = []
+
+    def _connect(self):
+        psycopg = _import_psycopg()
+        return psycopg.connect(self._url, row_factory=_row_factory)
+
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._inherited.extend(self._idle)
+                self._idle = []
+                self._pid = os.getpid()
+            while self._idle:
+                raw = self._idle.pop()
+                if not raw.closed and not raw.broken:
+                    return raw
+        return self._connect()
+
+    def release(self, raw):
+        psycopg = _import_psycopg()
+        if raw.closed or raw.broken:
+            return
+        try:
+            if raw.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+                raw.rollback()
+        except psycopg.Error:
+            raw.close()
+            return
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self._size:
+                self._idle.append(raw)
+                return
+        raw.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for raw in idle:
+            raw.close()
+
+# ==================== 通用接口 ====================
+
+class Database:
+    """一个数据库：SQLite 文件（path），或 url 为 postgresql://... 时的 PostgreSQL 及其连接池"""
+
+    def __init__(self, path=DATABASE, url='', pool_size=POOL_SIZE):
+        self.path = path
+        self.url = url
+        self.pool_size = pool_size
+        self.dialect = 'postgres' if url.startswith(('postgres://', 'postgresql://')) else 'sqlite'
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def describe(self):
+        """日志里显示的数据库（不含密码）"""
+        if self.dialect == 'postgres':
+            return re.sub(r'//([^:@/]+):[^@/]*@', r'//\1:***@', self.url)
+        return self.path
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = _Pool(self.url, self.pool_size)
+        return self._pool
+
+    def close_pool(self):
+        """关闭本进程的空闲连接（应用退出时调用）"""
+        if self._pool is not None:
+            self._pool.clear()
+
+    def connect(self, pooled=True):
+        """打开一个连接；用完调用 close()（PostgreSQL 下放回连接池）"""
+        if self.dialect == 'postgres':
+            if pooled:
+                pool = self._get_pool()
+                return _PostgresConnection(pool.acquire(), pool)
+            psycopg = _import_psycopg()
+            return _PostgresConnection(psycopg.connect(self.url, row_factory=_row_factory), None)
+        conn = sqlite3.connect(self.path, factory=_TimedConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def init_lock(self):
+        """跨进程（PostgreSQL 下跨机器）的初始化锁，防止多个 worker 同时执行迁移"""
+        if self.dialect == 'postgres':
+            conn = self.connect(pooled=False)
+            try:
+                conn.execute('SELECT pg_advisory_lock(?)', (INIT_LOCK_KEY,))
+                conn.commit()
+                yield
+            finally:
+                conn.close()  # 断开连接时释放锁
+            return
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.init.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# 按环境变量创建的数据库，模块级函数和没有传入 Database 的调用方使用
+default = Database(DATABASE, DATABASE_URL, POOL_SIZE)
+
+def describe():
+    return default.describe()
+
+def close_pool():
+    default.close_pool()
+
+def connect(pooled=True):
+    return default.connect(pooled)
+
+def init_lock():
+    return default.init_lock()
+
+def begin_write(conn):
+    """开始写事务
+
+    SQLite 一开始就拿写锁（BEGIN IMMEDIATE），避免先读后写时两个连接互相等待对方释放共享锁；
+    PostgreSQL 在第一条语句时隐式开始事务，写入按行加锁。
+    """
+    if conn.dialect == 'sqlite':
+        conn.execute('BEGIN IMMEDIATE')
+
+def insert(conn, sql, parameters=()):
+    """执行一条 INSERT，返回新行的 id"""
+    if conn.dialect == 'postgres':
+        return conn.execute(sql + ' RETURNING id', parameters).fetchone()[0]
+    return conn.execute(sql, parameters).lastrowid
+
+def insert_many(conn, sql, seq_of_parameters):
+    """批量执行 INSERT，按参数顺序返回新行的 id（调用方在写事务里）"""
+    rows = list(seq_of_parameters)
+    if not rows:
+        return []
+    if conn.dialect == 'postgres':
+        cursor = conn.cursor().executemany(sql + ' RETURNING id', rows, returning=True)
+        ids = []
+        while True:
+            ids.append(cursor.fetchone()[0])
+            if not cursor.nextset():
+                return ids
+    conn.executemany(sql, rows)
+    # 持有写锁时一条 executemany 插入的 AUTOINCREMENT id 是连续的
+    last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+def lock_names(conn, names):
+    """在当前写事务里对这些名字加互斥锁，直到事务结束
+
+    用于先查后写（如幂等键）：SQLite 的写事务本来就是串行的，不需要处理；
+    PostgreSQL 按固定顺序拿 advisory lock，并发的事务处理同一个名字时后者等前者提交。
+    """
+    if conn.dialect != 'postgres' or not names:
+        return
+    keys = sorted({advisory_key(name) for name in names})
+    conn.execute('SELECT pg_advisory_xact_lock(k) FROM unnest(?::bigint[]) AS k', (keys,))
+
+def table_exists(conn, name):
+    if conn.dialect == 'postgres':
+        return conn.execute('SELECT to_regclass(?) IS NOT NULL', (name,)).fetchone()[0]
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (name,)).fetchone() is not None
+
+def create_functions(conn):
+    """PostgreSQL 上各模块共用的 SQL 函数（数据库迁移时调用）
+
+    cathub_json_array(text)：把 TEXT 列里的 JSON 数组解析为 jsonb，不是合法 JSON 数组时返回空数组，
+    对应 SQLite 的 CASE WHEN json_valid(...) 写法。
+    """
+    if conn.dialect != 'postgres':
+        return
+    conn.execute('''CREATE OR REPLACE FUNCTION cathub_json_array(value TEXT) RETURNS jsonb
+        LANGUAGE plpgsql IMMUTABLE AS $fn$
+        BEGIN
+        RETURN CASE WHEN jsonb_typeof(value::jsonb) = 'array' THEN value::jsonb ELSE '[]'::jsonb END;
+        EXCEPTION WHEN others THEN
+        RETURN '[]'::jsonb;
+        END $fn$''')
+
+def order_ids_by_commit(conn, table):
+    """让 table 的自增 id 按事务提交的顺序递增（按 id 增量读取新行的表，如事件）
+
+    SQLite 同一时间只有一个写事务，本来就是这样。PostgreSQL 的写事务是并发的，先分配的 id 可能后提交，
+    读者读到大 id 之后小 id 才出现，就会漏掉；插入前拿 advisory lock 直到事务结束，
+    插入这张表的事务逐个分配 id 并提交。应在事务的最后插入这张表，缩短持锁时间。
+    """
+    if conn.dialect != 'postgres':
+        return
+    name = f'{table}_commit_order'
+    conn.execute(f'''CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $fn$
+        BEGIN
+        PERFORM pg_advisory_xact_lock({advisory_key(name)});
+        RETURN NULL;
+        END $fn$''')
+    conn.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+    conn.execute(f'CREATE TRIGGER {name} BEFORE INSERT ON {table} FOR EACH STATEMENT EXECUTE FUNCTION {name}()')
+
+def is_transient(error):
+    """锁等待超时、死锁、连接中断等重试可能成功的错误"""
+    if isinstance(error, sqlite3.OperationalError):
+        return True
+    return _psycopg is not None and isinstance(error, _psycopg.OperationalError)
+
+def schema_version(conn):
+    """数据库记录的表结构版本，新数据库为 0"""
+    if conn.dialect == 'postgres':
+        if not table_exists(conn, 'cathub_schema'):
+            return 0
+        row = conn.execute('SELECT MAX(version) FROM cathub_schema').fetchone()
+        return row[0] or 0
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def set_schema_version(conn, version):
+    if conn.dialect == 'postgres':
+        conn.execute('CREATE TABLE IF NOT EXISTS cathub_schema (version BIGINT NOT NULL)')
+        conn.execute('DELETE FROM cathub_schema')
+        conn.execute('INSERT INTO cathub_schema (version) VALUES (?)', (version,))
+    else:
+        conn.execute(f'PRAGMA user_version = {int(version)}')
+
+def create_trigger(conn, name, event, table, body, when=None):
+    """创建（或替换）行级触发器
+
+    event 如 'AFTER INSERT'、'AFTER UPDATE OF a, b'；body 是以分号结尾的若干条语句，
+    用 new / old 引用行。PostgreSQL 下包装为同名的 plpgsql 函数。
+    """
+    if conn.dialect == 'postgres':
+        conn.execute(f'''CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $fn$
+            BEGIN
+            {body}
+            RETURN NULL;
+            END $fn$''')
+        conn.execute(f'DROP TRIGGER IF EXISTS {name} ON {table}')
+        condition = f' WHEN ({when})' if when else ''
+        conn.execute(f'CREATE TRIGGER {name} {event} ON {table} FOR EACH ROW{condition} EXECUTE FUNCTION {name}()')
+        return
+    conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    condition = f' WHEN {when}' if when else ''
+    conn.execute(f'CREATE TRIGGER {name} {event} ON {table}{condition} BEGIN\n{body}\nEND')
@@ -0,0 +1,145 @@
+"""
+实时事件推送（SSE）
+- 每个进程只有一个轮询线程，每 POLL_INTERVAL 秒查询一次 id 大于上次最大 id 的事件
+  （主键范围查询，没有新事件时几乎没有开销），新事件放进内存环形缓冲区后唤醒所有订阅者
+- 多个 gunicorn worker 各自轮询同一个 SQLite 文件，任何 worker 写入的事件都能推送到所有连接
+- 订阅者只是在条件变量上等待，不各自查询数据库；没有订阅者时轮询线程也停下来
+- 客户端断线重连时带上 Last-Event-ID，从上次收到的事件继续；落后太多（超出缓冲区）时回退到数据库查询
+- 同步 worker 里每个 SSE 连接占一个线程，max_subscribers 限制每个进程的订阅数，超出时由调用方返回 503；
+  ASGI 入口用 wait_for_async 在事件循环里等待，不占线程
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+from app_logging import get_logger
+
+logger = get_logger('event_feed')
+
+POLL_INTERVAL_SECONDS = float(os.environ.get('CATHUB_EVENTS_POLL_SECONDS', 1.0))
+BUFFER_SIZE = int(os.environ.get('CATHUB_EVENTS_BUFFER_SIZE', 1000))
+# 每个 worker 进程同时保持的 SSE 连接数，默认最多占 gthread 一半的线程；0 不限制
+MAX_SUBSCRIBERS = int(os.environ.get('CATHUB_SSE_MAX_SUBSCRIBERS',
+                                     max(1, int(os.environ.get('GUNICORN_THREADS', 2)) // 2)))
+
+class EventFeed:
+    """fetch_since(last_id, limit) 返回 id 大于 last_id 的事件（按 id 升序），latest_id() 返回当前最大 id"""
+
+    def __init__(self, fetch_since, latest_id, poll_interval=POLL_INTERVAL_SECONDS, buffer_size=BUFFER_SIZE,
+                 max_subscribers=0):
+        self._fetch_since = fetch_since
+        self._latest_id = latest_id
+        self._poll_interval = poll_interval
+        self._buffer_size = buffer_size
+        self._max_subscribers = max_subscribers
+        self._cond = threading.Condition()
+        self._pid = None
+        self._buffer = deque(maxlen=buffer_size)
+        self._last_id = 0
+        self._subscribers = 0
+        # 在事件循环里等待的订阅者：(loop, asyncio.Event)，有新事件时逐个唤醒
+        self._async_waiters = set()
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._cond:
+            if self._pid == pid:
+                return
+            self._buffer = deque(maxlen=self._buffer_size)
+            self._last_id = self._latest_id() or 0
+            self._subscribers = 0
+            self._async_waiters = set()
+            threading.Thread(target=self._poll_loop, name='event-feed', daemon=True).start()
+            self._pid = pid
+
+    def latest_id(self):
+        self._ensure_started()
+        with self._cond:
+            return self._last_id
+
+    def subscribe(self):
+        """登记一个订阅者；本进程的订阅数已达 max_subscribers 时返回 False"""
+        self._ensure_started()
+        with self._cond:
+            if self._max_subscribers and self._subscribers >= self._max_subscribers:
+                return False
+            self._subscribers += 1
+            self._cond.notify_all()
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def wait_for(self, after_id, timeout):
+        """等待 id 大于 after_id 的事件，最多 timeout 秒
+
+        返回事件列表（可能为空）；after_id 早于缓冲区能覆盖的范围时返回 None，调用方应直接查数据库。
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._last_id > after_id:
+                    return self._since(after_id)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+
+    async def wait_for_async(self, after_id, timeout):
+        """wait_for 的协程版本：在事件循环里等待，轮询线程取到新事件时唤醒"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._cond:
+                if self._last_id > after_id:
+                    return self._since(after_id)
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return []
+                waiter = (loop, asyncio.Event())
+                self._async_waiters.add(waiter)
+            try:
+                await asyncio.wait_for(waiter[1].wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    self._async_waiters.discard(waiter)
+
+    def _since(self, after_id):
+        # 调用方持有锁；after_id 早于缓冲区能覆盖的范围时返回 None
+        if not self._buffer or after_id < self._buffer[0]['id'] - 1:
+            return None
+        return [e for e in self._buffer if e['id'] > after_id]
+
+    def _poll_loop(self):
+        while True:
+            with self._cond:
+                while self._subscribers <= 0:
+                    self._cond.wait()
+                last_id = self._last_id
+            try:
+                events = self._fetch_since(last_id, self._buffer_size)
+            except Exception as e:
+                logger.warning("轮询新事件失败: %s", e)
+                events = []
+            if events:
+                with self._cond:
+                    self._buffer.extend(events)
+                    self._last_id = events[-1]['id']
+                    self._cond.notify_all()
+                    for loop, woken in list(self._async_waiters):
+                        try:
+                            loop.call_soon_threadsafe(woken.set)
+                        except RuntimeError:
+                            # 事件循环已经关闭
+                            self._async_waiters.discard((loop, woken))
+                # 一次没取完时立即继续取
+                if len(events) >= self._buffer_size:
+                    continue
+            time.sleep(self._poll_interval)
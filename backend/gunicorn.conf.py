@@ -0,0 +1,36 @@
+"""
+Gunicorn 配置
+- preload_app：主进程只导入一次应用，worker fork 后共享已加载的代码
+- on_starting：在主进程中执行一次数据库初始化/迁移，worker 不再重复执行
+
+AI SDK 在第一次识别请求时才在各 worker 内导入（见 ai_recognition.init_ai_client），
+所以预加载时主进程不会创建任何网络客户端或数据库连接，fork 是安全的。
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+timeout = 120
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 2))
+# SSE 长连接（/api/events/stream）在 gthread worker 下每个占一个线程，每个 worker 的连接数受
+# CATHUB_SSE_MAX_SUBSCRIBERS 限制（超出返回 503）；需要支撑大量空闲连接时使用 ASGI 入口（asgi.py）
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+preload_app = True
+
+def on_starting(server):
+    from server import app, startup
+    startup(app)
+
+def worker_exit(server, worker):
+    # 先刷完写后队列里的 last_seen 更新和事件，再写最后一次指标快照并入累计值，
+    # 已退出 worker 的计数仍计入 /metrics
+    import metrics
+    from server import app, shutdown
+    shutdown(app)
+    metrics.flush()
+    metrics.retire()
+
+def child_exit(server, worker):
+    # 主进程中执行：超时被杀、崩溃的 worker 没有执行 worker_exit，在这里把它的快照并入累计值
+    import metrics
+    metrics.retire(worker.pid)
@@ -0,0 +1,388 @@
+"""
+Prometheus 风格的指标收集
+- Counter / Histogram，支持标签
+- 多进程：每个 gunicorn worker 定期把自己的指标快照写到 METRICS_DIR/metrics_<pid>.json，
+  /metrics 读取所有快照合并后输出，所以无论请求落到哪个 worker，看到的都是全局数据
+- 快照目录按部署区分（默认由数据库路径或 URL 生成，见 default_dir），同一台机器上的多个部署互不混合
+- 进程退出（worker 回收、超时被杀、崩溃）后计数不能减少，否则 Prometheus 会当作计数器重置，
+  rate() / increase() 把剩下的总数再算一遍增量。与 prometheus_client 的多进程模式一样，
+  已退出进程的快照并入累计文件 metrics_exited.json 后再删除，/metrics 输出累计值加上各个快照
+- 只依赖标准库
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from app_logging import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地开发
+    fcntl = None
+
+logger = get_logger('metrics')
+
+# 快照目录：CATHUB_METRICS_DIR 未设置时由应用启动时按数据库调用 configure 设置
+DIRECTORY = os.environ.get('CATHUB_METRICS_DIR', '')
+METRICS_DIR = DIRECTORY or os.path.join(tempfile.gettempdir(), 'cathub_metrics')
+FLUSH_INTERVAL_SECONDS = float(os.environ.get('CATHUB_METRICS_FLUSH_SECONDS', 2))
+
+# 延迟直方图默认桶（秒），覆盖从 SQLite 查询到远程 AI 调用
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_metrics = {}
+_dirty = False
+_flusher_pid = None
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        global _dirty
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            _dirty = True
+
+    def _dump(self):
+        return [[list(k), v] for k, v in self._values.items()]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        global _dirty
+        key = self._key(labels)
+        with _lock:
+            _dirty = True
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _dump(self):
+        return [[list(k), [list(v[0]), v[1], v[2]]] for k, v in self._values.items()]
+
+def _register(metric):
+    with _lock:
+        existing = _metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        _metrics[metric.name] = metric
+        return metric
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter(name, documentation, labelnames))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+# ==================== 应用使用的指标 ====================
+HTTP_REQUEST_DURATION = histogram(
+    'cathub_http_request_duration_seconds', 'HTTP 请求耗时', ('route', 'method', 'status'))
+DB_QUERY_DURATION = histogram(
+    'cathub_db_query_duration_seconds', 'SQLite 语句耗时', ('op', 'table'))
+IMAGE_STAGE_DURATION = histogram(
+    'cathub_image_stage_duration_seconds', '图片处理各阶段耗时', ('stage',))
+AI_CALL_DURATION = histogram(
+    'cathub_ai_call_duration_seconds', 'AI 服务商单次调用耗时', ('provider', 'outcome'))
+AI_RETRIES = counter('cathub_ai_retries_total', 'AI 调用重试次数', ('provider',))
+AI_ERRORS = counter('cathub_ai_errors_total', 'AI 调用失败次数', ('provider',))
+AI_CIRCUIT_REJECTIONS = counter(
+    'cathub_ai_circuit_rejections_total', '熔断器拒绝的 AI 调用次数', ('provider',))
+CACHE_REQUESTS = counter('cathub_cache_requests_total', '缓存查询次数', ('cache', 'result'))
+WRITE_BEHIND_WRITES = counter(
+    'cathub_write_behind_writes_total', '写后队列处理的行数', ('kind', 'outcome'))
+WRITE_BEHIND_FALLBACKS = counter('cathub_write_behind_fallbacks_total', '写后队列已满、改为同步写入的次数')
+WRITE_BEHIND_FLUSH_DURATION = histogram(
+    'cathub_write_behind_flush_duration_seconds', '写后队列每批事务耗时')
+ADMISSION_REJECTIONS = counter(
+    'cathub_admission_rejections_total', '准入控制拒绝的请求数（rate_limited 为 429，busy 为 503）', ('kind', 'reason'))
+ADMISSION_WAIT = histogram(
+    'cathub_admission_wait_seconds', '昂贵请求排队等待并发名额的时间', ('kind', 'outcome'))
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+def sql_labels(sql):
+    """从 SQL 语句中提取 (操作, 表名) 作为标签"""
+    stripped = sql.lstrip()
+    op = stripped.split(None, 1)[0].lower() if stripped else 'other'
+    match = _SQL_TABLE.search(sql)
+    return op, match.group(1) if match else ''
+
+# ==================== 多进程快照 ====================
+def default_dir(database):
+    """按数据库（SQLite 路径或 PostgreSQL URL）在临时目录里生成快照目录"""
+    digest = hashlib.sha1(database.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'cathub_metrics_{digest}')
+
+def configure(directory):
+    """设置本进程写入和读取快照的目录（应用启动时调用，fork 出的 worker 继承）"""
+    global METRICS_DIR
+    METRICS_DIR = directory
+
+def _alive(pid):
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _snapshot_pids():
+    """快照目录里的 (pid, 文件名)"""
+    if not os.path.isdir(METRICS_DIR):
+        return []
+    pids = []
+    for name in os.listdir(METRICS_DIR):
+        if name.startswith('metrics_') and name.endswith('.json'):
+            try:
+                pids.append((int(name[len('metrics_'):-len('.json')]), name))
+            except ValueError:
+                continue
+    return pids
+
+def _snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, f'metrics_{pid or os.getpid()}.json')
+
+# 已退出进程的累计值：{'folded': {进程标识: 快照文件名}, 'metrics': 与快照相同的格式}
+EXITED_FILE = 'metrics_exited.json'
+# 快照里的进程标识（pid 会被复用，标识不会），读者据此跳过已经并入累计值的快照
+_PROCESS_KEY = '_process'
+_process = {'pid': None, 'token': None, 'retired': False}
+
+def _process_token():
+    pid = os.getpid()
+    if _process['pid'] != pid:
+        _process.update(pid=pid, token=f'{pid}-{uuid.uuid4().hex}', retired=False)
+    return _process['token']
+
+def flush():
+    """把本进程的指标写入快照文件（原子替换）；retire 之后不再写入"""
+    global _dirty
+    token = _process_token()
+    if _process['retired']:
+        return
+    with _lock:
+        data = {name: m._dump() for name, m in _metrics.items()}
+        _dirty = False
+    data[_PROCESS_KEY] = token
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _write_json(_snapshot_path(), data)
+    except OSError as e:
+        logger.warning("写入指标快照失败: %s", e)
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL_SECONDS)
+        if _dirty:
+            flush()
+
+def start_flusher():
+    """确保本进程有一个后台线程每 FLUSH_INTERVAL_SECONDS 秒写一次快照
+
+    在请求中调用即可；按 pid 判断，gunicorn fork 出的 worker 会各自启动自己的线程。
+    """
+    global _flusher_pid
+    pid = os.getpid()
+    if _flusher_pid == pid:
+        return
+    with _lock:
+        if _flusher_pid == pid:
+            return
+        _flusher_pid = pid
+    threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+
+@contextmanager
+def _exited_lock():
+    """合并累计文件时的跨进程锁（worker 退出和启动清理可能同时进行）"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, EXITED_FILE + '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _merge(target, data):
+    """把快照格式的 data（{指标: [[标签, 值], ...]}）累加到 target（{指标: {标签: 值}}）"""
+    for metric_name, series in data.items():
+        if metric_name == _PROCESS_KEY:
+            continue
+        merged = target.setdefault(metric_name, {})
+        for labels, value in series:
+            key = tuple(labels)
+            entry = merged.get(key)
+            if not isinstance(value, list):
+                merged[key] = (entry or 0) + value
+            elif entry is None:
+                merged[key] = [list(value[0]), value[1], value[2]]
+            else:
+                entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+                entry[1] += value[1]
+                entry[2] += value[2]
+
+def _fold(names):
+    """把这些快照并入已退出进程的累计值，再删除快照文件
+
+    先原子地写入累计文件（记下并入的进程标识），再删除快照：读者先读快照、后读累计文件，
+    两者之间的任何时刻都不会少算或多算。
+    """
+    with _exited_lock():
+        exited_path = os.path.join(METRICS_DIR, EXITED_FILE)
+        exited = _read_json(exited_path) or {}
+        merged = {}
+        _merge(merged, exited.get('metrics', {}))
+        # 快照已经删除的标识不会再出现，不再保留
+        folded = {token: name for token, name in exited.get('folded', {}).items()
+                  if os.path.exists(os.path.join(METRICS_DIR, name))}
+        done = []
+        for name in names:
+            data = _read_json(os.path.join(METRICS_DIR, name))
+            if data is None:
+                continue
+            token = data.get(_PROCESS_KEY)
+            if token not in folded:
+                _merge(merged, data)
+                folded[token] = name
+            done.append(name)
+        if not done:
+            return
+        _write_json(exited_path, {
+            'folded': folded,
+            'metrics': {metric_name: [[list(k), v] for k, v in series.items()]
+                        for metric_name, series in merged.items()}
+        })
+        for name in done:
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except OSError:
+                pass
+
+def retire(pid=None):
+    """进程退出时把它的快照并入累计值
+
+    不传 pid 时为本进程（gunicorn worker_exit、ASGI lifespan 关闭时在 flush 之后调用），之后不再写快照；
+    主进程的 child_exit 传入退出的 worker 的 pid，覆盖超时被杀、崩溃等没有执行 worker_exit 的情况。
+    """
+    if pid is None:
+        _process_token()
+        pid = os.getpid()
+        _process['retired'] = True
+    try:
+        _fold([name for p, name in _snapshot_pids() if p == pid])
+    except OSError as e:
+        logger.warning("合并已退出进程的指标失败: %s", e)
+
+def collect_exited():
+    """把已退出进程留下的快照并入累计值（server.startup 和 ASGI worker 启动时调用，不影响正在运行的 worker）"""
+    try:
+        _fold([name for pid, name in _snapshot_pids() if not _alive(pid)])
+    except OSError as e:
+        logger.warning("合并已退出进程的指标失败: %s", e)
+
+def _load_snapshots():
+    # 先读快照再读累计文件：快照在并入累计值之后才删除，读到的快照已经并入时按标识跳过
+    snapshots = [_read_json(os.path.join(METRICS_DIR, name)) for _, name in _snapshot_pids()]
+    exited = _read_json(os.path.join(METRICS_DIR, EXITED_FILE)) or {}
+    folded = exited.get('folded', {})
+    merged = {}
+    _merge(merged, exited.get('metrics', {}))
+    for data in snapshots:
+        # 还没有并入的已退出进程（例如被 SIGKILL 的 worker）照常计入，计数不会减少
+        if data is not None and data.get(_PROCESS_KEY) not in folded:
+            _merge(merged, data)
+    return merged
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in pairs) + '}'
+
+def render_latest():
+    """合并所有进程的快照，输出 Prometheus 文本格式"""
+    flush()
+    merged = _load_snapshots()
+    lines = []
+    for name, metric in sorted(_metrics.items()):
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for key, value in sorted(merged.get(name, {}).items()):
+            if metric.kind == 'counter':
+                lines.append(f'{name}{_format_labels(metric.labelnames, key)} {value}')
+                continue
+            counts, total, total_sum = value
+            cumulative = 0
+            for bound, count in zip(metric.buckets, counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(metric.labelnames, key, ("le", repr(bound)))} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(metric.labelnames, key, ("le", "+Inf"))} {total}')
+            lines.append(f'{name}_sum{_format_labels(metric.labelnames, key)} {total_sum}')
+            lines.append(f'{name}_count{_format_labels(metric.labelnames, key)} {total}')
+    return '\n'.join(lines) + '\n'
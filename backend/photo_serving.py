@@ -0,0 +1,212 @@
+"""
+照片下载
+- 按内容寻址的照片（ab/cd/{sha256}.jpg，见 photo_store.py）和带内容哈希的文件名
+  （{毫秒时间戳}_{sha256 前 16 位}.jpg）内容不会再变，以 Cache-Control: immutable 缓存一年，客户端和 CDN 不再回源
+- 强 ETag 使用内容哈希：直接取自路径，旧文件读一次文件计算并按 (大小, 修改时间) 缓存；
+  支持 If-None-Match（304）和 Range（206）
+- 由 werkzeug send_file 发送，gunicorn 通过 wsgi.file_wrapper 使用 sendfile 零拷贝
+- 远程存储（s3）默认返回 302 到预签名 URL 或公开 URL，由对象存储 / CDN 发送；
+  关闭跳转时从本地缓存发送（见 blob_storage.py）
+- 前面有 Nginx / Apache 时可以设置 CATHUB_PHOTO_OFFLOAD，只返回 X-Accel-Redirect / X-Sendfile 头，
+  由代理发送文件，worker 线程立即释放
+- 每个 worker 同时发送照片的线程数有上限（默认线程数减一，至少 1），慢速客户端下载大图时
+  仍有线程处理 API 请求；等待超时返回 503 + Retry-After。交给代理发送时文件不占线程，默认不限制
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import Response, redirect, request, send_file
+from werkzeug.exceptions import NotFound, RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified
+
+from app_logging import get_logger
+from metrics import record_cache
+import photo_store
+
+logger = get_logger('photo_serving')
+
+# 带内容哈希的文件名：{毫秒时间戳}_{sha256 前 16 位}.{扩展名}
+CONTENT_HASH_LENGTH = 16
+_CONTENT_NAME = re.compile(r'^\d+_([0-9a-f]{%d})\.[a-z0-9]+$' % CONTENT_HASH_LENGTH)
+
+IMMUTABLE_MAX_AGE = 365 * 86400
+# 旧文件名（不带内容哈希）仍可能被覆盖，短期缓存并用 ETag 重新验证
+MUTABLE_MAX_AGE = int(os.environ.get('CATHUB_PHOTO_MAX_AGE', 3600))
+# '' 由 Flask 发送；x-accel-redirect（Nginx）或 x-sendfile（Apache / lighttpd）交给代理发送
+OFFLOAD = os.environ.get('CATHUB_PHOTO_OFFLOAD', '').lower()
+# X-Accel-Redirect 的内部 location 前缀，需要在 Nginx 中配置为 internal 并指向上传目录
+ACCEL_PREFIX = os.environ.get('CATHUB_PHOTO_ACCEL_PREFIX', '/_protected_uploads/')
+# 0 不限制；默认比线程数少一个，API 始终有线程可用。
+# 由代理发送时只有远程存储的本地缓存回退到 Flask 发送，默认不限制
+MAX_CONCURRENT = int(os.environ.get('CATHUB_PHOTO_MAX_CONCURRENT',
+                                    0 if OFFLOAD else max(1, int(os.environ.get('GUNICORN_THREADS', 2)) - 1)))
+QUEUE_TIMEOUT = float(os.environ.get('CATHUB_PHOTO_QUEUE_SECONDS', 2))
+ETAG_CACHE_SIZE = int(os.environ.get('CATHUB_PHOTO_ETAG_CACHE_SIZE', 4096))
+
+class _Unlimited:
+    """上限为 0 时的下载名额：总是可以获取"""
+
+    def acquire(self, timeout=None):
+        return True
+
+    def release(self):
+        pass
+
+def create_slots(max_concurrent):
+    """一组下载名额（每个应用一组），max_concurrent 为 0 时不限制"""
+    return threading.BoundedSemaphore(max_concurrent) if max_concurrent > 0 else _Unlimited()
+
+_slots = create_slots(MAX_CONCURRENT)
+_etag_cache = OrderedDict()
+_etag_cache_lock = threading.Lock()
+
+def _content_hash(filename):
+    """路径里的内容哈希，旧文件名返回 None"""
+    digest = photo_store.digest_of(filename)
+    if digest:
+        return digest[:CONTENT_HASH_LENGTH]
+    match = _CONTENT_NAME.match(os.path.basename(filename))
+    return match.group(1) if match else None
+
+def is_immutable(filename):
+    return _content_hash(filename) is not None
+
+def photo_etag(path, filename, by_key=False):
+    """照片的强 ETag（内容哈希）
+
+    by_key 为 True 时按键缓存（远程存储的本地缓存文件的修改时间会随读取变化，旧对象不会被覆盖）
+    """
+    etag = _content_hash(filename)
+    if etag:
+        return etag
+    if by_key:
+        key = ('key', filename)
+    else:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+    with _etag_cache_lock:
+        etag = _etag_cache.get(key)
+        if etag is not None:
+            _etag_cache.move_to_end(key)
+    record_cache('photo_etag', etag is not None)
+    if etag is not None:
+        return etag
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()[:CONTENT_HASH_LENGTH]
+    with _etag_cache_lock:
+        _etag_cache[key] = etag
+        while len(_etag_cache) > ETAG_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+    return etag
+
+def _cache_control(filename):
+    if is_immutable(filename):
+        return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return f'public, max-age={MUTABLE_MAX_AGE}'
+
+def _mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+def _not_modified(filename, etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = _cache_control(filename)
+    return response
+
+def _redirect(filename, url, valid_seconds):
+    """跳转到对象存储；预签名 URL 的跳转只缓存到 URL 过期之前"""
+    response = redirect(url, 302)
+    if valid_seconds is None:
+        response.headers['Cache-Control'] = _cache_control(filename)
+    else:
+        response.headers['Cache-Control'] = f'private, max-age={max(0, valid_seconds - 60)}'
+    return response
+
+def _offload(path, filename, etag):
+    response = Response(mimetype=_mimetype(filename))
+    if OFFLOAD == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = ACCEL_PREFIX.rstrip('/') + '/' + filename
+    else:
+        response.headers['X-Sendfile'] = path
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = _cache_control(filename)
+    return response
+
+class _SlotFile(io.FileIO):
+    """关闭时归还下载名额的文件
+
+    send_file 的响应是 direct_passthrough，响应体（文件）直接交给服务器，call_on_close 不会被调用；
+    服务器发送完或客户端断开时一定会关闭文件，在这里归还名额。fileno() 仍然可用于 sendfile。
+    """
+
+    def __init__(self, path, slots):
+        super().__init__(path, 'rb')
+        self._slots = slots
+
+    def close(self):
+        if not self.closed:
+            try:
+                super().close()
+            finally:
+                self._slots.release()
+
+def send_photo(storage, filename, slots=None, queue_timeout=QUEUE_TIMEOUT):
+    """发送存储中键为 filename 的照片，返回 Flask 响应
+
+    slots 为下载名额（create_slots 创建，每个应用一组），不传时使用按 MAX_CONCURRENT 创建的默认名额；
+    等待 queue_timeout 秒仍没有名额时返回 503。
+    """
+    slots = _slots if slots is None else slots
+    try:
+        target = storage.url(filename)
+        if target is not None:
+            return _redirect(filename, *target)
+        path = storage.local_path(filename)
+    except ValueError:  # 键里有 .. 等
+        raise NotFound()
+    if path is None:
+        raise NotFound()
+    etag = photo_etag(path, filename, by_key=not storage.is_local)
+
+    # X-Accel-Redirect 的 location 指向上传目录，远程存储的本地缓存只能用 X-Sendfile（绝对路径）
+    if OFFLOAD == 'x-sendfile' or (OFFLOAD == 'x-accel-redirect' and storage.is_local):
+        return _offload(path, filename, etag)
+
+    stat = os.stat(path)
+    last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+    # 重新验证（304）不发送文件，不占下载名额
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return _not_modified(filename, etag)
+
+    if not slots.acquire(timeout=queue_timeout):
+        logger.warning("照片下载并发已满")
+        busy = Response('photo downloads are busy, retry later', status=503, mimetype='text/plain')
+        busy.headers['Retry-After'] = '1'
+        return busy
+    try:
+        file = _SlotFile(path, slots)
+    except BaseException:
+        slots.release()
+        raise
+
+    try:
+        response = send_file(file, mimetype=_mimetype(filename), download_name=os.path.basename(filename),
+                             etag=etag, last_modified=last_modified, conditional=False, max_age=None)
+        response.content_length = stat.st_size
+        # 传入文件对象时 send_file 不知道文件大小，在这里处理 Range / If-Range
+        response = response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+    except BaseException:
+        file.close()
+        raise
+    response.accept_ranges = 'bytes'
+    response.headers['Cache-Control'] = _cache_control(filename)
+    return response
@@ -0,0 +1,243 @@
+"""
+按内容寻址的照片存储
+- 照片（压缩后的 JPEG 字节）按 sha256 存放在键 ab/cd/{sha256}.jpg 下（存储后端见 blob_storage.py），
+  同一张照片重复上传（客户端重试、先识别再设为档案照片）只存一份，返回已有的键
+- 键由内容决定且内容不会变，感知哈希等按照片计算的缓存可以直接按摘要共享
+- photo_blobs 记录每个摘要被 cats.photos、health_reports.photos、sightings.photo 引用的次数，
+  由触发器在插入、修改、删除时维护（批量上报和直接写库的脚本也会更新）
+- 写照片不经过数据库（识别的临时照片没有任何写入）；唯一删除照片的是垃圾回收：
+  持有写锁时删除没有引用且超过 GC_GRACE_SECONDS 未被使用的照片，正在识别的照片不会被删
+- PostgreSQL 的写事务是并发的：新增引用的触发器拿共享 advisory lock，垃圾回收每批拿排他锁，
+  效果与 SQLite 的写锁相同
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import db
+from app_logging import get_logger
+
+logger = get_logger('photo_store')
+
+# 没有引用的照片至少保留这么久（识别中的临时照片、刚上传还没写入档案的照片）
+GC_GRACE_SECONDS = int(os.environ.get('CATHUB_PHOTO_GC_GRACE_HOURS', 24)) * 3600
+# 每个进程自动垃圾回收的间隔，0 关闭（可以改用 flask --app server gc-photos 定时执行）
+GC_INTERVAL_SECONDS = int(os.environ.get('CATHUB_PHOTO_GC_INTERVAL_HOURS', 6)) * 3600
+GC_BATCH = 500
+
+# 扩展名统一为 3 个字母，触发器里可以按固定位置取出摘要
+EXTENSIONS = {'.jpg': '.jpg', '.jpeg': '.jpg', '.png': '.png', '.gif': '.gif'}
+_KEY = re.compile(r'([0-9a-f]{2})/([0-9a-f]{2})/([0-9a-f]{64})\.[a-z]{3}$')
+_HEX = '[0-9a-f]'
+# 与 _KEY 等价的 GLOB（SQLite 没有正则）；值可以是键，也可以是旧数据里的绝对路径或 URL
+KEY_GLOB = f"{_HEX * 2}/{_HEX * 2}/{_HEX * 64}.[a-z][a-z][a-z]"
+# PostgreSQL 用正则
+KEY_REGEX = r'(^|/)[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z]{3}$'
+REFS_LOCK_KEY = db.advisory_key('photo_refs')
+
+# 引用照片的列：(表, 列, 是否为 JSON 数组)
+REFERENCES = (
+    ('cats', 'photos', True),
+    ('health_reports', 'photos', True),
+    ('sightings', 'photo', False),
+)
+
+def blob_key(digest, ext):
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{EXTENSIONS.get(ext, ext)}"
+
+def digest_of(path):
+    """内容寻址路径中的 sha256，旧文件名返回 None"""
+    match = _KEY.search(path.replace('\\', '/')) if path else None
+    return match.group(3) if match else None
+
+def relative_key(path):
+    """照片的存储键：内容寻址的照片带两级目录，旧数据里的绝对路径、URL 只取文件名"""
+    match = _KEY.search(path.replace('\\', '/'))
+    return match.group(0) if match else os.path.basename(path.replace('\\', '/'))
+
+def normalize_path(path):
+    """旧数据里的服务器绝对路径和 /uploads URL 转换为键，已经是键的原样返回"""
+    if not isinstance(path, str) or not path:
+        return path
+    if path.startswith('/') or '\\' in path or '://' in path or re.match(r'^[A-Za-z]:', path):
+        return relative_key(path)
+    return path
+
+def put(storage, data, ext):
+    """保存照片内容，返回 (键, 是否已存在)
+
+    已存在时更新修改时间，垃圾回收不会删除正在使用的照片；
+    恰好被垃圾回收删除时重新写入。并发写入同一内容时后写的覆盖，内容相同。
+    """
+    key = blob_key(hashlib.sha256(data).hexdigest(), ext)
+    if storage.touch(key):
+        return key, True
+    storage.put(key, data)
+    return key, False
+
+def _ref_paths(table, column, is_array, row=None, dialect='sqlite'):
+    """引用的照片路径查询：row 为 new / old 时用于触发器，为 None 时扫描整张表"""
+    src = row or table
+    if dialect == 'postgres':
+        if not is_array:
+            source = f"SELECT {src}.{column} AS p" + (f" FROM {table}" if row is None else '')
+        else:
+            value = ("CASE jsonb_typeof(j.value) WHEN 'object' THEN j.value ->> 'path' "
+                     "WHEN 'string' THEN j.value #>> '{}' END")
+            source = (f"SELECT {value} AS p FROM {f'{table}, ' if row is None else ''}"
+                      f"jsonb_array_elements(cathub_json_array({src}.{column})) j")
+        return f"SELECT p FROM ({source}) paths WHERE p ~ '{KEY_REGEX}'"
+    scan = f"{table}, " if row is None else ''
+    if not is_array:
+        return (f"SELECT {src}.{column} AS p FROM {table if row is None else '(SELECT 1)'} "
+                f"WHERE p GLOB '{KEY_GLOB}' OR p GLOB '*/{KEY_GLOB}'")
+    value = ("CASE j.type WHEN 'object' THEN json_extract(j.value, '$.path') "
+             "WHEN 'text' THEN j.value END")
+    return (f"SELECT {value} AS p FROM {scan}json_each(CASE WHEN json_valid({src}.{column}) "
+            f"THEN {src}.{column} ELSE '[]' END) j WHERE p GLOB '{KEY_GLOB}' OR p GLOB '*/{KEY_GLOB}'")
+
+def _digests(table, column, is_array, row=None, dialect='sqlite'):
+    # 键的最后 68 个字符是 {摘要}.{扩展名}
+    start = 'length(p) - 67' if dialect == 'postgres' else '-68'
+    return f"SELECT substr(p, {start}, 64) AS d FROM ({_ref_paths(table, column, is_array, row, dialect)}) refs"
+
+def _ref_triggers(dialect):
+    triggers = {}
+    for table, column, is_array in REFERENCES:
+        new = _digests(table, column, is_array, 'new', dialect)
+        if dialect == 'postgres':
+            # 同一行里重复引用同一张照片时先合并，一条 UPSERT 不能两次修改同一行
+            increment = f'''PERFORM pg_advisory_xact_lock_shared({REFS_LOCK_KEY});
+            INSERT INTO photo_blobs (digest, refcount)
+            SELECT d, COUNT(*) FROM ({new}) added GROUP BY d
+            ON CONFLICT (digest) DO UPDATE SET refcount = photo_blobs.refcount + excluded.refcount;'''
+        else:
+            increment = f'''INSERT INTO photo_blobs (digest, refcount)
+            SELECT d, 1 FROM ({new}) WHERE true
+            ON CONFLICT (digest) DO UPDATE SET refcount = refcount + 1;'''
+        old = _digests(table, column, is_array, 'old', dialect)
+        decrement = f'''UPDATE photo_blobs
+            SET refcount = refcount - (SELECT COUNT(*) FROM ({old}) removed WHERE d = photo_blobs.digest)
+            WHERE digest IN ({old});'''
+        triggers[f'{table}_photo_refs_insert'] = ('AFTER INSERT', table, increment)
+        triggers[f'{table}_photo_refs_delete'] = ('AFTER DELETE', table, decrement)
+        triggers[f'{table}_photo_refs_update'] = (f'AFTER UPDATE OF {column}', table, f'{decrement}\n{increment}')
+    return triggers
+
+def init_photo_store(c):
+    """把旧数据里的路径转换为键，创建引用计数表和触发器，并根据现有数据重算一次（数据库迁移时调用）"""
+    normalize_paths(c)
+    c.execute('''CREATE TABLE IF NOT EXISTS photo_blobs (
+        digest TEXT PRIMARY KEY,
+        refcount INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+    for name, (event, table, body) in _ref_triggers(c.dialect).items():
+        db.create_trigger(c, name, event, table, body)
+    rebuild_refs(c)
+
+def normalize_paths(c):
+    """cats.photos 等列里的服务器绝对路径（旧版本保存的）改为键，返回修改的行数"""
+    updated = 0
+    for table, column, is_array in REFERENCES:
+        # 指定 ESCAPE，PostgreSQL 下反斜杠不作为 LIKE 的转义符
+        rows = c.execute(f"SELECT id, {column} FROM {table} "
+                         f"WHERE {column} LIKE '%/%' OR {column} LIKE '%\\%' ESCAPE '!'").fetchall()
+        for row_id, value in rows:
+            if is_array:
+                try:
+                    photos = json.loads(value)
+                except ValueError:
+                    continue
+                if not isinstance(photos, list):
+                    continue
+                normalized = [{**p, 'path': normalize_path(p.get('path'))} if isinstance(p, dict)
+                              else normalize_path(p) for p in photos]
+                new_value = json.dumps(normalized, ensure_ascii=False) if normalized != photos else value
+            else:
+                new_value = normalize_path(value)
+            if new_value != value:
+                c.execute(f'UPDATE {table} SET {column} = ? WHERE id = ?', (new_value, row_id))
+                updated += 1
+    if updated:
+        logger.info("照片路径已转换为存储键", extra={'rows': updated})
+    return updated
+
+def rebuild_refs(c):
+    """根据 cats / health_reports / sightings 重算引用计数（调用方负责事务）"""
+    c.execute('DELETE FROM photo_blobs')
+    union = ' UNION ALL '.join(_digests(table, column, is_array, dialect=c.dialect)
+                               for table, column, is_array in REFERENCES)
+    c.execute(f'INSERT INTO photo_blobs (digest, refcount) SELECT d, COUNT(*) FROM ({union}) refs GROUP BY d')
+
+def collect_garbage(transaction, storage, grace_seconds=GC_GRACE_SECONDS):
+    """删除没有引用且超过 grace_seconds 未使用的照片，返回 (删除的照片数, 字节数)
+
+    每批在一个写事务里确认引用计数并删除照片：与之并发的写入（新增引用）要等写锁
+    （PostgreSQL 下为 REFS_LOCK_KEY），不会出现刚被引用的照片被删除。
+    """
+    cutoff = time.time() - grace_seconds
+    candidates = []
+    for key, size, mtime in storage.scan():
+        digest = digest_of(key)
+        if digest is None:
+            # 写入中断留下的临时文件
+            if key.endswith('.tmp') and mtime < cutoff:
+                storage.delete(key)
+            continue
+        if mtime < cutoff:
+            candidates.append((digest, key, size))
+
+    deleted = freed = 0
+    for i in range(0, len(candidates), GC_BATCH):
+        batch = candidates[i:i + GC_BATCH]
+        with transaction() as conn:
+            if conn.dialect == 'postgres':
+                # 等正在新增引用的事务提交，本批结束前新的引用要等待
+                conn.execute('SELECT pg_advisory_xact_lock(?)', (REFS_LOCK_KEY,))
+            placeholders = ', '.join('?' * len(batch))
+            referenced = {row[0] for row in conn.execute(
+                f'SELECT digest FROM photo_blobs WHERE refcount > 0 AND digest IN ({placeholders})',
+                [digest for digest, _, _ in batch])}
+            for digest, key, size in batch:
+                if digest in referenced:
+                    continue
+                # 重新检查修改时间：扫描之后可能又被上传（put 会更新修改时间）
+                stat = storage.stat(key)
+                if stat is None or stat[1] >= cutoff:
+                    continue
+                if storage.delete(key):
+                    deleted += 1
+                    freed += size
+            conn.execute(f'DELETE FROM photo_blobs WHERE refcount <= 0 AND digest IN ({placeholders})',
+                         [digest for digest, _, _ in batch])
+    logger.info("照片垃圾回收完成", extra={'storage': storage.name, 'deleted': deleted,
+                                         'freed_kb': round(freed / 1024, 1)})
+    return deleted, freed
+
+_gc_lock = threading.Lock()
+_gc_state = {'pid': None, 'last_run': 0.0}
+
+def maybe_collect_garbage(transaction, storage):
+    """距离本进程上次垃圾回收超过 GC_INTERVAL_SECONDS 时，在后台线程里执行一次"""
+    if GC_INTERVAL_SECONDS <= 0:
+        return
+    now = time.time()
+    with _gc_lock:
+        if _gc_state['pid'] != os.getpid():
+            # 进程（gunicorn worker）启动后先等一个间隔，避免所有 worker 同时扫描
+            _gc_state.update(pid=os.getpid(), last_run=now)
+            return
+        if now - _gc_state['last_run'] < GC_INTERVAL_SECONDS:
+            return
+        _gc_state['last_run'] = now
+
+    def run():
+        try:
+            collect_garbage(transaction, storage)
+        except Exception as e:
+            logger.warning("照片垃圾回收失败: %s", e)
+
+    threading.Thread(target=run, name='photo-gc', daemon=True).start()
@@ -0,0 +1,148 @@
+"""
+全文搜索
+- cats_fts / events_fts：FTS5 外部内容表（content=cats / events），trigram 分词，中文不需要分词即可子串匹配
+- 由触发器在插入、删除、修改相关字段时同步；cats 只在名字、花色、性格等字段变化时更新索引，
+  频繁的 last_seen 更新不会触发
+- 查询按空白切分为多个词（AND）：3 个字及以上的词走 FTS5 MATCH 并按 bm25 排序；
+  trigram 无法索引 1-2 个字的词（如"橘猫"、"雪球"），这些词改为对原表做 LIKE 过滤
+- SQLite 不支持 FTS5 或 trigram（3.34 之前）时所有词都走 LIKE
+- PostgreSQL：每个词对各列拼接的文本做 ILIKE 子串匹配（有 pg_trgm 扩展时走 trigram GIN 索引），
+  按命中列的权重之和排序（取负数，与 bm25 一样越小越相关）
+"""
+import db
+from app_logging import get_logger
+
+logger = get_logger('search')
+
+TRIGRAM_MIN_LENGTH = 3
+
+# 表 -> (索引的列, bm25 列权重, 没有 MATCH 条件时的排序)
+INDEXES = {
+    'cats': (
+        ('name', 'pattern', 'personality', 'activity_areas', 'food_preferences', 'notes', 'feeding_tips'),
+        (10.0, 5.0, 3.0, 2.0, 2.0, 1.0, 1.0),
+        't.updated_at DESC',
+    ),
+    'events': (
+        ('title', 'cat_name', 'location', 'description'),
+        (5.0, 5.0, 2.0, 1.0),
+        't.id DESC',
+    ),
+}
+
+def _triggers(table, columns):
+    cols = ', '.join(columns)
+    new_values = ', '.join(f'new.{c}' for c in columns)
+    old_values = ', '.join(f'old.{c}' for c in columns)
+    fts = f'{table}_fts'
+    triggers = {
+        f'{fts}_insert': f'''AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_values});
+        END''',
+        f'{fts}_delete': f'''AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+        END''',
+        f'{fts}_update': f'''AFTER UPDATE OF {cols} ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+            INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_values});
+        END''',
+    }
+    return triggers
+
+def _document(columns, prefix=''):
+    """各列拼接的文本；词里没有空白（按空白切分），不会跨列命中"""
+    return " || ' ' || ".join(f"coalesce({prefix}{c}, '')" for c in columns)
+
+def _init_postgres(c):
+    c.execute('SAVEPOINT search_trgm')
+    try:
+        c.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except Exception as e:
+        c.execute('ROLLBACK TO SAVEPOINT search_trgm')
+        logger.warning("PostgreSQL 没有 pg_trgm 扩展，搜索将不使用索引: %s", e)
+        return
+    c.execute('RELEASE SAVEPOINT search_trgm')
+    for table, (columns, _, _) in INDEXES.items():
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_search ON {table} '
+                  f'USING gin (({_document(columns)}) gin_trgm_ops)')
+
+def init_search(c):
+    """创建全文索引和同步触发器，并为已有数据建索引（数据库迁移时调用）"""
+    if c.dialect == 'postgres':
+        _init_postgres(c)
+        return
+    for table, (columns, _, _) in INDEXES.items():
+        try:
+            c.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+                {', '.join(columns)}, content='{table}', content_rowid='id', tokenize='trigram')''')
+        except Exception as e:
+            logger.warning("SQLite 不支持 FTS5 trigram，搜索将使用 LIKE: %s", e)
+            return
+        for name, body in _triggers(table, columns).items():
+            c.execute(f'DROP TRIGGER IF EXISTS {name}')
+            c.execute(f'CREATE TRIGGER {name} {body}')
+        c.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+def fts_available(conn):
+    """conn 所在的数据库是否建了 FTS5 索引；每个数据库（应用）各自判断，调用方按应用缓存结果"""
+    return conn.dialect == 'sqlite' and db.table_exists(conn, 'events_fts')
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _search_postgres(conn, table, terms, limit, offset):
+    columns, weights, fallback_order = INDEXES[table]
+    document = _document(columns, 't.')
+    patterns = [f'%{_escape_like(term)}%' for term in terms]
+    scores = [f'CASE WHEN t.{c} ILIKE ? THEN {w} ELSE 0 END' for _ in patterns for c, w in zip(columns, weights)]
+    where = [f'{document} ILIKE ?'] * len(patterns)
+    params = [pattern for pattern in patterns for _ in columns] + patterns
+    sql = f'''SELECT t.*, CAST(-({' + '.join(scores)}) AS DOUBLE PRECISION) AS rank FROM {table} t
+        WHERE {' AND '.join(where)}
+        ORDER BY rank, {fallback_order} LIMIT ? OFFSET ?'''
+    params.extend([limit + 1, offset])
+    rows = conn.execute(sql, params).fetchall()
+    return rows[:limit], len(rows) > limit
+
+def search(conn, table, query, limit, offset, use_fts=None):
+    """搜索 cats 或 events，返回 (行列表, 是否还有更多)；行带 rank 列（bm25，越小越相关）
+
+    use_fts 为 fts_available(conn) 的结果（应用缓存的），不传时现查。
+    """
+    columns, weights, fallback_order = INDEXES[table]
+    terms = query.split()
+    if conn.dialect == 'postgres':
+        return _search_postgres(conn, table, terms, limit, offset)
+    if use_fts is None:
+        use_fts = fts_available(conn)
+    match_terms = [t for t in terms if use_fts and len(t) >= TRIGRAM_MIN_LENGTH]
+    like_terms = [t for t in terms if t not in match_terms]
+
+    where, params = [], []
+    for term in like_terms:
+        pattern = f'%{_escape_like(term)}%'
+        where.append('(' + ' OR '.join(f"t.{c} LIKE ? ESCAPE '\\'" for c in columns) + ')')
+        params.extend([pattern] * len(columns))
+
+    if match_terms:
+        # 每个词加引号作为短语，避免用户输入被当成 FTS5 语法
+        match = ' '.join('"' + t.replace('"', '""') + '"' for t in match_terms)
+        rank = f"bm25({table}_fts, {', '.join(map(str, weights))})"
+        if where:
+            sql = f'''SELECT t.*, {rank} AS rank FROM {table}_fts JOIN {table} t ON t.id = {table}_fts.rowid
+                WHERE {table}_fts MATCH ? AND {' AND '.join(where)}
+                ORDER BY rank LIMIT ? OFFSET ?'''
+        else:
+            # 只在索引上排序分页，再回表取这一页；常见词命中上万行时不必把整行都放进排序
+            sql = f'''SELECT t.*, m.rank FROM (
+                    SELECT rowid, {rank} AS rank FROM {table}_fts WHERE {table}_fts MATCH ?
+                    ORDER BY rank LIMIT ? OFFSET ?
+                ) m JOIN {table} t ON t.id = m.rowid ORDER BY m.rank'''
+        params.insert(0, match)
+    else:
+        sql = f'''SELECT t.*, 0.0 AS rank FROM {table} t WHERE {' AND '.join(where)}
+            ORDER BY {fallback_order} LIMIT ? OFFSET ?'''
+    params.extend([limit + 1, offset])
+
+    rows = conn.execute(sql, params).fetchall()
+    return rows[:limit], len(rows) > limit
@@ -2,58 +2,164 @@
 Cathub 后端服务器 - Flask REST API
 支持猫咪档案、上报、投喂等功能
 """
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Blueprint, request, jsonify, g, Response, current_app, has_app_context
 from flask_cors import CORS
-import sqlite3
+import click
+import functools
 import os
 import json
 import time
 import base64
+import threading
+import math
+import heapq
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from werkzeug.utils import secure_filename
 from PIL import Image
 import io
 import hashlib
 
+import admission
+import metrics
+from metrics import HTTP_REQUEST_DURATION, IMAGE_STAGE_DURATION, record_cache
+from app_logging import get_logger, sampled_debug, new_request_id, set_request_id, reset_request_id
+import tracing
+from tracing import span
+import db
+import write_behind
+from event_feed import EventFeed
+import stats
+import search
+import sync
+import compression
+import blob_storage
+import photo_serving
+import photo_store
+from config import Config
+
+logger = get_logger('server')
+
 # 导入 AI 识别模块
 try:
     from ai_recognition import is_ai_available, recognize_cat_from_database, describe_cat_features, get_ai_provider
-    AI_ENABLED = is_ai_available()
-    if AI_ENABLED:
-        print(f"🤖 AI 识别功能: 已启用 (服务商: {get_ai_provider()})")
-    else:
-        print(f"🤖 AI 识别功能: 未启用（需要配置 API Key）")
+    from ai_recognition import is_ai_circuit_open, get_ai_status, init_ai_client, print_ai_config
+    from ai_resilience import CircuitOpenError
 except ImportError as e:
-    AI_ENABLED = False
-    get_ai_provider = lambda: None
-    print(f"⚠️ AI 识别模块导入失败: {str(e)}")
-
-app = Flask(__name__)
-CORS(app)  # 允许跨域访问
-
-# 配置
-# 使用绝对路径，确保在 Render 上也能正常工作
-BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
-DATABASE = os.path.join(BASE_DIR, 'cathub.db')
+    is_ai_available = lambda provider=None: False
+    get_ai_provider = lambda provider=None: None
+    is_ai_circuit_open = lambda provider=None: False
+    get_ai_status = lambda provider=None: None
+    init_ai_client = lambda provider=None: None
+    print_ai_config = lambda provider=None: None
+
+    class CircuitOpenError(Exception):
+        pass
+    logger.warning("AI 识别模块导入失败: %s", e)
+
+# 路由和请求钩子注册在蓝图上，create_app 创建的每个应用各注册一次
+api = Blueprint('cathub', __name__, cli_group=None)
+
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-# Flask 配置
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB 最大上传大小
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+class AppState:
+    """一个应用实例的资源：数据库、照片存储、缓存和后台写入（create_app 创建，保存在 app.extensions['cathub']）
 
-# 确保上传文件夹存在
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    同一个进程里的多个应用互不影响；写后队列和事件推送的后台线程没有应用上下文，直接绑定这里的数据库。
+    """
 
-print(f"📁 工作目录: {BASE_DIR}")
-print(f"📁 数据库路径: {DATABASE}")
-print(f"📁 上传文件夹: {UPLOAD_FOLDER}")
+    def __init__(self, config):
+        self.config = config
+        # 数据库：默认 SQLite 文件，设置了 database_url 时使用 PostgreSQL（见 db.py）
+        self.database = db.Database(config.database, config.database_url, config.db_pool_size)
+        # 照片存储后端：本地目录（默认）或 S3 兼容的对象存储（见 blob_storage.py）
+        self.storage = blob_storage.create(config.storage, config.upload_folder, config.blob_cache_dir)
+        self.ai_enabled = is_ai_available(config.ai_provider)
+        self.photo_slots = photo_serving.create_slots(config.photo_max_concurrent)
+        # 猫咪列表不带 fields 参数时的字段，创建应用时解析，配置了未知字段时直接报错
+        self.cats_default_fields = parse_cat_fields(config.cats_default_fields)
+        # 指标快照目录按部署区分（见 metrics.py），prepare 时设置为本进程的目录
+        self.metrics_dir = config.metrics_dir or metrics.default_dir(config.database_url or config.database)
+        # 识别和上传的并发上限与客户端限流，计数在同一台机器的 worker 进程之间共享（见 admission.py）
+        self.admission = admission.AdmissionControl(
+            admission.create_store(config.admission_db or
+                                   admission.default_path(config.database_url or config.database)),
+            {'recognize': admission.Limit(config.recognize_max_concurrent, config.recognize_rate_per_minute,
+                                          config.recognize_burst),
+             'upload': admission.Limit(config.upload_max_concurrent, config.upload_rate_per_minute,
+                                       config.upload_burst)},
+            config.admission_queue_size, config.admission_queue_seconds, config.admission_worker_slots,
+            config.admission_ip_multiplier)
+        self.db_ready = False
+        self.geo_index_available = None
+        self.search_index_available = None
+        self.hash_cache = OrderedDict()
+        self.hash_cache_lock = threading.Lock()
+        self.cats_cache = OrderedDict()
+        self.cats_cache_lock = threading.Lock()
+        # 非关键写入的后台写线程（每个进程一个），见 write_behind.py
+        self.deferred_writes = write_behind.create_queue(_apply_deferred_writes,
+                                                         functools.partial(unit_of_work, self.database))
+        self.event_feed = EventFeed(functools.partial(fetch_events_since, database=self.database),
+                                    functools.partial(latest_event_id, self.database),
+                                    max_subscribers=config.sse_max_subscribers)
+
+    @property
+    def ai_provider(self):
+        return get_ai_provider(self.config.ai_provider)
+
+def current_state():
+    """当前应用的 AppState；在应用上下文之外（基准测试脚本等）使用默认的 server.app"""
+    return (current_app if has_app_context() else app).extensions['cathub']
+
+def print_startup_info(state=None):
+    """打印启动信息（由 startup 调用一次）"""
+    state = state or current_state()
+    logger.info("启动配置", extra={'database': state.database.describe(), 'upload_folder': state.config.upload_folder,
+                                  'storage': state.storage.name})
+    if state.config.ai_provider == 'none':
+        logger.info("AI 识别功能已关闭（ai_provider=none），只使用本地哈希匹配")
+        return
+    print_ai_config(state.config.ai_provider)
+    if state.ai_enabled:
+        logger.info("AI 识别功能已启用", extra={'provider': state.ai_provider})
+    else:
+        logger.info("AI 识别功能未启用（需要配置 API Key）")
 
 # ==================== 数据库初始化 ====================
-def init_db():
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+# 每次修改表结构或迁移时递增，记录在 PRAGMA user_version（PostgreSQL 为 cathub_schema 表）中
+SCHEMA_VERSION = 9
+
+def _schema_version(database):
+    conn = database.connect(pooled=False)
+    try:
+        return db.schema_version(conn)
+    finally:
+        conn.close()
+
+def ensure_db(state=None):
+    """确保应用的数据库已初始化且迁移到最新版本
+
+    已是最新版本时只读取一次 user_version，不会重复执行建表和迁移；
+    gunicorn 主进程在 on_starting 中调用一次，worker 里只走快速路径。
+    """
+    state = state or current_state()
+    if state.db_ready:
+        return
+    if _schema_version(state.database) < SCHEMA_VERSION:
+        with state.database.init_lock():
+            # 拿到锁后再检查一次，其他进程可能已经完成初始化
+            if _schema_version(state.database) < SCHEMA_VERSION:
+                init_db(state.database)
+    state.db_ready = True
+
+def init_db(database=None):
+    conn = (database or current_state().database).connect(pooled=False)
+    c = conn
     
+    # PostgreSQL 上共用的 SQL 函数（见 db.py）
+    db.create_functions(c)
+
     # 猫咪档案表
     c.execute('''CREATE TABLE IF NOT EXISTS cats (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -131,38 +237,149 @@ def init_db():
         FOREIGN KEY (cat_id) REFERENCES cats(id)
     )''')
 
-    # 数据库迁移：为现有表添加新字段
-    try:
-        # 检查 cats 表是否有 last_seen_at 字段
-        c.execute("PRAGMA table_info(cats)")
-        columns = [column[1] for column in c.fetchall()]
-
-        if 'last_seen_at' not in columns:
-            print("🔄 迁移数据库：添加 last_seen 字段...")
-            c.execute("ALTER TABLE cats ADD COLUMN last_seen_at INTEGER")
-            c.execute("ALTER TABLE cats ADD COLUMN last_seen_location TEXT")
-            c.execute("ALTER TABLE cats ADD COLUMN last_seen_latitude REAL")
-            c.execute("ALTER TABLE cats ADD COLUMN last_seen_longitude REAL")
-            conn.commit()
-            print("✅ 数据库迁移完成")
-    except Exception as e:
-        print(f"⚠️ 数据库迁移警告: {str(e)}")
+    # SSE 轮询和 since_id 按 id 增量读取事件，id 必须按提交顺序递增（PostgreSQL 下见 db.py）
+    db.order_ids_by_commit(c, 'events')
+
+    # 批量上报的幂等键：客户端重试同一批记录时返回第一次写入的 id
+    c.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        record_id INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (kind, key)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)')
+
+    # 数据库迁移：为现有表添加新字段（只有 SQLite 上有旧版本的数据库）
+    if conn.dialect == 'sqlite':
+        try:
+            # 检查 cats 表是否有 last_seen_at 字段
+            columns = [column[1] for column in c.execute("PRAGMA table_info(cats)").fetchall()]
+
+            if 'last_seen_at' not in columns:
+                logger.info("迁移数据库：添加 last_seen 字段")
+                c.execute("ALTER TABLE cats ADD COLUMN last_seen_at INTEGER")
+                c.execute("ALTER TABLE cats ADD COLUMN last_seen_location TEXT")
+                c.execute("ALTER TABLE cats ADD COLUMN last_seen_latitude REAL")
+                c.execute("ALTER TABLE cats ADD COLUMN last_seen_longitude REAL")
+                conn.commit()
+                logger.info("数据库迁移完成")
+        except Exception as e:
+            logger.warning("数据库迁移警告: %s", e)
+
+    init_geo_index(c)
 
+    # 喂食/目击/健康上报的按小时、按天汇总表，由触发器维护（见 stats.py）
+    stats.init_stats(c)
+
+    # 猫咪档案和事件的全文索引，由触发器同步（见 search.py）
+    search.init_search(c)
+
+    # 增量同步的变化序号，由触发器维护（见 sync.py）
+    sync.init_sync(c)
+
+    # 照片内容寻址存储的引用计数，由触发器维护（见 photo_store.py）
+    photo_store.init_photo_store(c)
+
+    db.set_schema_version(c, SCHEMA_VERSION)
     conn.commit()
     conn.close()
-    print("✅ 数据库初始化完成")
+    logger.info("数据库初始化完成", extra={'schema_version': SCHEMA_VERSION})
+
+# 空间索引：R*Tree 虚拟表，由触发器在每次写入 last_seen 坐标和插入事件时自动维护
+# （包括写后队列、批量上报和直接写库的脚本）。点坐标存为 min = max 的矩形。
+GEO_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS cats_geo_insert AFTER INSERT ON cats
+    WHEN new.last_seen_latitude IS NOT NULL AND new.last_seen_longitude IS NOT NULL
+    BEGIN
+        INSERT OR REPLACE INTO cats_geo VALUES (new.id, new.last_seen_latitude, new.last_seen_latitude,
+                                                new.last_seen_longitude, new.last_seen_longitude);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS cats_geo_update AFTER UPDATE OF last_seen_latitude, last_seen_longitude ON cats
+    BEGIN
+        DELETE FROM cats_geo WHERE id = old.id;
+        INSERT INTO cats_geo SELECT new.id, new.last_seen_latitude, new.last_seen_latitude,
+                                    new.last_seen_longitude, new.last_seen_longitude
+        WHERE new.last_seen_latitude IS NOT NULL AND new.last_seen_longitude IS NOT NULL;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS cats_geo_delete AFTER DELETE ON cats
+    BEGIN
+        DELETE FROM cats_geo WHERE id = old.id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS events_geo_insert AFTER INSERT ON events
+    WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL
+    BEGIN
+        INSERT OR REPLACE INTO events_geo VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS events_geo_delete AFTER DELETE ON events
+    BEGIN
+        DELETE FROM events_geo WHERE id = old.id;
+    END''',
+]
+
+def init_geo_index(c):
+    """创建空间索引和触发器，并为已有数据建索引；SQLite 未编译 R*Tree 时跳过（附近查询退化为范围扫描）
+
+    PostgreSQL 没有 R*Tree，在经纬度上建普通索引，附近查询走范围扫描。
+    """
+    if c.dialect == 'postgres':
+        c.execute('CREATE INDEX IF NOT EXISTS idx_cats_last_seen_position '
+                  'ON cats(last_seen_latitude, last_seen_longitude)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_events_position ON events(latitude, longitude)')
+        return
+    try:
+        c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS cats_geo USING rtree(id, min_lat, max_lat, min_lng, max_lng)')
+        c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS events_geo USING rtree(id, min_lat, max_lat, min_lng, max_lng)')
+    except Exception as e:
+        logger.warning("SQLite 不支持 R*Tree，附近查询将不使用空间索引: %s", e)
+        return
+    for trigger in GEO_TRIGGERS:
+        c.execute(trigger)
+    c.execute('''INSERT OR REPLACE INTO cats_geo
+        SELECT id, last_seen_latitude, last_seen_latitude, last_seen_longitude, last_seen_longitude FROM cats
+        WHERE last_seen_latitude IS NOT NULL AND last_seen_longitude IS NOT NULL''')
+    c.execute('''INSERT OR REPLACE INTO events_geo
+        SELECT id, latitude, latitude, longitude, longitude FROM events
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL''')
 
 # ==================== 工具函数 ====================
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+def get_db(database=None):
+    """打开当前应用（或指定 database）的一个连接"""
+    return (database or current_state().database).connect()
+
+@contextmanager
+def unit_of_work(database=None):
+    """一个请求里的所有写入（包括事件）共用一个连接和一个事务
+
+    用法：
+        with unit_of_work() as conn:
+            conn.execute(...)
+            conn.execute(EVENT_INSERT_SQL, event_row(...))
+    正常退出时提交一次，出现异常时整体回滚。SQLite 下事务一开始就拿写锁（见 db.begin_write）。
+    没有应用上下文的后台线程传入 database。
+    """
+    conn = get_db(database)
+    try:
+        db.begin_write(conn)
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+@contextmanager
+def image_stage(stage):
+    """图片处理阶段：同时记录指标和追踪 span"""
+    with IMAGE_STAGE_DURATION.time(stage=stage), span(f'image.{stage}'):
+        yield
 
 def save_photo(file, compress=True, max_size=(1280, 1280), quality=75):
-    """保存上传的照片，返回文件路径
+    """保存上传的照片，返回存储键（ab/cd/{sha256}.jpg）
 
     Args:
         file: 上传的文件对象
@@ -171,59 +388,125 @@ def save_photo(file, compress=True, max_size=(1280, 1280), quality=75):
         quality: JPEG 质量（1-100），默认 75（降低质量以减小文件大小）
     """
     if file and allowed_file(file.filename):
-        filename = f"{int(time.time() * 1000)}_{secure_filename(file.filename)}"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        ext = '.' + file.filename.rsplit('.', 1)[1].lower()
+        data = None
 
         if compress:
             try:
-                # 打开图片
-                img = Image.open(file)
-                original_size = img.size
-
-                # 转换为 RGB（如果是 RGBA 或其他模式）
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                    img = background
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
-
-                # 压缩尺寸（保持宽高比）
-                img.thumbnail(max_size, Image.Resampling.LANCZOS)
-
-                # 保存为 JPEG 格式
-                filepath = filepath.rsplit('.', 1)[0] + '.jpg'
-                img.save(filepath, 'JPEG', quality=quality, optimize=True)
-
-                # 获取压缩后的文件大小
-                compressed_size = os.path.getsize(filepath)
-                print(f"📦 图片已压缩: {original_size} -> {img.size}, 文件大小: {compressed_size / 1024:.1f} KB")
+                with image_stage('decode'):
+                    # 打开图片
+                    img = Image.open(file)
+                    original_size = img.size
+
+                    # 转换为 RGB（如果是 RGBA 或其他模式）
+                    if img.mode in ('RGBA', 'LA', 'P'):
+                        background = Image.new('RGB', img.size, (255, 255, 255))
+                        if img.mode == 'P':
+                            img = img.convert('RGBA')
+                        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+                        img = background
+                    elif img.mode != 'RGB':
+                        img = img.convert('RGB')
+
+                with image_stage('resize'):
+                    # 压缩尺寸（保持宽高比）
+                    img.thumbnail(max_size, Image.Resampling.LANCZOS)
+
+                with image_stage('encode'):
+                    # 编码为 JPEG 格式
+                    buffer = io.BytesIO()
+                    img.save(buffer, 'JPEG', quality=quality, optimize=True)
+                    data = buffer.getvalue()
+                    ext = '.jpg'
+
+                logger.info("图片已压缩", extra={'original_size': original_size, 'size': img.size,
+                                                'kb': round(len(data) / 1024, 1)})
 
             except Exception as e:
-                print(f"⚠️ 图片压缩失败，使用原图: {str(e)}")
-                file.seek(0)  # 重置文件指针
-                file.save(filepath)
-        else:
-            file.save(filepath)
+                logger.warning("图片压缩失败，使用原图: %s", e)
+                data = None
+
+        if data is None:
+            file.seek(0)  # 重置文件指针
+            data = file.read()
+
+        # 按内容寻址：同一张照片只存一份，键不变，URL 可以永久缓存（见 photo_store.py）
+        state = current_state()
+        key, duplicate = photo_store.put(state.storage, data, ext)
+        if duplicate:
+            logger.info("照片已存在，复用已有文件", extra={'key': key})
+        photo_store.maybe_collect_garbage(functools.partial(unit_of_work, state.database), state.storage)
 
-        return filepath
+        return key
     return None
 
-def compute_image_hash(image_path):
-    """计算图像的感知哈希值（用于相似度比较）"""
+def photo_local_path(photo):
+    """照片（存储键，或旧数据里的绝对路径）在本地的文件路径，远程存储会先下载到缓存；不存在时返回 None"""
     try:
-        print(f"  📷 处理图像: {image_path}")
+        return current_state().storage.local_path(photo_store.relative_key(photo))
+    except ValueError:
+        return None
 
+# 已入库照片的感知哈希缓存（AppState.hash_cache，Config.hash_cache_size 张）：识别时每张档案照片都要算一次哈希，
+# 照片文件写入后不会再修改，用 (路径, 修改时间, 大小) 作为键即可安全复用
+def _cached_image_hash(state, key):
+    with state.hash_cache_lock:
+        cached = state.hash_cache.get(key)
+        if cached is not None:
+            state.hash_cache.move_to_end(key)
+    record_cache('image_hash', cached is not None)
+    return cached
+
+def compute_image_hash(photo):
+    """计算照片（存储键或本地路径）的感知哈希值（用于相似度比较），结果按照片缓存；照片不存在时返回 None"""
+    # 内容寻址的照片内容不会变，按摘要缓存（同一张照片在识别和档案里共用一个结果），
+    # 命中时不需要读取照片（远程存储也不用下载）；旧文件名按 (路径, 修改时间, 大小)，
+    # 远程存储按键（本地缓存的修改时间会随读取变化）
+    state = current_state()
+    digest = photo_store.digest_of(photo)
+    is_path = os.path.isabs(photo) and os.path.isfile(photo)
+    key = None
+    if digest:
+        key = ('blob', digest)
+    elif not is_path and not state.storage.is_local:
+        # 现在保存的照片都是内容寻址的，远程存储里的旧对象不会再被覆盖
+        key = ('key', photo_store.relative_key(photo))
+    if key is not None:
+        cached = _cached_image_hash(state, key)
+        if cached is not None:
+            return cached
+
+    image_path = photo if is_path else photo_local_path(photo)
+    if image_path is None:
+        sampled_debug(logger, "照片不存在", extra={'photo': photo})
+        return None
+    if key is None:
+        stat = os.stat(image_path)
+        key = (image_path, stat.st_mtime_ns, stat.st_size)
+        cached = _cached_image_hash(state, key)
+        if cached is not None:
+            return cached
+
+    with image_stage('hash'):
+        hash_str = _compute_image_hash(image_path)
+
+    if hash_str:
+        with state.hash_cache_lock:
+            state.hash_cache[key] = hash_str
+            while len(state.hash_cache) > state.config.hash_cache_size:
+                state.hash_cache.popitem(last=False)
+    return hash_str
+
+def _compute_image_hash(image_path):
+    try:
         # 检查文件是否存在
         if not os.path.exists(image_path):
-            print(f"  ❌ 文件不存在: {image_path}")
+            logger.warning("文件不存在", extra={'path': image_path})
             return None
 
         # 打开图像
         img = Image.open(image_path)
-        print(f"  ✅ 图像大小: {img.size}, 模式: {img.mode}")
+        sampled_debug(logger, "计算图像哈希", extra={'path': image_path, 'size': img.size, 'mode': img.mode})
 
         # 转换为 RGB（如果是 RGBA 或其他模式）
         if img.mode in ('RGBA', 'LA', 'P'):
@@ -246,32 +529,71 @@ def compute_image_hash(image_path):
 
         # 生成哈希
         hash_str = ''.join(['1' if p > avg else '0' for p in pixels])
-        print(f"  ✅ 哈希生成成功: {hash_str[:16]}...")
 
         return hash_str
     except Exception as e:
-        print(f"  ❌ 计算图像哈希失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("计算图像哈希失败", extra={'path': image_path})
         return None
 
+EVENT_INSERT_SQL = '''INSERT INTO events
+    (event_type, cat_id, cat_name, title, description, location, latitude, longitude, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+def event_row(event_type, cat_id, cat_name, title, description=None, location=None, latitude=None, longitude=None):
+    """生成 EVENT_INSERT_SQL 的参数，便于在调用方自己的事务里批量插入"""
+    return (event_type, cat_id, cat_name, title, description, location, latitude, longitude, int(time.time() * 1000))
+
 def create_event(event_type, cat_id, cat_name, title, description=None, location=None, latitude=None, longitude=None):
-    """创建事件记录"""
+    """单独创建一条事件记录；和其他写入一起时应在 unit_of_work 里插入 event_row"""
     try:
-        conn = get_db()
-        conn.execute('''INSERT INTO events
-            (event_type, cat_id, cat_name, title, description, location, latitude, longitude, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (event_type, cat_id, cat_name, title, description, location, latitude, longitude, int(time.time() * 1000))
-        )
-        conn.commit()
-        conn.close()
-        print(f"✅ 事件已创建: {title}")
+        with unit_of_work() as conn:
+            conn.execute(EVENT_INSERT_SQL,
+                event_row(event_type, cat_id, cat_name, title, description, location, latitude, longitude))
+        logger.info("事件已创建", extra={'event_type': event_type, 'cat_id': cat_id})
         return True
     except Exception as e:
-        print(f"❌ 创建事件失败: {str(e)}")
+        logger.exception("创建事件失败")
         return False
 
+LAST_SEEN_UPDATE_SQL = '''UPDATE cats
+    SET last_seen_at = ?, last_seen_location = ?, last_seen_latitude = ?, last_seen_longitude = ?
+    WHERE id = ?'''
+
+def _apply_deferred_writes(conn, writes):
+    """写入识别后的副作用：writes 为 {'last_seen': [...], 'event': [...]}"""
+    if writes.get('last_seen'):
+        conn.executemany(LAST_SEEN_UPDATE_SQL, writes['last_seen'])
+    if writes.get('event'):
+        conn.executemany(EVENT_INSERT_SQL, writes['event'])
+
+def record_sightings(matches, location, latitude, longitude):
+    """识别后更新匹配猫咪的最后出没位置并创建目击事件
+
+    优先放入写后队列，请求线程不等待 SQLite 写锁；队列满或未启用时在一个事务里同步写入。
+    """
+    seen_at = int(time.time() * 1000)
+    writes = []
+    for match in matches:
+        # 按猫 id 合并：同一批里只保留这只猫最后一次出没的位置
+        writes.append(('last_seen', match['id'], (seen_at, location, latitude, longitude, match['id'])))
+        writes.append(('event', None, event_row(
+            event_type='sighting',
+            cat_id=match['id'],
+            cat_name=match['name'],
+            title=f"{match['name']} 在 {location} 出没",
+            description=f"有人在 {location} 发现了 {match['name']}",
+            location=location,
+            latitude=latitude,
+            longitude=longitude
+        )))
+    if current_state().deferred_writes.submit(writes):
+        return
+    grouped = {}
+    for kind, _, row in writes:
+        grouped.setdefault(kind, []).append(row)
+    with unit_of_work() as conn:
+        _apply_deferred_writes(conn, grouped)
+
 def hamming_distance(hash1, hash2):
     """计算两个哈希值的汉明距离"""
     if not hash1 or not hash2 or len(hash1) != len(hash2):
@@ -285,20 +607,153 @@ def calculate_similarity(hash1, hash2):
     return max(0, similarity)
 
 # ==================== 初始化数据库 ====================
-# 在模块加载时初始化数据库（确保 gunicorn 启动时也会执行）
-try:
-    init_db()
-except Exception as e:
-    print(f"⚠️ 数据库初始化警告: {str(e)}")
+# 不在模块加载时初始化：gunicorn 由 gunicorn.conf.py 的 on_starting 钩子执行一次（见 startup），
+# 其他启动方式（flask run、测试客户端）在第一个请求前执行
+@api.before_app_request
+def _ensure_db_before_request():
+    state = current_state()
+    if not state.db_ready:
+        metrics.configure(state.metrics_dir)
+        try:
+            ensure_db(state)
+        except Exception as e:
+            logger.warning("数据库初始化警告: %s", e)
 
 # ==================== API 路由 ====================
 
-@app.route('/api/health', methods=['GET'])
+@api.before_app_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    # 客户端或反向代理传入的 X-Request-ID 优先，方便跨服务关联日志
+    g.request_id = request.headers.get('X-Request-ID') or new_request_id()
+    g.request_id_token = set_request_id(g.request_id)
+
+    # ?debug_timing=1 时在响应里返回各阶段耗时；开启导出时按采样率记录
+    g.debug_timing = request.args.get('debug_timing') == '1'
+    g.export_trace = tracing.should_export()
+    if g.debug_timing or g.export_trace:
+        route = request.url_rule.rule if request.url_rule else request.path
+        _, g.trace_token = tracing.start_trace(
+            f'{request.method} {route}', **{'http.method': request.method, 'http.route': route,
+                                            'request_id': g.request_id})
+
+# ==================== 准入控制 ====================
+# 昂贵的接口和它们的请求类别（见 admission.py），其余接口不受并发上限和限流影响
+ADMISSION_KINDS = {
+    'cathub.recognize_cat': 'recognize',
+    'cathub.upload_cat_photo': 'upload',
+}
+CLIENT_ID_MAX_LENGTH = 128
+
+def client_ip():
+    """客户端地址；前面有 proxy_hops 层反向代理时取 X-Forwarded-For 里最外层代理记录的地址"""
+    hops = current_state().config.proxy_hops
+    if hops:
+        forwarded = [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',') if a.strip()]
+        if len(forwarded) >= hops:
+            return forwarded[-hops]
+    return request.remote_addr or ''
+
+def client_device():
+    """客户端自报的设备标识：X-Device-ID 头或 device 参数，其次是 reporter 参数，都没有时返回 None
+
+    由客户端随意设置，只作为按地址限流之外的附加限制（见 admission.py）。
+    在读取请求体之前调用，只看请求头和查询参数，被拒绝的上传不需要先解析整张照片。
+    """
+    device = request.headers.get('X-Device-ID') or request.args.get('device')
+    if device:
+        return 'device:' + device[:CLIENT_ID_MAX_LENGTH]
+    reporter = request.args.get('reporter')
+    if reporter:
+        return 'reporter:' + reporter[:CLIENT_ID_MAX_LENGTH]
+    return None
+
+@api.before_app_request
+def _admit_request():
+    kind = ADMISSION_KINDS.get(request.endpoint)
+    if kind is None:
+        return None
+    try:
+        g.admission_lease = current_state().admission.acquire(kind, client_ip(), client_device())
+    except admission.Rejected as e:
+        message = 'too many requests' if e.status == 429 else 'server is busy'
+        response = jsonify({"error": f"{message}, retry later", "retry_after": e.retry_after})
+        response.status_code = e.status
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    return None
+
+@api.teardown_app_request
+def _release_admission(exc):
+    # 视图抛出异常、before_request 提前返回时 teardown 也会执行，名额一定归还
+    lease = g.pop('admission_lease', None)
+    if lease is not None:
+        current_state().admission.release(lease)
+
+# Flask 按注册的相反顺序调用 after_request，压缩放在前面注册，在 _timing 等修改响应体之后执行
+@api.after_app_request
+def _compress_response(response):
+    return compression.compress_response(response, request.accept_encodings)
+
+@api.after_app_request
+def _record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, route=route,
+                                      method=request.method, status=response.status_code)
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    token = g.pop('trace_token', None)
+    if token is not None:
+        trace = tracing.end_trace(token)
+        trace.root.attributes['http.status_code'] = response.status_code
+        if g.get('debug_timing'):
+            _attach_timing(response, trace)
+        if g.get('export_trace'):
+            tracing.export(trace)
+    metrics.start_flusher()
+    return response
+
+def _attach_timing(response, trace):
+    """把 span 树放进 JSON 对象响应的 _timing 字段，并设置 Server-Timing 头"""
+    response.headers['Server-Timing'] = trace.server_timing()
+    if response.is_json and not response.direct_passthrough:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict):
+            body['_timing'] = trace.to_tree()
+            response.set_data(current_app.json.dumps(body))
+
+@api.teardown_app_request
+def _clear_request_id(exc):
+    # 未处理的异常不会经过 after_request，这里兜底清理上下文
+    trace_token = g.pop('trace_token', None)
+    if trace_token is not None:
+        tracing.end_trace(trace_token)
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        reset_request_id(token)
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 指标（合并所有 worker 进程）"""
+    return Response(metrics.render_latest(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查"""
-    return jsonify({"status": "ok", "message": "Cathub API is running"})
+    state = current_state()
+    return jsonify({
+        "status": "ok",
+        "message": "Cathub API is running",
+        "ai": get_ai_status(state.config.ai_provider) if state.ai_enabled else None
+    })
 
 # ---------- 猫咪档案 API ----------
+def photo_url(photo):
+    """照片（存储键，或旧数据里的绝对路径）的完整 HTTP URL"""
+    return f"{request.host_url}uploads/{photo_store.normalize_path(photo)}"
+
 def convert_photo_paths_to_urls(photos):
     """将照片路径转换为完整的 HTTP URL"""
     if not photos:
@@ -307,83 +762,24 @@ def convert_photo_paths_to_urls(photos):
     result = []
     for photo in photos:
         if isinstance(photo, dict):
-            path = photo.get('path', '')
-            # 如果是绝对路径，提取文件名
-            if path.startswith('/') or '\\' in path:
-                filename = os.path.basename(path)
-            else:
-                filename = path
-
             # 构建完整的 URL
-            photo_url = f"{request.host_url}uploads/{filename}"
             result.append({
-                'path': photo_url,
+                'path': photo_url(photo.get('path', '')),
                 'uploaded_at': photo.get('uploaded_at', 0)
             })
         elif isinstance(photo, str):
             # 兼容旧格式
-            filename = os.path.basename(photo)
-            photo_url = f"{request.host_url}uploads/{filename}"
             result.append({
-                'path': photo_url,
+                'path': photo_url(photo),
                 'uploaded_at': 0
             })
 
     return result
 
-@app.route('/api/cats', methods=['GET'])
-def get_cats():
-    """获取所有猫咪列表"""
-    try:
-        print("📋 获取猫咪列表...")
-        conn = get_db()
-        cats = conn.execute('SELECT * FROM cats ORDER BY created_at DESC').fetchall()
-        conn.close()
-
-        result = []
-        for cat in cats:
-            photos = json.loads(cat['photos']) if cat['photos'] else []
-            result.append({
-                'id': cat['id'],
-                'name': cat['name'],
-                'sex': cat['sex'],
-                'age_months': cat['age_months'],
-                'pattern': cat['pattern'],
-                'activity_areas': json.loads(cat['activity_areas']) if cat['activity_areas'] else [],
-                'personality': json.loads(cat['personality']) if cat['personality'] else [],
-                'food_preferences': json.loads(cat['food_preferences']) if cat['food_preferences'] else [],
-                'feeding_tips': cat['feeding_tips'],
-                'notes': cat['notes'],
-                'photos': convert_photo_paths_to_urls(photos),
-                'created_at': cat['created_at'],
-                'updated_at': cat['updated_at'],
-                'last_seen_at': cat['last_seen_at'],
-                'last_seen_location': cat['last_seen_location'],
-                'last_seen_latitude': cat['last_seen_latitude'],
-                'last_seen_longitude': cat['last_seen_longitude']
-            })
-
-        print(f"✅ 返回 {len(result)} 只猫咪")
-        return jsonify(result)
-    except Exception as e:
-        print(f"❌ 获取猫咪列表失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
-
-@app.route('/api/cats/<int:cat_id>', methods=['GET'])
-def get_cat(cat_id):
-    """获取单个猫咪详情"""
-    conn = get_db()
-    cat = conn.execute('SELECT * FROM cats WHERE id = ?', (cat_id,)).fetchone()
-    conn.close()
-
-    if not cat:
-        return jsonify({"error": "Cat not found"}), 404
-
+def serialize_cat(cat, include_embeddings=False):
+    """把 cats 表的一行转换为 API 返回的字典"""
     photos = json.loads(cat['photos']) if cat['photos'] else []
-
-    return jsonify({
+    result = {
         'id': cat['id'],
         'name': cat['name'],
         'sex': cat['sex'],
@@ -395,71 +791,197 @@ def get_cat(cat_id):
         'feeding_tips': cat['feeding_tips'],
         'notes': cat['notes'],
         'photos': convert_photo_paths_to_urls(photos),
-        'embeddings': json.loads(cat['embeddings']) if cat['embeddings'] else [],
         'created_at': cat['created_at'],
         'updated_at': cat['updated_at'],
         'last_seen_at': cat['last_seen_at'],
         'last_seen_location': cat['last_seen_location'],
         'last_seen_latitude': cat['last_seen_latitude'],
         'last_seen_longitude': cat['last_seen_longitude']
-    })
+    }
+    if include_embeddings:
+        result['embeddings'] = json.loads(cat['embeddings']) if cat['embeddings'] else []
+    return result
+
+# 列表接口可选的字段 -> 查询表达式，只查询被请求的列（不再 SELECT * 带出 embeddings）
+CAT_LIST_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'sex': 'sex',
+    'age_months': 'age_months',
+    'pattern': 'pattern',
+    'activity_areas': 'activity_areas',
+    'personality': 'personality',
+    'food_preferences': 'food_preferences',
+    'feeding_tips': 'feeding_tips',
+    'notes': 'notes',
+    'photos': 'photos',
+    # 封面（第一张照片），在 SQL 里取出，不把整个 photos 数组读到 Python 里解码
+    'cover_photo': "CASE WHEN json_valid(photos) THEN json_quote(json_extract(photos, '$[0]')) END",
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+    'last_seen_at': 'last_seen_at',
+    'last_seen_location': 'last_seen_location',
+    'last_seen_latitude': 'last_seen_latitude',
+    'last_seen_longitude': 'last_seen_longitude'
+}
+# PostgreSQL 没有 SQLite 的 JSON 函数，用 cathub_json_array（见 db.py）取第一个元素
+CAT_LIST_FIELDS_POSTGRES = {**CAT_LIST_FIELDS, 'cover_photo': '(cathub_json_array(photos) -> 0)::text'}
+CAT_JSON_LIST_FIELDS = ('activity_areas', 'personality', 'food_preferences')
+CAT_FIELD_PRESETS = {
+    # 列表页只显示名字、花色、一张缩略图和最近出没
+    'summary': ('id', 'name', 'pattern', 'cover_photo', 'last_seen_at', 'last_seen_location'),
+    # 与详情接口相同的字段（不含 embeddings）
+    'all': tuple(f for f in CAT_LIST_FIELDS if f != 'cover_photo')
+}
+def parse_cat_fields(value):
+    """解析 fields 参数（字段名或 summary / all，逗号分隔），返回字段元组；有未知字段时抛出 ValueError"""
+    fields = []
+    for name in value.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name in CAT_FIELD_PRESETS:
+            fields.extend(CAT_FIELD_PRESETS[name])
+        elif name in CAT_LIST_FIELDS:
+            fields.append(name)
+        else:
+            raise ValueError(name)
+    # 去重并保持顺序，id 总是返回
+    return tuple(dict.fromkeys(['id'] + fields))
+
+def serialize_cat_fields(cat, fields):
+    """只转换被请求的字段，未请求的 JSON 列不解码"""
+    result = {}
+    for field in fields:
+        value = cat[field]
+        if field in CAT_JSON_LIST_FIELDS:
+            value = json.loads(value) if value else []
+        elif field == 'photos':
+            value = convert_photo_paths_to_urls(json.loads(value) if value else [])
+        elif field == 'cover_photo':
+            photo = json.loads(value) if value else None
+            value = convert_photo_paths_to_urls([photo])[0] if photo else None
+        result[field] = value
+    return result
+
+# 猫咪列表响应缓存：按 (字段, 主机) 缓存序列化后的响应体，版本为 cats 最近一次变化的同步序号
+# （sync.entity_version）。任何实例、任何进程写入 cats 都会让共享数据库里的版本前进，
+# 其他实例下一次请求时发现版本不同即重新查询，实例之间不需要互相通知（AppState.cats_cache）
+def _cached_cats_list(state, key, version):
+    """版本一致时返回 (响应体, ETag)，否则返回 None"""
+    with state.cats_cache_lock:
+        entry = state.cats_cache.get(key)
+        hit = entry is not None and entry[0] == version
+        if hit:
+            state.cats_cache.move_to_end(key)
+    record_cache('cats_list', hit)
+    return entry[1:] if hit else None
+
+def _store_cats_list(state, key, version, body):
+    etag = f'{version}-{hashlib.sha256(body).hexdigest()[:16]}'
+    if state.config.cats_cache_size > 0:
+        with state.cats_cache_lock:
+            state.cats_cache[key] = (version, body, etag)
+            state.cats_cache.move_to_end(key)
+            while len(state.cats_cache) > state.config.cats_cache_size:
+                state.cats_cache.popitem(last=False)
+    return body, etag
+
+@api.route('/api/cats', methods=['GET'])
+def get_cats():
+    """获取所有猫咪列表
+
+    参数 fields：要返回的字段，逗号分隔，可以是字段名或 summary（名字、花色、封面、最近出没）/ all；
+    cover_photo 只返回第一张照片，需要全部照片时请求 photos。
+    """
+    state = current_state()
+    try:
+        value = request.args.get('fields')
+        fields = parse_cat_fields(value) if value else state.cats_default_fields
+    except ValueError as e:
+        return jsonify({"error": f"unknown field: {e}"}), 400
+    try:
+        conn = get_db()
+        try:
+            # 先读版本再查询：查到的数据不会比版本旧，按这个版本缓存是安全的
+            version = sync.entity_version(conn, 'cats')
+            key = (fields, request.host_url)
+            cached = _cached_cats_list(state, key, version)
+            if cached is None:
+                sql_fields = CAT_LIST_FIELDS_POSTGRES if conn.dialect == 'postgres' else CAT_LIST_FIELDS
+                columns = ', '.join(f'{sql_fields[f]} AS {f}' for f in fields)
+                cats = conn.execute(f'SELECT {columns} FROM cats ORDER BY created_at DESC').fetchall()
+                body = jsonify([serialize_cat_fields(cat, fields) for cat in cats]).get_data()
+                cached = _store_cats_list(state, key, version, body)
+        finally:
+            conn.close()
+
+        body, etag = cached
+        response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(etag, weak=True)
+        return response.make_conditional(request)
+    except Exception as e:
+        logger.exception("获取猫咪列表失败")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/cats/<int:cat_id>', methods=['GET'])
+def get_cat(cat_id):
+    """获取单个猫咪详情"""
+    conn = get_db()
+    cat = conn.execute('SELECT * FROM cats WHERE id = ?', (cat_id,)).fetchone()
+    conn.close()
+
+    if not cat:
+        return jsonify({"error": "Cat not found"}), 404
+
+    return jsonify(serialize_cat(cat, include_embeddings=True))
 
-@app.route('/api/cats', methods=['POST'])
+@api.route('/api/cats', methods=['POST'])
 def create_cat():
     """创建猫咪档案"""
     try:
-        print("📝 创建猫咪档案...")
         data = request.json
-        print(f"收到数据: {data}")
 
         now = int(time.time())
-        conn = get_db()
-        cursor = conn.cursor()
-
-        cursor.execute('''INSERT INTO cats
-            (name, sex, age_months, pattern, activity_areas, personality,
-             food_preferences, feeding_tips, notes, photos, embeddings, created_by, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            (
-                data.get('name'),
-                data.get('sex'),
-                data.get('age_months'),
-                data.get('pattern'),
-                json.dumps(data.get('activity_areas', []), ensure_ascii=False),
-                json.dumps(data.get('personality', []), ensure_ascii=False),
-                json.dumps(data.get('food_preferences', []), ensure_ascii=False),
-                data.get('feeding_tips'),
-                data.get('notes'),
-                json.dumps(data.get('photos', []), ensure_ascii=False),
-                json.dumps(data.get('embeddings', []), ensure_ascii=False),
-                data.get('created_by', 'anonymous'),
-                now,
-                now
-            ))
-    
-        cat_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-
-        # 创建事件：新猫咪加入档案
         cat_name = data.get('name', '未命名')
-        create_event(
-            event_type='new_cat',
-            cat_id=cat_id,
-            cat_name=cat_name,
-            title=f"新的猫咪：{cat_name} 加入档案",
-            description=f"猫咪档案已创建"
-        )
+        with unit_of_work() as conn:
+            cat_id = db.insert(conn, '''INSERT INTO cats
+                (name, sex, age_months, pattern, activity_areas, personality,
+                 food_preferences, feeding_tips, notes, photos, embeddings, created_by, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (
+                    data.get('name'),
+                    data.get('sex'),
+                    data.get('age_months'),
+                    data.get('pattern'),
+                    json.dumps(data.get('activity_areas', []), ensure_ascii=False),
+                    json.dumps(data.get('personality', []), ensure_ascii=False),
+                    json.dumps(data.get('food_preferences', []), ensure_ascii=False),
+                    data.get('feeding_tips'),
+                    data.get('notes'),
+                    json.dumps(data.get('photos', []), ensure_ascii=False),
+                    json.dumps(data.get('embeddings', []), ensure_ascii=False),
+                    data.get('created_by', 'anonymous'),
+                    now,
+                    now
+                ))
+
+            # 创建事件：新猫咪加入档案（与档案在同一事务中）
+            conn.execute(EVENT_INSERT_SQL, event_row(
+                event_type='new_cat',
+                cat_id=cat_id,
+                cat_name=cat_name,
+                title=f"新的猫咪：{cat_name} 加入档案",
+                description=f"猫咪档案已创建"
+            ))
 
-        print(f"✅ 猫咪创建成功，ID: {cat_id}")
+        logger.info("猫咪创建成功", extra={'cat_id': cat_id})
         return jsonify({"id": cat_id, "message": "Cat created successfully"}), 201
     except Exception as e:
-        print(f"❌ 创建猫咪失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("创建猫咪失败")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/cats/<int:cat_id>', methods=['PUT'])
+@api.route('/api/cats/<int:cat_id>', methods=['PUT'])
 def update_cat(cat_id):
     """更新猫咪档案"""
     data = request.json
@@ -499,238 +1021,341 @@ def update_cat(cat_id):
     
     return jsonify({"message": "Cat updated successfully"})
 
-@app.route('/api/cats/<int:cat_id>/photos', methods=['POST'])
+@api.route('/api/cats/<int:cat_id>/photos', methods=['POST'])
 def upload_cat_photo(cat_id):
     """上传猫咪照片"""
     if 'photo' not in request.files:
         return jsonify({"error": "No photo provided"}), 400
     
     file = request.files['photo']
-    filepath = save_photo(file)
+    key = save_photo(file)
     
-    if not filepath:
+    if not key:
         return jsonify({"error": "Invalid file type"}), 400
     
-    # 更新猫咪的照片列表
-    conn = get_db()
-    cursor = conn.cursor()
-    cat = cursor.execute('SELECT photos FROM cats WHERE id = ?', (cat_id,)).fetchone()
-    
-    if not cat:
-        conn.close()
-        return jsonify({"error": "Cat not found"}), 404
-    
-    photos = json.loads(cat['photos']) if cat['photos'] else []
-    photos.append({
-        "path": filepath,
-        "uploaded_at": int(time.time())
-    })
-    
-    cursor.execute('UPDATE cats SET photos = ?, updated_at = ? WHERE id = ?',
-                   (json.dumps(photos, ensure_ascii=False), int(time.time()), cat_id))
-    conn.commit()
-    conn.close()
-    
-    return jsonify({"path": filepath, "message": "Photo uploaded successfully"})
-
-@app.route('/api/recognize', methods=['POST'])
-def recognize_cat():
-    """识别猫咪 - 支持 AI 和传统方法"""
-    temp_filepath = None
-    try:
-        # 检查是否使用 AI 识别
-        # 默认：如果 AI 可用，就使用 AI；除非明确指定 use_ai=false
-        use_ai_param = request.form.get('use_ai', 'auto').lower()
-
-        if use_ai_param == 'auto':
-            use_ai = AI_ENABLED  # AI 可用时自动使用
-        else:
-            use_ai = use_ai_param == 'true'
-
-        print(f"🔍 开始识别猫咪... (方法: {'AI' if use_ai and AI_ENABLED else '传统哈希'})")
-        if use_ai and AI_ENABLED:
-            print(f"🤖 使用 AI 服务: {get_ai_provider()}")
-
-        if 'photo' not in request.files:
-            print("❌ 没有收到照片文件")
-            return jsonify({"error": "No photo provided"}), 400
-
-        file = request.files['photo']
-        print(f"📸 收到文件: {file.filename}, 大小: {file.content_length if hasattr(file, 'content_length') else 'unknown'}")
-
-        # 保存临时文件
-        temp_filepath = save_photo(file)
-        if not temp_filepath:
-            print("❌ 文件类型不支持")
-            return jsonify({"error": "Invalid file type"}), 400
-
-        print(f"✅ 临时文件已保存: {temp_filepath}")
-
-        # 获取所有猫咪数据
-        conn = get_db()
-        cursor = conn.cursor()
-        cats = cursor.execute('SELECT * FROM cats').fetchall()
-        print(f"📊 找到 {len(cats)} 只猫咪")
+    # 更新猫咪的照片列表（引用计数由触发器在同一事务里更新）
+    with unit_of_work() as conn:
+        cat = conn.execute('SELECT photos FROM cats WHERE id = ?', (cat_id,)).fetchone()
+        if not cat:
+            return jsonify({"error": "Cat not found"}), 404
+
+        photos = json.loads(cat['photos']) if cat['photos'] else []
+        # 同一张照片重复上传（客户端重试）时 save_photo 返回已有的键，不重复添加
+        if any(photo_store.relative_key((p.get('path') if isinstance(p, dict) else p) or '') == key
+               for p in photos):
+            return jsonify({"path": key, "url": photo_url(key), "duplicate": True,
+                            "message": "Photo already exists"})
+        photos.append({
+            "path": key,
+            "uploaded_at": int(time.time())
+        })
 
-        matches = []
+        conn.execute('UPDATE cats SET photos = ?, updated_at = ? WHERE id = ?',
+                     (json.dumps(photos, ensure_ascii=False), int(time.time()), cat_id))
 
-        # 选择识别方法
-        if use_ai and AI_ENABLED:
-            # 使用 AI 识别
-            print("🤖 使用 AI 识别...")
-            cats_data = []
-            for cat in cats:
-                cats_data.append({
-                    'id': cat['id'],
-                    'name': cat['name'],
-                    'sex': cat['sex'],
-                    'age_months': cat['age_months'],
-                    'pattern': cat['pattern'],
-                    'activity_areas': json.loads(cat['activity_areas']) if cat['activity_areas'] else [],
-                    'personality': json.loads(cat['personality']) if cat['personality'] else [],
-                    'food_preferences': json.loads(cat['food_preferences']) if cat['food_preferences'] else [],
-                    'feeding_tips': cat['feeding_tips'],
-                    'photos': json.loads(cat['photos']) if cat['photos'] else [],
-                    'embeddings': json.loads(cat['embeddings']) if cat['embeddings'] else [],
-                    'created_at': cat['created_at'],
-                    'updated_at': cat['updated_at']
-                })
-
-            ai_matches = recognize_cat_from_database(temp_filepath, cats_data)
-
-            for match in ai_matches:
-                cat_data = match['cat']
-                cat_data['similarity'] = match['similarity']
-                matches.append(cat_data)
+    return jsonify({"path": key, "url": photo_url(key), "duplicate": False,
+                    "message": "Photo uploaded successfully"})
 
-        else:
-            # 使用传统哈希方法
-            print("🔢 使用传统哈希识别...")
-            upload_hash = compute_image_hash(temp_filepath)
-            if not upload_hash:
-                print("❌ 图像处理失败")
-                return jsonify({"error": "Failed to process image"}), 500
+def match_cats_by_hash(upload_path, cats):
+    """使用传统感知哈希匹配猫咪，图像处理失败时返回 None"""
+    threshold = current_state().config.hash_match_threshold
+    upload_hash = compute_image_hash(upload_path)
+    if not upload_hash:
+        logger.error("图像处理失败")
+        return None
 
-            print(f"✅ 图像哈希: {upload_hash[:16]}...")
+    matches = []
+    for cat in cats:
+        photos = json.loads(cat['photos']) if cat['photos'] else []
+
+        if not photos:
+            continue
+
+        # 计算与每张照片的相似度
+        max_similarity = 0
+        for photo in photos:
+            photo_path = photo.get('path')
+            if photo_path:
+                photo_hash = compute_image_hash(photo_path)
+                if photo_hash:
+                    similarity = calculate_similarity(upload_hash, photo_hash)
+                    max_similarity = max(max_similarity, similarity)
+
+        # 如果相似度超过阈值（默认 30%），添加到匹配列表
+        if max_similarity > threshold:
+            sampled_debug(logger, "哈希匹配", extra={'cat_id': cat['id'], 'similarity': round(max_similarity, 2)})
+            matches.append({
+                'id': cat['id'],
+                'name': cat['name'],
+                'sex': cat['sex'],
+                'age_months': cat['age_months'],
+                'pattern': cat['pattern'],
+                'activity_areas': json.loads(cat['activity_areas']) if cat['activity_areas'] else [],
+                'personality': json.loads(cat['personality']) if cat['personality'] else [],
+                'food_preferences': json.loads(cat['food_preferences']) if cat['food_preferences'] else [],
+                'feeding_tips': cat['feeding_tips'],
+                'notes': cat['notes'],
+                'photos': convert_photo_paths_to_urls(photos),
+                'embeddings': json.loads(cat['embeddings']) if cat['embeddings'] else [],
+                'created_at': cat['created_at'],
+                'updated_at': cat['updated_at'],
+                'similarity': round(max_similarity, 2)
+            })
+    return matches
 
-            for cat in cats:
-                photos = json.loads(cat['photos']) if cat['photos'] else []
+# 位置先验：流浪猫的活动范围很小，先在附近的猫里找，找不到再扩大到全部（半径为 Config.recognition_prior_radius_m）
 
-                if not photos:
-                    continue
+def _area_matches(location, areas_json):
+    """上报地点与猫的活动区域互相包含（如 "小区东门附近" 与 "小区东门"）"""
+    try:
+        areas = json.loads(areas_json) if areas_json else []
+    except ValueError:
+        return False
+    return any(area and (area in location or location in area) for area in areas if isinstance(area, str))
+
+def nearby_cat_ids(conn, location=None, latitude=None, longitude=None):
+    """识别的位置先验：最后出没位置在先验半径内，或活动区域与上报地点相符的猫 id"""
+    radius_m = current_state().config.recognition_prior_radius_m
+    nearby_ids = set()
+    if radius_m > 0:
+        if latitude is not None and longitude is not None:
+            nearby_ids.update(row_id for _, row_id in nearest_ids(
+                conn, 'cats', 'last_seen_latitude', 'last_seen_longitude',
+                latitude, longitude, radius_m))
+        if location:
+            rows = conn.execute('SELECT id, activity_areas FROM cats WHERE activity_areas IS NOT NULL').fetchall()
+            nearby_ids.update(row['id'] for row in rows if _area_matches(location, row['activity_areas']))
+    return nearby_ids
+
+def candidate_tier(conn, index, nearby_ids):
+    """第 index 层候选 (范围, 候选猫)：附近有猫时依次为 nearby、all，否则只有 all；没有更多层时返回 None"""
+    if not nearby_ids:
+        return ('all', conn.execute('SELECT * FROM cats').fetchall()) if index == 0 else None
+
+    ids = list(nearby_ids)
+    placeholders = ','.join('?' * len(ids))
+    if index == 0:
+        return 'nearby', conn.execute(f'SELECT * FROM cats WHERE id IN ({placeholders})', ids).fetchall()
+    if index == 1:
+        return 'all', conn.execute(f'SELECT * FROM cats WHERE id NOT IN ({placeholders})', ids).fetchall()
+    return None
 
-                # 计算与每张照片的相似度
-                max_similarity = 0
-                for photo in photos:
-                    photo_path = photo.get('path')
-                    if photo_path and os.path.exists(photo_path):
-                        photo_hash = compute_image_hash(photo_path)
-                        if photo_hash:
-                            similarity = calculate_similarity(upload_hash, photo_hash)
-                            max_similarity = max(max_similarity, similarity)
-
-                # 如果相似度超过阈值，添加到匹配列表
-                if max_similarity > 30:  # 30% 相似度阈值
-                    print(f"✅ 匹配: {cat['name']} (相似度: {max_similarity:.2f}%)")
-                    photos_data = json.loads(cat['photos']) if cat['photos'] else []
-                    matches.append({
-                        'id': cat['id'],
-                        'name': cat['name'],
-                        'sex': cat['sex'],
-                        'age_months': cat['age_months'],
-                        'pattern': cat['pattern'],
-                        'activity_areas': json.loads(cat['activity_areas']) if cat['activity_areas'] else [],
-                        'personality': json.loads(cat['personality']) if cat['personality'] else [],
-                        'food_preferences': json.loads(cat['food_preferences']) if cat['food_preferences'] else [],
-                        'feeding_tips': cat['feeding_tips'],
-                        'notes': cat['notes'],
-                        'photos': convert_photo_paths_to_urls(photos_data),
-                        'embeddings': json.loads(cat['embeddings']) if cat['embeddings'] else [],
-                        'created_at': cat['created_at'],
-                        'updated_at': cat['updated_at'],
-                        'similarity': round(max_similarity, 2)
-                    })
+def candidate_tiers(conn, location=None, latitude=None, longitude=None):
+    """按位置先验依次产出 (范围, 候选猫)：先是附近的猫，再是其余的猫
 
+    "附近" 指最后出没位置在 Config.recognition_prior_radius_m 米内，或活动区域与上报地点相符。
+    没有位置信息、关闭了先验（半径设为 0）或附近没有猫时，只产出一层 ('all', 全部猫)。
+    其余的猫只在调用方继续迭代（附近没有匹配）时才查询。
+    """
+    nearby_ids = nearby_cat_ids(conn, location, latitude, longitude)
+    index = 0
+    while True:
+        tier = candidate_tier(conn, index, nearby_ids)
+        if tier is None:
+            return
+        yield tier
+        index += 1
+
+def fetch_candidate_tier(index, params, nearby_ids=None):
+    """单独打开连接取第 index 层候选，返回 (tier, nearby_ids)，tier 为 None 表示没有更多候选
+
+    供 asgi.py 在线程池里逐层调用，连接不跨线程使用；nearby_ids 为 None 时先计算位置先验，
+    之后的调用传入上一次返回的 nearby_ids。
+    """
+    conn = get_db()
+    try:
+        with span('db_fetch'):
+            if nearby_ids is None:
+                nearby_ids = nearby_cat_ids(conn, params['location'], params['latitude'], params['longitude'])
+            return candidate_tier(conn, index, nearby_ids), nearby_ids
+    finally:
         conn.close()
 
-        # 按相似度排序
-        matches.sort(key=lambda x: x['similarity'], reverse=True)
-
-        print(f"🎯 识别完成，找到 {len(matches)} 个匹配")
-
-        # 获取位置信息
-        location = request.form.get('location')
-        latitude = request.form.get('latitude', type=float)
-        longitude = request.form.get('longitude', type=float)
-
-        # 如果有匹配结果且提供了位置信息，更新猫咪的最后出没位置并创建事件
-        if matches and location:
-            for match in matches:
-                cat_id = match['id']
-                cat_name = match['name']
+def recognition_method(use_ai):
+    """选择识别方法：'ai' 或 'hash'（第一次选择 AI 时导入 SDK 并创建客户端）"""
+    state = current_state()
+    provider = state.config.ai_provider
+    # 服务商熔断时直接走本地哈希匹配，不再等待远程超时
+    if use_ai and state.ai_enabled and is_ai_circuit_open(provider):
+        logger.warning("AI 服务已熔断，降级为本地哈希识别")
+    elif use_ai and state.ai_enabled and init_ai_client(provider):
+        return 'ai'
+    return 'hash'
+
+def ai_candidates(cats):
+    """AI 识别的输入：返回 (cats_data, photos_by_id)"""
+    cats_data = []
+    photos_by_id = {}
+    for cat in cats:
+        photos_by_id[cat['id']] = json.loads(cat['photos']) if cat['photos'] else []
+        cats_data.append({
+            'id': cat['id'],
+            'name': cat['name'],
+            'sex': cat['sex'],
+            'age_months': cat['age_months'],
+            'pattern': cat['pattern'],
+            'activity_areas': json.loads(cat['activity_areas']) if cat['activity_areas'] else [],
+            'personality': json.loads(cat['personality']) if cat['personality'] else [],
+            'food_preferences': json.loads(cat['food_preferences']) if cat['food_preferences'] else [],
+            'feeding_tips': cat['feeding_tips'],
+            # AI 模块读取本地文件：远程存储的照片先下载到本地缓存
+            'photos': [{**photo, 'path': photo_local_path(photo.get('path') or '')}
+                       for photo in photos_by_id[cat['id']]],
+            'embeddings': json.loads(cat['embeddings']) if cat['embeddings'] else [],
+            'created_at': cat['created_at'],
+            'updated_at': cat['updated_at']
+        })
+    return cats_data, photos_by_id
+
+def ai_matches(results, photos_by_id):
+    """把 AI 模块的匹配结果转换为响应里的猫咪列表"""
+    matches = []
+    for match in results:
+        cat_data = match['cat']
+        # 返回给客户端的是照片 URL，不是本地缓存路径
+        cat_data['photos'] = convert_photo_paths_to_urls(photos_by_id[cat_data['id']])
+        cat_data['similarity'] = match['similarity']
+        matches.append(cat_data)
+    return matches
+
+def hash_matches(upload_path, cats):
+    """本地感知哈希匹配，返回 (matches, 'hash')；图像处理失败时 matches 为 None"""
+    with span('hash_match', candidates=len(cats)):
+        return match_cats_by_hash(upload_path, cats), 'hash'
+
+def match_candidates(upload_path, cats, use_ai):
+    """在一组候选猫中识别，返回 (matches, method)；图像处理失败时 matches 为 None"""
+    if recognition_method(use_ai) == 'ai':
+        # 使用 AI 识别（第一次调用时才导入 SDK 并创建客户端）
+        config = current_state().config
+        cats_data, photos_by_id = ai_candidates(cats)
+        try:
+            with span('ai_match', provider=get_ai_provider(config.ai_provider), candidates=len(cats)):
+                results = recognize_cat_from_database(upload_path, cats_data, provider=config.ai_provider,
+                                                      threshold=config.ai_match_threshold)
+            return ai_matches(results, photos_by_id), 'ai'
+        except CircuitOpenError as e:
+            logger.warning("%s，降级为本地哈希识别", e)
+
+    return hash_matches(upload_path, cats)
+
+def parse_recognition_request():
+    """解析识别请求并保存上传的照片
+
+    返回 (参数, None)；请求无效时返回 (None, 错误响应)。
+    """
+    # 检查是否使用 AI 识别
+    # 默认：如果 AI 可用，就使用 AI；除非明确指定 use_ai=false
+    with span('parse_upload'):
+        use_ai_param = request.form.get('use_ai', 'auto').lower()
+        file = request.files.get('photo')
 
-                # 更新猫咪的最后出没位置
-                try:
-                    conn = get_db()
-                    conn.execute('''UPDATE cats
-                        SET last_seen_at = ?, last_seen_location = ?, last_seen_latitude = ?, last_seen_longitude = ?
-                        WHERE id = ?''',
-                        (int(time.time() * 1000), location, latitude, longitude, cat_id)
-                    )
-                    conn.commit()
-                    conn.close()
-                    print(f"✅ 更新 {cat_name} 的最后出没位置: {location}")
-
-                    # 创建事件
-                    create_event(
-                        event_type='sighting',
-                        cat_id=cat_id,
-                        cat_name=cat_name,
-                        title=f"{cat_name} 在 {location} 出没",
-                        description=f"有人在 {location} 发现了 {cat_name}",
-                        location=location,
-                        latitude=latitude,
-                        longitude=longitude
-                    )
-                except Exception as e:
-                    print(f"⚠️ 更新最后出没位置失败: {str(e)}")
-
-        # 删除临时文件
-        if temp_filepath:
+    state = current_state()
+    if use_ai_param == 'auto':
+        use_ai = state.ai_enabled  # AI 可用时自动使用
+    else:
+        use_ai = use_ai_param == 'true'
+
+    logger.info("开始识别猫咪", extra={'use_ai': bool(use_ai and state.ai_enabled), 'provider': state.ai_provider})
+
+    if file is None:
+        return None, (jsonify({"error": "No photo provided"}), 400)
+
+    # 保存上传的照片
+    with span('save_photo'):
+        upload_key = save_photo(file)
+    if not upload_key:
+        return None, (jsonify({"error": "Invalid file type"}), 400)
+    # 识别读取本地文件（远程存储时 save_photo 已经写入了本地缓存）
+    upload_path = state.storage.local_path(upload_key)
+    if upload_path is None:
+        return None, (jsonify({"error": "Failed to process image"}), 500)
+
+    # 获取位置信息
+    return {
+        'upload_path': upload_path,
+        'use_ai': use_ai,
+        'location': request.form.get('location'),
+        'latitude': request.form.get('latitude', type=float),
+        'longitude': request.form.get('longitude', type=float),
+    }, None
+
+def recognition_response(params, matches, method, scope, candidates):
+    """排序、记录出没位置并生成识别响应"""
+    # 按相似度排序
+    matches.sort(key=lambda x: x['similarity'], reverse=True)
+
+    logger.info("识别完成", extra={'method': method, 'matches': len(matches),
+                                  'candidates': candidates, 'scope': scope})
+
+    # 如果有匹配结果且提供了位置信息，更新猫咪的最后出没位置并创建事件
+    # 这些写入交给后台写线程批量提交，响应不等待 SQLite 写锁
+    location = params['location']
+    if matches and location:
+        with span('last_seen_update', matches=len(matches)):
             try:
-                os.remove(temp_filepath)
-                print(f"🗑️ 临时文件已删除")
+                record_sightings(matches, location, params['latitude'], params['longitude'])
             except Exception as e:
-                print(f"⚠️ 删除临时文件失败: {str(e)}")
+                logger.warning("更新最后出没位置失败: %s", e, extra={'matches': len(matches)})
 
-        return jsonify({
-            "matches": matches,
-            "count": len(matches)
-        })
+    # 上传的照片不删除：按内容寻址，可能与档案照片是同一个文件；没有被引用的由垃圾回收清理
 
-    except Exception as e:
-        print(f"❌ 识别失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
+    return jsonify({
+        "matches": matches,
+        "count": len(matches),
+        "method": method,
+        "scope": scope,
+        "candidates": candidates
+    })
 
-        # 清理临时文件
-        if temp_filepath:
-            try:
-                os.remove(temp_filepath)
-            except:
-                pass
+@api.route('/api/recognize', methods=['POST'])
+def recognize_cat():
+    """识别猫咪 - 支持 AI 和传统方法
+
+    ASGI 入口（asgi.py）用协程实现同一个接口，共用这里的解析、候选查询和响应函数。
+    """
+    try:
+        params, error = parse_recognition_request()
+        if error:
+            return error
 
+        # 先在附近的猫里识别，没有匹配时再扩大到其余的猫
+        conn = get_db()
+        matches = []
+        method = 'hash'
+        scope = 'all'
+        candidates = 0
+        try:
+            tiers = candidate_tiers(conn, params['location'], params['latitude'], params['longitude'])
+            while True:
+                with span('db_fetch'):
+                    tier = next(tiers, None)
+                if tier is None:
+                    break
+                scope, cats = tier
+                candidates += len(cats)
+                matches, method = match_candidates(params['upload_path'], cats, params['use_ai'])
+                if matches is None:
+                    return jsonify({"error": "Failed to process image"}), 500
+                if matches:
+                    break
+        finally:
+            conn.close()
+
+        return recognition_response(params, matches, method, scope, candidates)
+
+    except Exception as e:
+        logger.exception("识别失败")
         return jsonify({"error": str(e)}), 500
 
 # ---------- 目击记录 API ----------
-@app.route('/api/sightings', methods=['POST'])
+@api.route('/api/sightings', methods=['POST'])
 def create_sighting():
     """创建目击记录"""
     data = request.json
     
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO sightings 
+    sighting_id = db.insert(conn, '''INSERT INTO sightings
         (cat_id, photo, location, similarity, device, reporter, ts)
         VALUES (?, ?, ?, ?, ?, ?, ?)''',
         (
@@ -742,14 +1367,12 @@ def create_sighting():
             data.get('reporter', 'anonymous'),
             int(time.time())
         ))
-    
-    sighting_id = cursor.lastrowid
     conn.commit()
     conn.close()
     
     return jsonify({"id": sighting_id, "message": "Sighting created successfully"}), 201
 
-@app.route('/api/sightings', methods=['GET'])
+@api.route('/api/sightings', methods=['GET'])
 def get_sightings():
     """获取目击记录"""
     cat_id = request.args.get('cat_id')
@@ -764,81 +1387,80 @@ def get_sightings():
     result = [dict(s) for s in sightings]
     return jsonify(result)
 
+# 将英文类型转换为中文
+HEALTH_REPORT_TYPES = {
+    'injury': '受伤',
+    'sick': '生病',
+    'neutered': '已绝育',
+    'other': '其他'
+}
+HEALTH_REPORT_SEVERITIES = {
+    'low': '轻微',
+    'medium': '中等',
+    'high': '严重'
+}
+
+def health_report_title(cat_name, report_type, severity):
+    """健康上报对应事件的标题，只在有严重程度时才添加括号"""
+    type_text = HEALTH_REPORT_TYPES.get(report_type, '其他')
+    severity_text = HEALTH_REPORT_SEVERITIES.get(severity) if severity else None
+    if severity_text:
+        return f"{cat_name} {type_text}（{severity_text}）"
+    return f"{cat_name} {type_text}"
+
 # ---------- 健康上报 API ----------
-@app.route('/api/health_reports', methods=['POST'])
+@api.route('/api/health_reports', methods=['POST'])
 def create_health_report():
     """创建健康上报"""
     data = request.json
-    
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO health_reports 
-        (cat_id, type, severity, note, photos, reporter, ts, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-        (
-            data.get('cat_id'),
-            data.get('type'),
-            data.get('severity'),
-            data.get('note'),
-            json.dumps(data.get('photos', []), ensure_ascii=False),
-            data.get('reporter', 'anonymous'),
-            int(time.time()),
-            data.get('status', 'pending')
-        ))
-    
-    report_id = cursor.lastrowid
-
-    # 获取猫咪名称
-    cat = cursor.execute('SELECT name FROM cats WHERE id = ?', (data.get('cat_id'),)).fetchone()
-    cat_name = cat['name'] if cat else '未知猫咪'
-
-    conn.commit()
-    conn.close()
 
-    # 创建事件
-    # 将英文类型转换为中文
-    type_mapping = {
-        'injury': '受伤',
-        'sick': '生病',
-        'neutered': '已绝育',
-        'other': '其他'
-    }
-    report_type = type_mapping.get(data.get('type', 'other'), '其他')
-    severity = data.get('severity')
-
-    # 根据严重程度生成标题（只在有严重程度时才添加）
-    if severity:
-        if severity == 'low':
-            severity_text = '轻微'
-        elif severity == 'medium':
-            severity_text = '中等'
-        elif severity == 'high':
-            severity_text = '严重'
-        else:
-            severity_text = None
+    with unit_of_work() as conn:
+        report_id = db.insert(conn, '''INSERT INTO health_reports
+            (cat_id, type, severity, note, photos, reporter, ts, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            (
+                data.get('cat_id'),
+                data.get('type'),
+                data.get('severity'),
+                data.get('note'),
+                json.dumps(data.get('photos', []), ensure_ascii=False),
+                data.get('reporter', 'anonymous'),
+                int(time.time()),
+                data.get('status', 'pending')
+            ))
 
-        if severity_text:
-            title = f"{cat_name} {report_type}（{severity_text}）"
-        else:
-            title = f"{cat_name} {report_type}"
-    else:
-        # 没有严重程度选项时，不添加括号
-        title = f"{cat_name} {report_type}"
+        # 获取猫咪名称
+        cat = conn.execute('SELECT name FROM cats WHERE id = ?', (data.get('cat_id'),)).fetchone()
+        cat_name = cat['name'] if cat else '未知猫咪'
 
-    create_event(
-        event_type='health_report',
-        cat_id=data.get('cat_id'),
-        cat_name=cat_name,
-        title=title,
-        description=data.get('note', ''),
-        location=data.get('location'),
-        latitude=data.get('latitude'),
-        longitude=data.get('longitude')
-    )
+        # 创建事件（与上报在同一事务中）
+        conn.execute(EVENT_INSERT_SQL, event_row(
+            event_type='health_report',
+            cat_id=data.get('cat_id'),
+            cat_name=cat_name,
+            title=health_report_title(cat_name, data.get('type', 'other'), data.get('severity')),
+            description=data.get('note', ''),
+            location=data.get('location'),
+            latitude=data.get('latitude'),
+            longitude=data.get('longitude')
+        ))
 
     return jsonify({"id": report_id, "message": "Health report created successfully"}), 201
 
-@app.route('/api/health_reports', methods=['GET'])
+def serialize_health_report(r):
+    return {
+        'id': r['id'],
+        'cat_id': r['cat_id'],
+        'type': r['type'],
+        'severity': r['severity'],
+        'note': r['note'],
+        'photos': json.loads(r['photos']) if r['photos'] else [],
+        'reporter': r['reporter'],
+        'ts': r['ts'],
+        'status': r['status']
+    }
+
+@api.route('/api/health_reports', methods=['GET'])
 def get_health_reports():
     """获取健康上报"""
     cat_id = request.args.get('cat_id')
@@ -850,31 +1472,18 @@ def get_health_reports():
         reports = conn.execute('SELECT * FROM health_reports ORDER BY ts DESC LIMIT 100').fetchall()
     conn.close()
     
-    result = []
-    for r in reports:
-        result.append({
-            'id': r['id'],
-            'cat_id': r['cat_id'],
-            'type': r['type'],
-            'severity': r['severity'],
-            'note': r['note'],
-            'photos': json.loads(r['photos']) if r['photos'] else [],
-            'reporter': r['reporter'],
-            'ts': r['ts'],
-            'status': r['status']
-        })
+    result = [serialize_health_report(r) for r in reports]
     
     return jsonify(result)
 
 # ---------- 投喂记录 API ----------
-@app.route('/api/feed_logs', methods=['POST'])
+@api.route('/api/feed_logs', methods=['POST'])
 def create_feed_log():
     """创建投喂记录"""
     data = request.json
     
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO feed_logs 
+    log_id = db.insert(conn, '''INSERT INTO feed_logs
         (cat_id, food, qty, note, reporter, ts)
         VALUES (?, ?, ?, ?, ?, ?)''',
         (
@@ -885,14 +1494,12 @@ def create_feed_log():
             data.get('reporter', 'anonymous'),
             int(time.time())
         ))
-    
-    log_id = cursor.lastrowid
     conn.commit()
     conn.close()
     
     return jsonify({"id": log_id, "message": "Feed log created successfully"}), 201
 
-@app.route('/api/feed_logs', methods=['GET'])
+@api.route('/api/feed_logs', methods=['GET'])
 def get_feed_logs():
     """获取投喂记录"""
     cat_id = request.args.get('cat_id')
@@ -907,18 +1514,248 @@ def get_feed_logs():
     result = [dict(log) for log in logs]
     return jsonify(result)
 
+# ---------- 批量上报 API ----------
+# 志愿者手机离线时把记录排队，联网后一次提交一批：
+#   POST /api/<资源>/batch  {"items": [{..., "idempotency_key": "客户端生成的唯一键"}, ...]}
+# 整批在一个事务里用 executemany 写入（健康上报对应的事件也在同一事务里），
+# 带相同幂等键的重试不会重复写入，而是返回第一次写入的 id。
+BATCH_MAX_ITEMS = int(os.environ.get('CATHUB_BATCH_MAX_ITEMS', 500))
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('CATHUB_IDEMPOTENCY_TTL_DAYS', 7)) * 86400
+
+class BatchItemError(ValueError):
+    """单条记录无效，只影响这一条，不影响整批"""
+
+def _item_ts(item, now):
+    """离线记录保留客户端的时间戳（秒），没有时使用服务器时间"""
+    ts = item.get('ts')
+    if ts is None:
+        return now
+    if isinstance(ts, bool) or not isinstance(ts, int):
+        raise BatchItemError('ts must be an integer (seconds)')
+    return ts
+
+def _sighting_row(item, now):
+    return (
+        item.get('cat_id'),
+        item.get('photo'),
+        item.get('location'),
+        item.get('similarity'),
+        item.get('device'),
+        item.get('reporter', 'anonymous'),
+        _item_ts(item, now)
+    )
+
+def _feed_log_row(item, now):
+    return (
+        item.get('cat_id'),
+        item.get('food'),
+        item.get('qty'),
+        item.get('note'),
+        item.get('reporter', 'anonymous'),
+        _item_ts(item, now)
+    )
+
+def _health_report_row(item, now):
+    return (
+        item.get('cat_id'),
+        item.get('type'),
+        item.get('severity'),
+        item.get('note'),
+        json.dumps(item.get('photos', []), ensure_ascii=False),
+        item.get('reporter', 'anonymous'),
+        _item_ts(item, now),
+        item.get('status', 'pending')
+    )
+
+def _health_report_event(item, cat_names):
+    cat_name = cat_names.get(item.get('cat_id'), '未知猫咪')
+    return event_row(
+        event_type='health_report',
+        cat_id=item.get('cat_id'),
+        cat_name=cat_name,
+        title=health_report_title(cat_name, item.get('type', 'other'), item.get('severity')),
+        description=item.get('note', ''),
+        location=item.get('location'),
+        latitude=item.get('latitude'),
+        longitude=item.get('longitude')
+    )
+
+def _cat_names(conn, cat_ids):
+    cat_ids = list({cid for cid in cat_ids if cid is not None})
+    if not cat_ids:
+        return {}
+    placeholders = ','.join('?' * len(cat_ids))
+    rows = conn.execute(f'SELECT id, name FROM cats WHERE id IN ({placeholders})', cat_ids).fetchall()
+    return {row['id']: row['name'] for row in rows}
+
+def ingest_batch(kind, insert_sql, build_row, build_event=None):
+    """批量写入一种记录，返回逐条结果
+
+    每条结果为 {"index", "status": created|duplicate|error, "id" 或 "error"}。
+    无效记录只标记为 error，其余记录照常写入。
+    """
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return jsonify({"error": "Expected a JSON array or {\"items\": [...]}"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items (max {BATCH_MAX_ITEMS})"}), 413
+
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {"index": index, "status": "error", "error": "Item must be an object"}
+            continue
+        key = item.get('idempotency_key')
+        if key is not None and (not isinstance(key, str) or not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH):
+            results[index] = {"index": index, "status": "error",
+                              "error": f"idempotency_key must be a non-empty string of at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters"}
+            continue
+        pending.append((index, key, item))
+
+    now = int(time.time())
+    try:
+        # 先拿写锁（PostgreSQL 下锁住幂等键）再查幂等键，避免两个并发重试都认为自己是第一次
+        with span('batch_insert', kind=kind, items=len(items)), unit_of_work() as conn:
+            conn.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (now - IDEMPOTENCY_TTL_SECONDS,))
+
+            keys = [key for _, key, _ in pending if key]
+            existing = {}
+            if keys:
+                # PostgreSQL 下并发的事务可以同时执行到这里，同一个幂等键只让一个事务往下走
+                db.lock_names(conn, [f'idempotency:{kind}:{key}' for key in keys])
+                placeholders = ','.join('?' * len(keys))
+                rows = conn.execute(
+                    f'SELECT key, record_id FROM idempotency_keys WHERE kind = ? AND key IN ({placeholders})',
+                    [kind] + keys).fetchall()
+                existing = {row['key']: row['record_id'] for row in rows}
+
+            to_insert = []
+            repeats = []  # 同一批里重复出现的幂等键
+            first_index = {}
+            for index, key, item in pending:
+                if key in existing:
+                    results[index] = {"index": index, "status": "duplicate", "id": existing[key]}
+                    continue
+                if key and key in first_index:
+                    repeats.append((index, first_index[key]))
+                    continue
+                try:
+                    row = build_row(item, now)
+                except BatchItemError as e:
+                    results[index] = {"index": index, "status": "error", "error": str(e)}
+                    continue
+                if key:
+                    first_index[key] = index
+                to_insert.append((index, key, item, row))
+
+            if to_insert:
+                ids = db.insert_many(conn, insert_sql, [row for _, _, _, row in to_insert])
+                for (index, _, _, _), record_id in zip(to_insert, ids):
+                    results[index] = {"index": index, "status": "created", "id": record_id}
+
+                conn.executemany(
+                    'INSERT INTO idempotency_keys (kind, key, record_id, created_at) VALUES (?, ?, ?, ?)',
+                    [(kind, key, results[index]['id'], now) for index, key, _, _ in to_insert if key])
+
+                if build_event:
+                    cat_names = _cat_names(conn, [item.get('cat_id') for _, _, item, _ in to_insert])
+                    conn.executemany(EVENT_INSERT_SQL,
+                                     [build_event(item, cat_names) for _, _, item, _ in to_insert])
+    except Exception as e:
+        logger.exception("批量写入失败", extra={'kind': kind, 'items': len(items)})
+        return jsonify({"error": str(e)}), 500
+
+    for index, original in repeats:
+        results[index] = {"index": index, "status": "duplicate", "id": results[original]['id']}
+
+    summary = {status: sum(1 for r in results if r['status'] == status)
+               for status in ('created', 'duplicate', 'error')}
+    # summary 的键 created 与 LogRecord 的内置属性同名，不能直接作为 extra
+    logger.info("批量写入完成", extra={'kind': kind, **{f'{k}_count': v for k, v in summary.items()}})
+    return jsonify({"results": results, **summary})
+
+@api.route('/api/sightings/batch', methods=['POST'])
+def create_sightings_batch():
+    """批量创建目击记录"""
+    return ingest_batch('sighting', '''INSERT INTO sightings
+        (cat_id, photo, location, similarity, device, reporter, ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?)''', _sighting_row)
+
+@api.route('/api/feed_logs/batch', methods=['POST'])
+def create_feed_logs_batch():
+    """批量创建投喂记录"""
+    return ingest_batch('feed_log', '''INSERT INTO feed_logs
+        (cat_id, food, qty, note, reporter, ts)
+        VALUES (?, ?, ?, ?, ?, ?)''', _feed_log_row)
+
+@api.route('/api/health_reports/batch', methods=['POST'])
+def create_health_reports_batch():
+    """批量创建健康上报（同时在同一事务中创建对应事件）"""
+    return ingest_batch('health_report', '''INSERT INTO health_reports
+        (cat_id, type, severity, note, photos, reporter, ts, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', _health_report_row, _health_report_event)
+
 # ---------- 照片访问 ----------
-@app.route('/uploads/<path:filename>')
+@api.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    """访问上传的照片"""
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    """访问上传的照片（缓存头、ETag、Range 和代理卸载见 photo_serving.py）"""
+    state = current_state()
+    return photo_serving.send_photo(state.storage, filename, state.photo_slots, state.config.photo_queue_seconds)
 
 # ---------- 事件 API ----------
-@app.route('/api/events', methods=['GET'])
+EVENTS_MAX_LIMIT = 500
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('CATHUB_SSE_HEARTBEAT_SECONDS', 15))
+# 单个 SSE 连接的最长时间，到期后客户端带 Last-Event-ID 自动重连，避免长期占用 worker 线程
+SSE_MAX_SECONDS = float(os.environ.get('CATHUB_SSE_MAX_SECONDS', 300))
+# 本进程的 SSE 连接数已满时建议客户端等待的秒数
+SSE_BUSY_RETRY_AFTER = 5
+
+def serialize_event(event):
+    return {
+        'id': event['id'],
+        'event_type': event['event_type'],
+        'cat_id': event['cat_id'],
+        'cat_name': event['cat_name'],
+        'title': event['title'],
+        'description': event['description'],
+        'location': event['location'],
+        'latitude': event['latitude'],
+        'longitude': event['longitude'],
+        'created_at': event['created_at']
+    }
+
+def fetch_events_since(since_id, limit, database=None):
+    """id 大于 since_id 的事件，按 id 升序（主键范围查询）"""
+    conn = get_db(database)
+    try:
+        events = conn.execute('SELECT * FROM events WHERE id > ? ORDER BY id LIMIT ?', (since_id, limit)).fetchall()
+    finally:
+        conn.close()
+    return [serialize_event(event) for event in events]
+
+def latest_event_id(database=None):
+    conn = get_db(database)
+    try:
+        return conn.execute('SELECT MAX(id) FROM events').fetchone()[0] or 0
+    finally:
+        conn.close()
+
+@api.route('/api/events', methods=['GET'])
 def get_events():
-    """获取事件列表"""
+    """获取事件列表
+
+    带 since_id 时只返回 id 更大的新事件（按 id 升序，最多 limit 条），客户端记住最大 id 作为下次的游标。
+    """
     try:
-        limit = request.args.get('limit', 20, type=int)
+        # SQLite 的 LIMIT -1 表示不限制，下限为 1
+        limit = min(max(request.args.get('limit', 20, type=int), 1), EVENTS_MAX_LIMIT)
+        since_id = request.args.get('since_id', type=int)
+
+        if since_id is not None:
+            return jsonify(fetch_events_since(since_id, limit))
 
         conn = get_db()
         events = conn.execute(
@@ -927,46 +1764,414 @@ def get_events():
         ).fetchall()
         conn.close()
 
-        result = []
-        for event in events:
-            result.append({
-                'id': event['id'],
-                'event_type': event['event_type'],
-                'cat_id': event['cat_id'],
-                'cat_name': event['cat_name'],
-                'title': event['title'],
-                'description': event['description'],
-                'location': event['location'],
-                'latitude': event['latitude'],
-                'longitude': event['longitude'],
-                'created_at': event['created_at']
-            })
-
-        return jsonify(result)
+        return jsonify([serialize_event(event) for event in events])
     except Exception as e:
-        print(f"❌ 获取事件失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("获取事件失败")
         return jsonify({"error": str(e)}), 500
 
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'  # 关闭 nginx 缓冲，事件立即送达
+}
+
+def sse_message(event):
+    return f"id: {event['id']}\nevent: event\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+@api.route('/api/events/stream', methods=['GET'])
+def stream_events():
+    """通过 Server-Sent Events 推送新事件
+
+    从 Last-Event-ID 请求头（断线重连时浏览器/客户端自动带上）或 since_id 参数之后开始；
+    都没有时只推送连接之后产生的事件。每个连接占一个 worker 线程，本进程的连接数达到
+    sse_max_subscribers 时返回 503 和 Retry-After，其余线程留给普通接口（ASGI 入口不占线程，见 asgi.py）。
+    """
+    # 生成器在请求上下文结束后执行，提前取出应用的事件源和数据库
+    state = current_state()
+    event_feed = state.event_feed
+    if not event_feed.subscribe():
+        response = jsonify({"error": "too many event streams, retry later", "retry_after": SSE_BUSY_RETRY_AFTER})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_BUSY_RETRY_AFTER)
+        return response
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = request.args.get('since_id', type=int)
+    if cursor is None:
+        cursor = event_feed.latest_id()
+
+    def generate(last_id):
+        yield f"retry: 3000\n\n"
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        while time.monotonic() < deadline:
+            events = event_feed.wait_for(last_id, SSE_HEARTBEAT_SECONDS)
+            if events is None:
+                # 落后于内存缓冲区，直接从数据库补齐
+                events = fetch_events_since(last_id, EVENTS_MAX_LIMIT, state.database)
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                yield sse_message(event)
+            last_id = events[-1]['id']
+
+    response = Response(generate(cursor), mimetype='text/event-stream', headers=SSE_HEADERS)
+    # 服务器关闭响应时退订（生成器还没开始执行、客户端就断开时也会调用）
+    response.call_on_close(event_feed.unsubscribe)
+    return response
+
+# ---------- 附近查询 API ----------
+EARTH_RADIUS_M = 6371008.8
+NEARBY_DEFAULT_RADIUS_M = 1000
+NEARBY_MAX_RADIUS_M = 50000
+NEARBY_MAX_LIMIT = 500
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """两点间的大圆距离（米）"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+def bounding_box(lat, lng, radius_m):
+    """覆盖以 (lat, lng) 为圆心、radius_m 为半径的圆的经纬度矩形"""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    cos_lat = math.cos(math.radians(lat))
+    # 靠近两极时经度跨度趋于无穷，直接取全部经度
+    dlng = 180.0 if cos_lat < 1e-6 else min(180.0, math.degrees(radius_m / (EARTH_RADIUS_M * cos_lat)))
+    return max(-90.0, lat - dlat), min(90.0, lat + dlat), max(-180.0, lng - dlng), min(180.0, lng + dlng)
+
+def geo_index_available(conn):
+    state = current_state()
+    if state.geo_index_available is None:
+        state.geo_index_available = db.table_exists(conn, 'events_geo')
+    return state.geo_index_available
+
+def _nearby_args():
+    """解析 lat、lng、radius_m、limit 参数，出错时返回 (None, 错误响应)"""
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius_m = request.args.get('radius_m', NEARBY_DEFAULT_RADIUS_M, type=float)
+    limit = request.args.get('limit', 50, type=int)
+    if lat is None or lng is None or not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        return None, (jsonify({"error": "lat and lng are required and must be valid coordinates"}), 400)
+    if not 0 < radius_m <= NEARBY_MAX_RADIUS_M:
+        return None, (jsonify({"error": f"radius_m must be between 0 and {NEARBY_MAX_RADIUS_M}"}), 400)
+    return (lat, lng, radius_m, max(1, min(limit, NEARBY_MAX_LIMIT))), None
+
+def nearest_ids(conn, table, lat_column, lng_column, lat, lng, radius_m, limit=None):
+    """半径内各行的 [(距离, id)]，由近到远，limit 为 None 时返回全部
+
+    用空间索引（或经纬度范围）只取出外接矩形内各点的 id 和坐标，在 Python 中按 haversine 距离精确过滤。
+    """
+    box = bounding_box(lat, lng, radius_m)
+    if geo_index_available(conn):
+        candidates = conn.execute(f'''SELECT id, min_lat, min_lng FROM {table}_geo
+            WHERE min_lat >= ? AND max_lat <= ? AND min_lng >= ? AND max_lng <= ?''', box).fetchall()
+    else:
+        candidates = conn.execute(f'''SELECT id, {lat_column}, {lng_column} FROM {table}
+            WHERE {lat_column} BETWEEN ? AND ? AND {lng_column} BETWEEN ? AND ?''', box).fetchall()
+
+    within = []
+    for row_id, row_lat, row_lng in candidates:
+        distance = haversine_m(lat, lng, row_lat, row_lng)
+        if distance <= radius_m:
+            within.append((distance, row_id))
+    if limit is None:
+        return sorted(within)
+    return heapq.nsmallest(limit, within)
+
+def query_nearby(conn, table, lat_column, lng_column, lat, lng, radius_m, limit):
+    """查询半径内最近的 limit 行，返回 [(距离, 行)]（由近到远），只为最近的这些 id 读取整行"""
+    nearest = nearest_ids(conn, table, lat_column, lng_column, lat, lng, radius_m, limit)
+    if not nearest:
+        return []
+
+    ids = [row_id for _, row_id in nearest]
+    placeholders = ','.join('?' * len(ids))
+    rows = {row['id']: row for row in conn.execute(f'SELECT * FROM {table} WHERE id IN ({placeholders})', ids)}
+    # R*Tree 以 32 位浮点存坐标，返回的距离用原表中的精确坐标重新计算
+    return [(haversine_m(lat, lng, rows[row_id][lat_column], rows[row_id][lng_column]), rows[row_id])
+            for _, row_id in nearest if row_id in rows]
+
+@api.route('/api/cats/nearby', methods=['GET'])
+def get_nearby_cats():
+    """按最后出没位置查询附近的猫咪，由近到远"""
+    args, error = _nearby_args()
+    if error:
+        return error
+    lat, lng, radius_m, limit = args
+
+    conn = get_db()
+    try:
+        nearby = query_nearby(conn, 'cats', 'last_seen_latitude', 'last_seen_longitude', lat, lng, radius_m, limit)
+    finally:
+        conn.close()
+
+    result = []
+    for distance, cat in nearby:
+        item = serialize_cat(cat)
+        item['distance_m'] = round(distance, 1)
+        result.append(item)
+    return jsonify(result)
+
+@api.route('/api/events/nearby', methods=['GET'])
+def get_nearby_events():
+    """查询附近发生的事件，由近到远"""
+    args, error = _nearby_args()
+    if error:
+        return error
+    lat, lng, radius_m, limit = args
+
+    conn = get_db()
+    try:
+        nearby = query_nearby(conn, 'events', 'latitude', 'longitude', lat, lng, radius_m, limit)
+    finally:
+        conn.close()
+
+    result = []
+    for distance, event in nearby:
+        item = serialize_event(event)
+        item['distance_m'] = round(distance, 1)
+        result.append(item)
+    return jsonify(result)
+
+# ---------- 统计 API ----------
+STATS_DEFAULT_RANGE_SECONDS = 7 * 86400
+
+@api.route('/api/stats', methods=['GET'])
+def get_stats():
+    """按时间范围查询汇总统计
+
+    参数：
+    - metric：feed / sighting / health_report，或 open_health_reports（未处理的健康上报按严重程度计数）
+    - interval：hour / day（默认 day）
+    - from、to：时间范围（秒，左闭右开），默认最近 7 天
+    - cat_id：只统计某只猫
+    - by：按 cat 和/或 severity 细分，逗号分隔
+    - hour_of_day=1：把小时桶折叠为 0-23 点（需要 interval=hour），用于出没时段热力图
+    """
+    metric = request.args.get('metric')
+    conn = get_db()
+    try:
+        if metric == 'open_health_reports':
+            return jsonify({"metric": metric, "by_severity": stats.open_health_reports(conn)})
+        if metric not in stats.METRICS:
+            return jsonify({"error": f"metric must be one of: {', '.join(list(stats.METRICS) + ['open_health_reports'])}"}), 400
+
+        interval = request.args.get('interval', 'day')
+        if interval not in stats.INTERVALS:
+            return jsonify({"error": "interval must be hour or day"}), 400
+        hour_of_day = request.args.get('hour_of_day') in ('1', 'true')
+        if hour_of_day and interval != 'hour':
+            return jsonify({"error": "hour_of_day requires interval=hour"}), 400
+
+        end = request.args.get('to', int(time.time()), type=int)
+        start = request.args.get('from', end - STATS_DEFAULT_RANGE_SECONDS, type=int)
+        if start >= end:
+            return jsonify({"error": "from must be earlier than to"}), 400
+        by = {b.strip() for b in request.args.get('by', '').split(',') if b.strip()}
+        if by - {'cat', 'severity'}:
+            return jsonify({"error": "by accepts cat and severity"}), 400
+
+        series = stats.query_series(
+            conn, metric, interval, start, end,
+            cat_id=request.args.get('cat_id', type=int),
+            by_cat='cat' in by, by_dim='severity' in by, hour_of_day=hour_of_day)
+    finally:
+        conn.close()
+
+    return jsonify({
+        "metric": metric,
+        "interval": interval,
+        "from": start,
+        "to": end,
+        "series": series
+    })
+
+@api.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """根据明细表重建统计汇总（导入历史数据或修改时区后执行）：flask --app server rebuild-stats"""
+    ensure_db()
+    start = time.time()
+    with unit_of_work() as conn:
+        stats.rebuild_stats(conn)
+        rows = sum(conn.execute(f'SELECT COUNT(*) FROM {rollup}').fetchone()[0]
+                   for rollup, _ in stats.INTERVALS.values())
+    logger.info("统计汇总已重建", extra={'rows': rows, 'elapsed_s': round(time.time() - start, 2)})
+
+@api.cli.command('gc-photos')
+@click.option('--grace-hours', type=float, default=photo_store.GC_GRACE_SECONDS / 3600,
+              help='没有引用的照片至少保留的小时数')
+def gc_photos_command(grace_hours):
+    """重算照片引用计数并删除没有引用的照片：flask --app server gc-photos"""
+    ensure_db()
+    with unit_of_work() as conn:
+        photo_store.rebuild_refs(conn)
+    state = current_state()
+    photo_store.collect_garbage(functools.partial(unit_of_work, state.database), state.storage,
+                                grace_seconds=int(grace_hours * 3600))
+
+@api.cli.command('migrate-photos')
+@click.option('--source', default=None, help='本地上传目录（默认为 CATHUB_UPLOAD_FOLDER）')
+def migrate_photos_command(source):
+    """把本地上传目录里的照片复制到当前存储后端（切换到 s3 时执行一次）：flask --app server migrate-photos"""
+    state = current_state()
+    storage = state.storage
+    source = source or state.config.upload_folder
+    if storage.is_local and os.path.abspath(source) == os.path.abspath(storage.root):
+        logger.info("存储后端就是本地上传目录，不需要迁移")
+        return
+    copied = skipped = 0
+    for dirpath, _, names in os.walk(source):
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(dirpath, name)
+            key = os.path.relpath(path, source).replace(os.sep, '/')
+            if storage.stat(key) is not None:
+                skipped += 1
+                continue
+            with open(path, 'rb') as f:
+                storage.put(key, f.read())
+            copied += 1
+    logger.info("照片迁移完成", extra={'storage': storage.name, 'copied': copied, 'skipped': skipped})
+
+# ==================== 全文搜索 ====================
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+def search_index_available(conn):
+    """本应用的数据库是否有 FTS5 索引（每个应用各自缓存，见 search.fts_available）"""
+    state = current_state()
+    if state.search_index_available is None:
+        state.search_index_available = search.fts_available(conn)
+    return state.search_index_available
+
+@api.route('/api/search', methods=['GET'])
+def search_all():
+    """全文搜索猫咪档案或事件
+
+    参数：
+    - q：搜索词，多个词用空格分隔（同时包含）；3 个字及以上的词走全文索引并按相关度排序
+    - type：cats / events（默认 cats）
+    - limit、offset：分页（limit 默认 20，最大 100）
+    """
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({"error": "q is required"}), 400
+    kind = request.args.get('type', 'cats')
+    if kind not in search.INDEXES:
+        return jsonify({"error": "type must be cats or events"}), 400
+    limit = min(max(request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int), 1), SEARCH_MAX_LIMIT)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+
+    conn = get_db()
+    try:
+        rows, has_more = search.search(conn, kind, q, limit, offset, search_index_available(conn))
+    finally:
+        conn.close()
+
+    serialize = serialize_cat if kind == 'cats' else serialize_event
+    return jsonify({
+        "type": kind,
+        "query": q,
+        "items": [serialize(row) for row in rows],
+        "limit": limit,
+        "offset": offset,
+        "has_more": has_more
+    })
+
+# ==================== 增量同步 ====================
+SYNC_DEFAULT_LIMIT = 500
+SYNC_MAX_LIMIT = 2000
+
+@api.route('/api/sync', methods=['GET'])
+def sync_changes():
+    """离线客户端增量同步
+
+    参数：
+    - since：上次同步返回的 token，首次同步不传（或传 0）即从头拉取全部数据
+    - limit：本次最多返回多少条变化（默认 500，最大 2000），has_more 为 true 时用新 token 继续拉取
+
+    返回 token（下次同步使用）、has_more、upserts（{表: [记录]}，新建或修改过的记录）
+    和 deletes（{表: [id]}，已删除的记录）；没有变化的表不出现在结果里。
+    token 比服务器当前的序号还新（例如数据库被恢复过）时返回 410，客户端应清空本地数据并从头同步。
+    """
+    since = request.args.get('since', '0') or '0'
+    if not since.isdigit():
+        return jsonify({"error": "since must be a token returned by /api/sync"}), 400
+    since = int(since)
+    limit = min(max(request.args.get('limit', SYNC_DEFAULT_LIMIT, type=int), 1), SYNC_MAX_LIMIT)
+
+    conn = get_db()
+    try:
+        if since and since > sync.latest_seq(conn):
+            return jsonify({"error": "sync token is no longer valid, resync from scratch", "token": "0"}), 410
+        upserts, deletes, last_seq, has_more = sync.changes_since(conn, since, limit)
+    finally:
+        conn.close()
+
+    serializers = {
+        'cats': serialize_cat,
+        'sightings': dict,
+        'feed_logs': dict,
+        'health_reports': serialize_health_report,
+        'events': serialize_event
+    }
+    return jsonify({
+        "token": str(last_seq),
+        "has_more": has_more,
+        "upserts": {entity: [serializers[entity](row) for row in rows] for entity, rows in upserts.items()},
+        "deletes": deletes
+    })
+
+# ==================== 应用工厂和生命周期 ====================
+def create_app(config=None):
+    """按 config（默认 Config.from_env()）创建应用
+
+    只创建对象，不访问数据库和文件系统；一次性的初始化在 startup 中执行。
+    同一个进程里可以创建多个互相隔离的应用（各自的数据库、存储、缓存和写后队列）。
+    """
+    config = config or Config.from_env()
+    flask_app = Flask(__name__)
+    CORS(flask_app)  # 允许跨域访问
+    flask_app.config['MAX_CONTENT_LENGTH'] = config.max_content_length
+    flask_app.config['UPLOAD_FOLDER'] = config.upload_folder
+    flask_app.extensions['cathub'] = AppState(config)
+    flask_app.register_blueprint(api)
+    return flask_app
+
+def prepare(flask_app):
+    """设置指标快照目录、创建照片目录、清理已退出进程的并发名额并初始化/迁移数据库（可以重复调用，已是最新版本时很快返回）"""
+    state = flask_app.extensions['cathub']
+    metrics.configure(state.metrics_dir)
+    state.storage.prepare()
+    state.admission.prepare()
+    ensure_db(state)
+
+def startup(flask_app):
+    """部署启动时执行一次：打印配置、执行 prepare 并把已退出进程的指标快照并入累计值
+
+    gunicorn 由 gunicorn.conf.py 的 on_starting 在主进程中调用，__main__ 在开始服务前调用；
+    其他启动方式（flask run、测试客户端）在第一个请求前自动执行 ensure_db。
+    """
+    print_startup_info(flask_app.extensions['cathub'])
+    prepare(flask_app)
+    metrics.collect_exited()
+
+def shutdown(flask_app):
+    """退出前刷完应用的写后队列并关闭连接池（gunicorn 的 worker_exit、ASGI lifespan 调用）"""
+    state = flask_app.extensions['cathub']
+    state.deferred_writes.close()
+    state.database.close_pool()
+
+# WSGI 入口 server:app，按环境变量配置
+app = create_app()
+
 # ==================== 启动服务器 ====================
 if __name__ == '__main__':
-    init_db()
+    startup(app)
     port = int(os.environ.get('PORT', 5000))
-    print("=" * 50)
-    print("🐱 Cathub 后端服务器启动中...")
-    print("=" * 50)
-    print("📡 API 地址: http://localhost:{port}")
-    print("📝 API 文档:")
-    print("   GET  /api/health - 健康检查")
-    print("   GET  /api/cats - 获取所有猫咪")
-    print("   POST /api/cats - 创建猫咪档案")
-    print("   GET  /api/cats/<id> - 获取猫咪详情")
-    print("   PUT  /api/cats/<id> - 更新猫咪档案")
-    print("   POST /api/cats/<id>/photos - 上传照片")
-    print("   POST /api/sightings - 创建目击记录")
-    print("   POST /api/health_reports - 创建健康上报")
-    print("   POST /api/feed_logs - 创建投喂记录")
-    print("=" * 50)
+    logger.info("Cathub 后端服务器启动中", extra={'url': f"http://localhost:{port}"})
     app.run(host='0.0.0.0', port=port, debug=False)
-
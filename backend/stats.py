@@ -0,0 +1,137 @@
+"""
+统计汇总（rollup）
+- stats_hourly / stats_daily：按 (指标, 时间桶, 猫, 维度) 计数，指标为 feed / sighting / health_report，
+  健康上报的维度是严重程度，其余为空字符串
+- stats_open_health_reports：未处理的健康上报按严重程度计数
+- 全部由触发器在插入（以及删除、修改状态）时增量维护，单条接口、批量上报和直接写库的脚本都会触发；
+  /api/stats 只读这几张小表，不再对明细表做 GROUP BY
+- 按天分桶使用 STATS_UTC_OFFSET_HOURS（默认 +8，北京时间）的自然日；修改后需要执行一次重建
+- SQLite 和 PostgreSQL 共用同一套触发器语句（见 db.create_trigger）
+"""
+import os
+
+import db
+
+STATS_UTC_OFFSET_HOURS = int(os.environ.get('CATHUB_STATS_UTC_OFFSET_HOURS', 8))
+
+# 指标 -> (明细表, 维度表达式)，{row} 在触发器中替换为 new / old
+METRICS = {
+    'feed': ('feed_logs', "''"),
+    'sighting': ('sightings', "''"),
+    'health_report': ('health_reports', "COALESCE({row}.severity, '')"),
+}
+INTERVALS = {
+    'hour': ('stats_hourly', '{ts} - {ts} % 3600'),
+    'day': ('stats_daily', '{ts} - ({ts} + {offset}) % 86400'),
+}
+# 状态为这些值之外的健康上报都算未处理
+CLOSED_HEALTH_STATUSES = ('resolved', 'closed')
+
+def _bucket_expr(interval, ts):
+    return INTERVALS[interval][1].format(ts=ts, offset=STATS_UTC_OFFSET_HOURS * 3600)
+
+def _is_open(row):
+    closed = ', '.join(f"'{s}'" for s in CLOSED_HEALTH_STATUSES)
+    return f"({row}.status IS NULL OR {row}.status NOT IN ({closed}))"
+
+def _rollup_triggers():
+    triggers = {}
+    for metric, (table, dim) in METRICS.items():
+        inserts, deletes = [], []
+        for interval, (rollup, _) in INTERVALS.items():
+            inserts.append(f'''INSERT INTO {rollup} (metric, bucket, cat_id, dim, count)
+            VALUES ('{metric}', {_bucket_expr(interval, 'new.ts')}, COALESCE(new.cat_id, 0), {dim.format(row='new')}, 1)
+            ON CONFLICT (metric, bucket, cat_id, dim) DO UPDATE SET count = {rollup}.count + 1;''')
+            deletes.append(f'''UPDATE {rollup} SET count = count - 1
+            WHERE metric = '{metric}' AND bucket = {_bucket_expr(interval, 'old.ts')}
+              AND cat_id = COALESCE(old.cat_id, 0) AND dim = {dim.format(row='old')};''')
+        triggers[f'{table}_stats_insert'] = ('AFTER INSERT', table, 'new.ts IS NOT NULL', '\n'.join(inserts))
+        triggers[f'{table}_stats_delete'] = ('AFTER DELETE', table, 'old.ts IS NOT NULL', '\n'.join(deletes))
+
+    increment = '''INSERT INTO stats_open_health_reports (severity, count) VALUES (COALESCE(new.severity, ''), 1)
+        ON CONFLICT (severity) DO UPDATE SET count = stats_open_health_reports.count + 1;'''
+    decrement = '''UPDATE stats_open_health_reports SET count = count - 1 WHERE severity = COALESCE(old.severity, '');'''
+    update = 'AFTER UPDATE OF status, severity'
+    triggers['health_reports_open_insert'] = ('AFTER INSERT', 'health_reports', _is_open('new'), increment)
+    triggers['health_reports_open_delete'] = ('AFTER DELETE', 'health_reports', _is_open('old'), decrement)
+    triggers['health_reports_open_update_old'] = (update, 'health_reports', _is_open('old'), decrement)
+    triggers['health_reports_open_update_new'] = (update, 'health_reports', _is_open('new'), increment)
+    return triggers
+
+def init_stats(c):
+    """创建汇总表和触发器，并根据明细表重建一次（数据库迁移时调用）"""
+    for rollup, _ in INTERVALS.values():
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {rollup} (
+            metric TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            cat_id INTEGER NOT NULL,
+            dim TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (metric, bucket, cat_id, dim)
+        ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_open_health_reports (
+        severity TEXT PRIMARY KEY,
+        count INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+    rebuild_stats(c)
+
+def rebuild_stats(c):
+    """重新创建触发器并根据明细表重算所有汇总（调用方负责事务）"""
+    for name, (event, table, when, body) in _rollup_triggers().items():
+        db.create_trigger(c, name, event, table, body, when)
+
+    for rollup, _ in INTERVALS.values():
+        c.execute(f'DELETE FROM {rollup}')
+    c.execute('DELETE FROM stats_open_health_reports')
+
+    for metric, (table, dim) in METRICS.items():
+        for interval, (rollup, _) in INTERVALS.items():
+            c.execute(f'''INSERT INTO {rollup} (metric, bucket, cat_id, dim, count)
+                SELECT '{metric}', {_bucket_expr(interval, 'ts')} AS b, COALESCE(cat_id, 0) AS cid,
+                       {dim.format(row=table)} AS d, COUNT(*)
+                FROM {table} WHERE ts IS NOT NULL
+                GROUP BY b, cid, d''')
+    c.execute(f'''INSERT INTO stats_open_health_reports (severity, count)
+        SELECT COALESCE(severity, '') AS s, COUNT(*) FROM health_reports
+        WHERE {_is_open('health_reports')} GROUP BY s''')
+
+def query_series(conn, metric, interval, start, end, cat_id=None, by_cat=False, by_dim=False, hour_of_day=False):
+    """从汇总表查询 [start, end) 时间范围内的计数
+
+    返回 [{'bucket', 'count', ['cat_id'], ['severity']}]；hour_of_day 为 True 时把小时桶折叠为 0-23 点（热力图）。
+    """
+    rollup = INTERVALS[interval][0]
+    if hour_of_day:
+        bucket = f'((bucket + {STATS_UTC_OFFSET_HOURS * 3600}) % 86400) / 3600'
+    else:
+        bucket = 'bucket'
+    columns = [f'{bucket} AS bucket']
+    if by_cat:
+        columns.append('cat_id')
+    if by_dim:
+        columns.append('dim')
+    # PostgreSQL 的 SUM 返回 numeric，转换回整数
+    sql = (f'SELECT {", ".join(columns)}, CAST(SUM(count) AS BIGINT) AS total FROM {rollup} '
+           f'WHERE metric = ? AND bucket >= ? AND bucket < ?')
+    params = [metric, start, end]
+    if cat_id is not None:
+        sql += ' AND cat_id = ?'
+        params.append(cat_id)
+    # 按位置分组：折叠后的别名 bucket 与表中的 bucket 列同名，GROUP BY bucket 会取到原列
+    group = ', '.join(str(i + 1) for i in range(len(columns)))
+    sql += f' GROUP BY {group} HAVING SUM(count) > 0 ORDER BY {group}'
+
+    result = []
+    for row in conn.execute(sql, params):
+        item = {'bucket': row['bucket'], 'count': row['total']}
+        if by_cat:
+            item['cat_id'] = row['cat_id'] or None
+        if by_dim:
+            item['severity'] = row['dim'] or None
+        result.append(item)
+    return result
+
+def open_health_reports(conn):
+    """未处理的健康上报数，按严重程度"""
+    rows = conn.execute('SELECT severity, count FROM stats_open_health_reports WHERE count > 0').fetchall()
+    return {(row['severity'] or 'unknown'): row['count'] for row in rows}
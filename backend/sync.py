@@ -0,0 +1,121 @@
+"""
+增量同步（离线优先的移动端）
+- changes 表记录每条记录最近一次变化的序号：插入、修改、删除时由触发器写入，
+  单条接口、批量上报、写后队列和直接写库的脚本都会记录
+- 每条记录只保留一行（同一条记录再次变化时删除旧行、以新序号插入），changes 的大小与数据量同级；
+  删除的记录保留为墓碑（deleted = 1），客户端据此删除本地副本
+- 序号是 AUTOINCREMENT 主键：SQLite 同一时间只有一个写事务，序号按提交顺序递增，
+  客户端用上次拿到的最大序号作为 token，不会漏掉之后提交的变化
+- PostgreSQL 的写事务是并发的，先分配的序号可能后提交，读到大序号时小序号还不可见。
+  触发器只把序号置空，由延迟到提交时执行的约束触发器在 advisory lock 下分配，序号同样按提交顺序递增
+- 每张表最近一次变化的序号（entity_version）可以作为这张表的数据版本：
+  任何实例写入后版本前进，各实例的查询缓存据此失效（见 server.py 的猫咪列表缓存）
+"""
+import db
+
+# 参与同步的表，按客户端应用的顺序排列（先猫咪档案，再引用它的记录）
+ENTITIES = ('cats', 'sightings', 'feed_logs', 'health_reports', 'events')
+
+# SQLite 单条语句的参数上限较低（旧版本为 999），按 id 回表时分段查询
+_ID_CHUNK = 500
+
+# 分配序号时持有的 advisory lock（PostgreSQL）
+SEQ_LOCK_KEY = db.advisory_key('changes_seq')
+
+def _now_sql(dialect):
+    if dialect == 'postgres':
+        return 'CAST(extract(epoch FROM now()) AS BIGINT)'
+    return "CAST(strftime('%s', 'now') AS INTEGER)"
+
+def _change_sql(entity, row, deleted, dialect):
+    if dialect == 'postgres':
+        return f'''INSERT INTO changes (entity, entity_id, seq, deleted, changed_at)
+            VALUES ('{entity}', {row}.id, NULL, {deleted}, {_now_sql(dialect)})
+            ON CONFLICT (entity, entity_id)
+            DO UPDATE SET seq = NULL, deleted = excluded.deleted, changed_at = excluded.changed_at;'''
+    return f'''INSERT OR REPLACE INTO changes (entity, entity_id, deleted, changed_at)
+        VALUES ('{entity}', {row}.id, {deleted}, {_now_sql(dialect)});'''
+
+def _create_changes_postgres(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS changes (
+        entity TEXT NOT NULL,
+        entity_id BIGINT NOT NULL,
+        seq BIGINT,
+        deleted BIGINT NOT NULL DEFAULT 0,
+        changed_at BIGINT NOT NULL,
+        PRIMARY KEY (entity, entity_id)
+    )''')
+    c.execute('CREATE SEQUENCE IF NOT EXISTS changes_seq')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_changes_seq ON changes(seq)')
+    # 提交时才分配序号：同一时间只有一个事务在分配，拿到锁的事务提交后下一个才能继续
+    c.execute(f'''CREATE OR REPLACE FUNCTION changes_assign_seq() RETURNS trigger LANGUAGE plpgsql AS $fn$
+        BEGIN
+        PERFORM pg_advisory_xact_lock({SEQ_LOCK_KEY});
+        UPDATE changes SET seq = nextval('changes_seq')
+        WHERE entity = new.entity AND entity_id = new.entity_id AND seq IS NULL;
+        RETURN NULL;
+        END $fn$''')
+    c.execute('DROP TRIGGER IF EXISTS changes_assign_seq ON changes')
+    c.execute('''CREATE CONSTRAINT TRIGGER changes_assign_seq AFTER INSERT OR UPDATE ON changes
+        DEFERRABLE INITIALLY DEFERRED FOR EACH ROW WHEN (new.seq IS NULL) EXECUTE FUNCTION changes_assign_seq()''')
+
+def init_sync(c):
+    """创建 changes 表和触发器，并为还没有变化记录的已有数据补一条（数据库迁移时调用）"""
+    if c.dialect == 'postgres':
+        _create_changes_postgres(c)
+    else:
+        c.execute('''CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0,
+            changed_at INTEGER NOT NULL
+        )''')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_changes_entity ON changes(entity, entity_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_changes_entity_seq ON changes(entity, seq)')
+    for entity in ENTITIES:
+        for name, event, row, deleted in (('insert', 'AFTER INSERT', 'new', 0), ('update', 'AFTER UPDATE', 'new', 0),
+                                          ('delete', 'AFTER DELETE', 'old', 1)):
+            db.create_trigger(c, f'{entity}_changes_{name}', event, entity, _change_sql(entity, row, deleted, c.dialect))
+        # 已经有变化记录的保持原序号，避免每次迁移都让所有客户端重新下载全部数据
+        c.execute(f'''INSERT INTO changes (entity, entity_id, deleted, changed_at)
+            SELECT '{entity}', id, 0, {_now_sql(c.dialect)} FROM {entity} WHERE true ORDER BY id
+            ON CONFLICT (entity, entity_id) DO NOTHING''')
+
+def latest_seq(conn):
+    return conn.execute('SELECT MAX(seq) FROM changes').fetchone()[0] or 0
+
+def entity_version(conn, entity):
+    """entity 表最近一次变化的序号（表的数据版本），没有变化记录时为 0"""
+    return conn.execute('SELECT MAX(seq) FROM changes WHERE entity = ?', (entity,)).fetchone()[0] or 0
+
+def changes_since(conn, since, limit):
+    """序号大于 since 的变化（最多 limit 条）
+
+    返回 (upserts, deletes, last_seq, has_more)：upserts 为 {表: [行]}，deletes 为 {表: [id]}，
+    last_seq 是本页最后一条的序号（没有变化时等于 since）。
+    """
+    rows = conn.execute('SELECT seq, entity, entity_id, deleted FROM changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                        (since, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    changed, deletes = {}, {}
+    for row in rows:
+        target = deletes if row['deleted'] else changed
+        target.setdefault(row['entity'], []).append(row['entity_id'])
+
+    upserts = {}
+    for entity in ENTITIES:
+        ids = changed.get(entity)
+        if not ids:
+            continue
+        records = []
+        for i in range(0, len(ids), _ID_CHUNK):
+            chunk = ids[i:i + _ID_CHUNK]
+            placeholders = ', '.join('?' * len(chunk))
+            records.extend(conn.execute(f'SELECT * FROM {entity} WHERE id IN ({placeholders}) ORDER BY id', chunk))
+        upserts[entity] = records
+
+    last_seq = rows[-1]['seq'] if rows else since
+    return upserts, deletes, last_seq, has_more
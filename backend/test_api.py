@@ -3,6 +3,7 @@
 """
 import requests
 import json
+import time
 
 BASE_URL = "http://localhost:5000"
 
@@ -101,6 +102,25 @@ def test_create_feed_log(cat_id):
     print(f"   响应: {response.json()}")
     assert response.status_code == 201
 
+def test_batch_health_reports(cat_id):
+    """测试批量健康上报（重试同一批不会重复写入）"""
+    print(f"\n8️⃣ 测试批量健康上报 (猫咪 ID: {cat_id})...")
+    key = f"test-{time.time()}"
+    data = {"items": [
+        {"cat_id": cat_id, "type": "sick", "note": "打喷嚏", "idempotency_key": key + "-1"},
+        {"cat_id": cat_id, "type": "neutered", "idempotency_key": key + "-2"}
+    ]}
+    response = requests.post(f"{BASE_URL}/api/health_reports/batch", json=data)
+    print(f"   状态码: {response.status_code}")
+    print(f"   响应: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["created"] == 2
+
+    retry = requests.post(f"{BASE_URL}/api/health_reports/batch", json=data)
+    print(f"   重试响应: {retry.json()}")
+    assert retry.json()["duplicate"] == 2
+    assert [r["id"] for r in retry.json()["results"]] == [r["id"] for r in response.json()["results"]]
+
 if __name__ == "__main__":
     print("=" * 60)
     print("🧪 Cathub API 测试")
@@ -114,6 +134,7 @@ if __name__ == "__main__":
         test_create_sighting(cat_id)
         test_create_health_report(cat_id)
         test_create_feed_log(cat_id)
+        test_batch_health_reports(cat_id)
         
         print("\n" + "=" * 60)
         print("✅ 所有测试通过！")
@@ -0,0 +1,78 @@
+"""
+测试夹具
+- 每个测试用 server.create_app(Config.from_env().replace(...)) 创建独立的应用：临时目录里的 SQLite 数据库、
+  照片目录和指标快照，进程内存里的准入计数，不开 AI；测试结束时执行 server.shutdown
+- 运行：cd backend && pip install -r requirements-dev.txt && python -m pytest
+"""
+import io
+import os
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import pytest  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import server  # noqa: E402
+from config import Config  # noqa: E402
+
+@pytest.fixture
+def make_app(tmp_path):
+    """返回 make(**changes)：按测试默认配置加上 changes 创建并初始化一个应用"""
+    created = []
+
+    def make(**changes):
+        settings = {
+            'database': str(tmp_path / 'cathub.db'),
+            'database_url': '',
+            'storage': 'local',
+            'upload_folder': str(tmp_path / 'uploads'),
+            'blob_cache_dir': str(tmp_path / 'blob_cache'),
+            'metrics_dir': str(tmp_path / 'metrics'),
+            'admission_db': 'memory',
+            'ai_provider': 'none',
+        }
+        settings.update(changes)
+        flask_app = server.create_app(Config.from_env().replace(**settings))
+        server.prepare(flask_app)
+        created.append(flask_app)
+        return flask_app
+
+    yield make
+    for flask_app in created:
+        server.shutdown(flask_app)
+
+@pytest.fixture
+def app_config():
+    """app 夹具在测试默认配置之上修改的字段；模块里重新定义或 parametrize 覆盖"""
+    return {}
+
+@pytest.fixture
+def app(make_app, app_config):
+    return make_app(**app_config)
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def state(app):
+    return app.extensions['cathub']
+
+def jpeg_bytes(color=(200, 10, 10), size=64):
+    """一张纯色 JPEG 照片"""
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+@pytest.fixture
+def photo():
+    return jpeg_bytes
+
+@pytest.fixture
+def create_cat(client):
+    """返回 create(name, **fields)：创建一只猫，返回 id"""
+    def create(name='雪球', **fields):
+        response = client.post('/api/cats', json={'name': name, 'pattern': '三花', **fields})
+        assert response.status_code in (200, 201), response.get_json()
+        return response.get_json()['id']
+    return create
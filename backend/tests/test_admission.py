@@ -0,0 +1,70 @@
+"""准入控制：按地址和按设备的令牌桶、被拒绝时归还令牌"""
+import io
+
+import pytest
+
+import admission
+
+def make_control(max_concurrent=0, burst=1, ip_multiplier=2):
+    # 每分钟补充一个令牌，测试期间可以看作不补充
+    limits = {'upload': admission.Limit(max_concurrent, 1, burst)}
+    return admission.AdmissionControl(admission.MemoryStore(), limits, queue_size=0,
+                                      worker_slots=0, ip_multiplier=ip_multiplier)
+
+def rejected_status(control, *args):
+    with pytest.raises(admission.Rejected) as info:
+        control.acquire('upload', *args)
+    assert info.value.retry_after >= 1
+    return info.value.status
+
+def test_rotating_device_ids_are_capped_by_ip():
+    control = make_control(burst=1, ip_multiplier=2)
+    control.acquire('upload', '10.0.0.1', 'device:a')
+    control.acquire('upload', '10.0.0.1', 'device:b')
+    assert rejected_status(control, '10.0.0.1', 'device:c') == 429
+    # 其他地址不受影响
+    control.acquire('upload', '10.0.0.2', 'device:c')
+
+def test_device_limit_refunds_ip_token():
+    control = make_control(burst=1, ip_multiplier=2)
+    control.acquire('upload', '10.0.0.1', 'device:a')
+    for _ in range(3):
+        assert rejected_status(control, '10.0.0.1', 'device:a') == 429
+    # 被设备限流拒绝的请求没有消耗地址的令牌
+    control.acquire('upload', '10.0.0.1', 'device:b')
+
+def test_busy_rejection_refunds_both_buckets():
+    control = make_control(max_concurrent=1, burst=2, ip_multiplier=1)
+    lease = control.acquire('upload', '10.0.0.1', 'device:a')
+    for _ in range(3):
+        assert rejected_status(control, '10.0.0.1', 'device:a') == 503
+    control.release(lease)
+
+    # 503 时归还了两个桶的令牌：还剩一次，之后才被限流
+    control.release(control.acquire('upload', '10.0.0.1', 'device:a'))
+    assert rejected_status(control, '10.0.0.1', 'device:a') == 429
+
+def test_unlisted_kind_is_not_limited():
+    assert make_control().acquire('recognize', '10.0.0.1') is None
+
+@pytest.fixture
+def app_config():
+    return {'upload_rate_per_minute': 1, 'upload_burst': 1, 'admission_ip_multiplier': 3,
+            'upload_max_concurrent': 0}
+
+def test_upload_rate_limited_per_device_and_ip(client, create_cat, photo):
+    cat_id = create_cat()
+
+    def upload(device):
+        return client.post(f'/api/cats/{cat_id}/photos', headers={'X-Device-ID': device},
+                           data={'photo': (io.BytesIO(photo()), 'cat.jpg')},
+                           content_type='multipart/form-data')
+
+    assert upload('a').status_code == 200
+    limited = upload('a')
+    assert limited.status_code == 429
+    assert int(limited.headers['Retry-After']) >= 1
+    assert upload('b').status_code == 200
+    assert upload('c').status_code == 200
+    # 地址的桶（1 × 3）用完，换设备标识也不行
+    assert upload('d').status_code == 429
@@ -0,0 +1,113 @@
+"""AI 调用的熔断器：closed -> open -> half_open -> closed，以及熔断时识别降级为本地哈希"""
+import io
+import time
+
+import pytest
+
+import ai_recognition
+import ai_resilience
+from ai_resilience import CircuitBreaker, CircuitOpenError
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('test', failure_threshold=3, recovery_seconds=60)
+    for _ in range(2):
+        breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.allow()
+    assert 0 < error.value.retry_after <= 60
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker('test', failure_threshold=2, recovery_seconds=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_half_open_allows_one_probe_then_closes_on_success():
+    breaker = CircuitBreaker('test', failure_threshold=1, recovery_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.allow()
+    # 试探请求进行中，其余调用仍被拒绝
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.allow()
+
+def test_half_open_failure_reopens():
+    breaker = CircuitBreaker('test', failure_threshold=5, recovery_seconds=0.05)
+    for _ in range(5):
+        breaker.record_failure()
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.snapshot()['total_rejections'] == 0
+
+@pytest.fixture
+def flaky_provider(monkeypatch):
+    """注册一个可以切换成功 / 失败的服务商，熔断器和重试预算只在本测试内有效"""
+    monkeypatch.setattr(ai_resilience, '_guards', {})
+    monkeypatch.setattr(ai_resilience, '_retry_budget', ai_resilience.RetryBudget())
+    monkeypatch.setattr(ai_resilience, 'backoff_delay', lambda attempt: 0)
+    provider = {'fail': True}
+
+    def call(prompt, image_paths, timeout):
+        if provider['fail']:
+            raise RuntimeError('模型不可用')
+        if len(image_paths) == 1:
+            return {'overall_description': '测试'}
+        return {'similarity': 90, 'reason': '相同', 'is_same_cat': True}
+
+    ai_recognition.register_provider('flaky', call)
+    yield provider
+    ai_recognition.unregister_provider('flaky')
+
+@pytest.fixture
+def app_config(flaky_provider):
+    # 服务商要在创建应用之前注册
+    return {'ai_provider': 'flaky', 'recognize_rate_per_minute': 0}
+
+def _recognize(client, image):
+    response = client.post('/api/recognize', data={'use_ai': 'true', 'photo': (io.BytesIO(image), 'a.jpg')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+def test_recognition_degrades_to_hash_while_open_and_recovers(client, create_cat, flaky_provider, photo):
+    image = photo()
+    cat_id = create_cat()
+    assert client.post(f'/api/cats/{cat_id}/photos', data={'photo': (io.BytesIO(image), 'a.jpg')},
+                       content_type='multipart/form-data').status_code == 200
+
+    # 连续失败（含重试）直到熔断，之后不再调用模型，直接用本地哈希匹配
+    methods = [_recognize(client, image)['method'] for _ in range(4)]
+    assert methods[0] == 'ai'
+    assert methods[-1] == 'hash'
+    health = client.get('/api/health').get_json()['ai']
+    assert health['circuit_open']
+    assert health['providers']['flaky']['state'] == 'open'
+
+    fallback = _recognize(client, image)
+    assert (fallback['method'], [m['id'] for m in fallback['matches']]) == ('hash', [cat_id])
+
+    # 恢复时间过后放行一个试探请求，成功后关闭
+    flaky_provider['fail'] = False
+    ai_resilience.get_guard('flaky').breaker.recovery_seconds = 0
+    recovered = _recognize(client, image)
+    assert recovered['method'] == 'ai'
+    assert [(m['id'], m['similarity']) for m in recovered['matches']] == [(cat_id, 90)]
+    assert client.get('/api/health').get_json()['ai']['providers']['flaky']['state'] == 'closed'
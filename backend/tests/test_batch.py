@@ -0,0 +1,69 @@
+"""批量写入接口（/api/*/batch）和幂等键"""
+
+def test_batch_returns_results_and_summary(client, create_cat):
+    cat_id = create_cat()
+    response = client.post('/api/sightings/batch', json={'items': [
+        {'cat_id': cat_id, 'location': '东门', 'idempotency_key': 'a'},
+        {'cat_id': cat_id, 'location': '西门'},
+        {'cat_id': cat_id, 'ts': 'yesterday'},
+        'not an object',
+    ]})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['created'], body['duplicate'], body['error']) == (2, 0, 2)
+    assert [r['status'] for r in body['results']] == ['created', 'created', 'error', 'error']
+    assert [r['index'] for r in body['results']] == [0, 1, 2, 3]
+    assert all(isinstance(r['id'], int) for r in body['results'][:2])
+
+    sightings = client.get(f'/api/sightings?cat_id={cat_id}').get_json()
+    assert sorted(s['location'] for s in sightings) == ['东门', '西门']
+
+def test_batch_accepts_plain_array(client, create_cat):
+    cat_id = create_cat()
+    response = client.post('/api/feed_logs/batch', json=[{'cat_id': cat_id, 'food': '猫粮', 'qty': 1}])
+    assert response.status_code == 200
+    assert response.get_json()['created'] == 1
+
+def test_batch_rejects_non_list(client):
+    assert client.post('/api/sightings/batch', json={'items': 'x'}).status_code == 400
+
+def test_idempotency_key_replay_returns_original_ids(client, create_cat):
+    cat_id = create_cat()
+    items = [{'cat_id': cat_id, 'location': '东门', 'idempotency_key': 'k1'},
+             {'cat_id': cat_id, 'location': '西门', 'idempotency_key': 'k2'}]
+    first = client.post('/api/sightings/batch', json={'items': items}).get_json()
+    replay = client.post('/api/sightings/batch', json={'items': items}).get_json()
+
+    assert (replay['created'], replay['duplicate']) == (0, 2)
+    assert [r['status'] for r in replay['results']] == ['duplicate', 'duplicate']
+    assert [r['id'] for r in replay['results']] == [r['id'] for r in first['results']]
+    assert len(client.get(f'/api/sightings?cat_id={cat_id}').get_json()) == 2
+
+def test_repeated_key_within_batch_is_written_once(client, create_cat):
+    cat_id = create_cat()
+    body = client.post('/api/sightings/batch', json={'items': [
+        {'cat_id': cat_id, 'idempotency_key': 'same'},
+        {'cat_id': cat_id, 'idempotency_key': 'same'},
+    ]}).get_json()
+
+    assert [r['status'] for r in body['results']] == ['created', 'duplicate']
+    assert body['results'][1]['id'] == body['results'][0]['id']
+    assert len(client.get(f'/api/sightings?cat_id={cat_id}').get_json()) == 1
+
+def test_idempotency_keys_are_scoped_by_kind(client, create_cat):
+    cat_id = create_cat()
+    client.post('/api/sightings/batch', json=[{'cat_id': cat_id, 'idempotency_key': 'shared'}])
+    body = client.post('/api/feed_logs/batch', json=[{'cat_id': cat_id, 'idempotency_key': 'shared'}]).get_json()
+    assert body['created'] == 1
+
+def test_health_report_batch_creates_events(client, create_cat):
+    cat_id = create_cat('小黑')
+    body = client.post('/api/health_reports/batch', json=[
+        {'cat_id': cat_id, 'type': 'injury', 'severity': 'high', 'note': '腿伤', 'idempotency_key': 'h1'},
+    ]).get_json()
+    assert body['created'] == 1
+
+    events = client.get('/api/events').get_json()
+    assert [(e['event_type'], e['cat_id']) for e in events if e['event_type'] == 'health_report'] == \
+        [('health_report', cat_id)]
@@ -0,0 +1,29 @@
+"""猫咪列表（/api/cats）：fields 字段投影、未知字段、ETag 重新验证"""
+def test_fields_projection(client, create_cat):
+    create_cat('大橘', notes='喜欢晒太阳')
+    summary = client.get('/api/cats?fields=summary').get_json()
+    assert set(summary[0]) == {'id', 'name', 'pattern', 'cover_photo', 'last_seen_at', 'last_seen_location'}
+
+    # id 总是返回，重复的字段只出现一次
+    assert client.get('/api/cats?fields=name,notes,name').get_json() == [
+        {'id': summary[0]['id'], 'name': '大橘', 'notes': '喜欢晒太阳'}]
+    assert 'embeddings' not in client.get('/api/cats?fields=all').get_json()[0]
+
+def test_unknown_field_is_rejected(client):
+    response = client.get('/api/cats?fields=name,embeddings')
+    assert response.status_code == 400
+    assert 'embeddings' in response.get_json()['error']
+
+def test_etag_revalidation(client, create_cat):
+    create_cat('大橘')
+    first = client.get('/api/cats?fields=name')
+    etag = first.headers['ETag']
+    assert client.get('/api/cats?fields=name', headers={'If-None-Match': etag}).status_code == 304
+    # 不同字段是不同的表示
+    assert client.get('/api/cats?fields=summary').headers['ETag'] != etag
+
+    # 猫咪有变化后旧 ETag 失效
+    create_cat('雪球')
+    second = client.get('/api/cats?fields=name', headers={'If-None-Match': etag})
+    assert second.status_code == 200
+    assert sorted(cat['name'] for cat in second.get_json()) == ['大橘', '雪球']
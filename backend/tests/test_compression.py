@@ -0,0 +1,31 @@
+"""JSON 响应压缩：按 Accept-Encoding 协商、最小长度、q=0 拒绝"""
+import gzip
+import json
+
+from werkzeug.http import parse_accept_header
+
+import compression
+
+def test_gzip_negotiated_above_threshold(client, create_cat):
+    create_cat('大橘', notes='喜欢晒太阳' * 200)
+    response = client.get('/api/cats?fields=notes', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(gzip.decompress(response.data))[0]['notes'] == '喜欢晒太阳' * 200
+
+    # 小于 MIN_BYTES 的响应不压缩，但仍然声明 Vary
+    small = client.get('/api/cats?fields=name', headers={'Accept-Encoding': 'gzip'})
+    assert len(small.data) < compression.MIN_BYTES
+    assert 'Content-Encoding' not in small.headers and 'Accept-Encoding' in small.headers['Vary']
+
+def test_not_compressed_when_client_refuses(client, create_cat):
+    create_cat('大橘', notes='喜欢晒太阳' * 200)
+    for accept in ('gzip;q=0', 'identity', None):
+        headers = {'Accept-Encoding': accept} if accept else {}
+        response = client.get('/api/cats?fields=notes', headers=headers)
+        assert 'Content-Encoding' not in response.headers
+        assert response.get_json()[0]['notes'] == '喜欢晒太阳' * 200
+
+def test_negotiate_prefers_higher_quality():
+    assert compression.negotiate(parse_accept_header('gzip;q=0.5, br;q=0')) == 'gzip'
+    assert compression.negotiate(parse_accept_header('*')) == next(iter(compression.ENCODERS))
@@ -0,0 +1,138 @@
+"""数据库访问层：SQLite / PostgreSQL 的方言差异
+
+PostgreSQL 的用例需要 CATHUB_TEST_DATABASE_URL（例如 postgresql://postgres@127.0.0.1:5432/cathub_test），
+每个用例在一个新建的 schema 里运行，结束后删除；没有设置时跳过。
+"""
+import io
+import os
+import sqlite3
+import uuid
+from urllib.parse import quote
+
+import pytest
+
+import db
+
+TEST_DATABASE_URL = os.environ.get('CATHUB_TEST_DATABASE_URL', '')
+
+@pytest.fixture(params=['sqlite', pytest.param('postgres', marks=pytest.mark.postgres)])
+def database(request, tmp_path):
+    if request.param == 'sqlite':
+        yield db.Database(str(tmp_path / 'cathub.db'))
+        return
+    if not TEST_DATABASE_URL:
+        pytest.skip('没有设置 CATHUB_TEST_DATABASE_URL')
+    psycopg = pytest.importorskip('psycopg')
+    schema = f'cathub_test_{uuid.uuid4().hex[:12]}'
+    with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as admin:
+        admin.execute(f'CREATE SCHEMA {schema}')
+    separator = '&' if '?' in TEST_DATABASE_URL else '?'
+    database = db.Database(url=f"{TEST_DATABASE_URL}{separator}options={quote(f'-csearch_path={schema},public')}")
+    try:
+        yield database
+    finally:
+        database.close_pool()
+        with psycopg.connect(TEST_DATABASE_URL, autocommit=True) as admin:
+            admin.execute(f'DROP SCHEMA {schema} CASCADE')
+
+@pytest.fixture
+def conn(database):
+    conn = database.connect()
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, score REAL)')
+    conn.execute('CREATE TABLE counters (name TEXT PRIMARY KEY, total INTEGER NOT NULL) WITHOUT ROWID')
+    conn.commit()
+    yield conn
+    conn.close()
+
+def test_placeholders_and_percent_signs_are_converted():
+    sql = "SELECT ? AS a, '?%' AS b, \"odd?\" FROM t WHERE name LIKE '%x' AND c % 2 = ?"
+    assert db._postgres_sql(sql) == "SELECT %s AS a, '?%%' AS b, \"odd?\" FROM t WHERE name LIKE '%%x' AND c %% 2 = %s"
+    body = "CREATE FUNCTION f() RETURNS int AS $fn$ SELECT 1 WHERE 'a?' <> ? $fn$"
+    assert db._postgres_sql(body) == body
+
+def test_create_table_types_are_translated():
+    ddl = '''CREATE TABLE t (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        cat_id INTEGER,
+        score REAL,
+        FOREIGN KEY (cat_id) REFERENCES cats (id)
+    ) WITHOUT ROWID'''
+    translated = db._postgres_sql(ddl)
+    assert 'BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY' in translated
+    assert 'cat_id BIGINT' in translated and 'score DOUBLE PRECISION' in translated
+    assert 'FOREIGN KEY' not in translated and 'WITHOUT ROWID' not in translated
+
+def test_dialect_follows_url():
+    assert db.Database('x.db').dialect == 'sqlite'
+    assert db.Database(url='postgresql://u@h/d').dialect == 'postgres'
+    assert db.Database(url='postgres://u:secret@h/d').describe() == 'postgres://u:***@h/d'
+
+def test_insert_returns_ids_in_order(conn):
+    db.begin_write(conn)
+    first = db.insert(conn, 'INSERT INTO items (name, score) VALUES (?, ?)', ('a', 1.5))
+    rest = db.insert_many(conn, 'INSERT INTO items (name, score) VALUES (?, ?)', [('b', 2), ('c', 3), ('d', 4)])
+    conn.commit()
+
+    assert rest == [first + 1, first + 2, first + 3]
+    rows = conn.execute('SELECT id, name, score FROM items ORDER BY id').fetchall()
+    assert [(row['id'], row['name']) for row in rows] == list(zip([first] + rest, 'abcd'))
+    assert rows[0][2] == 1.5 and dict(rows[0]) == {'id': first, 'name': 'a', 'score': 1.5}
+    assert db.insert_many(conn, 'INSERT INTO items (name) VALUES (?)', []) == []
+
+def test_rollback_discards_write(conn):
+    db.begin_write(conn)
+    db.insert(conn, 'INSERT INTO items (name) VALUES (?)', ('gone',))
+    conn.rollback()
+    assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+
+def test_schema_version_and_table_exists(conn):
+    assert db.schema_version(conn) == 0
+    db.set_schema_version(conn, 7)
+    conn.commit()
+    assert db.schema_version(conn) == 7
+    assert db.table_exists(conn, 'items')
+    assert not db.table_exists(conn, 'missing')
+
+def test_trigger_runs_for_each_row(conn):
+    body = '''INSERT INTO counters (name, total)
+        VALUES ('items', 1) ON CONFLICT (name) DO UPDATE SET total = counters.total + 1;'''
+    # 重复创建时替换，不会执行两次
+    for _ in range(2):
+        db.create_trigger(conn, 'items_count', 'AFTER INSERT', 'items', body)
+    db.insert_many(conn, 'INSERT INTO items (name) VALUES (?)', [('a',), ('b',)])
+    conn.commit()
+    assert conn.execute("SELECT total FROM counters WHERE name = 'items'").fetchone()[0] == 2
+
+def test_lock_names_in_write_transaction(conn):
+    db.begin_write(conn)
+    db.lock_names(conn, ['key:a', 'key:b', 'key:a'])
+    db.insert(conn, 'INSERT INTO items (name) VALUES (?)', ('a',))
+    conn.commit()
+
+def test_init_lock_can_be_taken_again(database):
+    for _ in range(2):
+        with database.init_lock():
+            pass
+
+def test_transient_errors():
+    assert db.is_transient(sqlite3.OperationalError('database is locked'))
+    assert not db.is_transient(sqlite3.IntegrityError('UNIQUE constraint failed'))
+    assert not db.is_transient(ValueError())
+
+def test_app_runs_on_both_dialects(make_app, database, photo):
+    """完整的迁移和几个接口：建猫、上传照片（引用计数触发器）、批量上报、增量同步"""
+    client = make_app(database=database.path, database_url=database.url).test_client()
+    cat_id = client.post('/api/cats', json={'name': '雪球', 'pattern': '三花'}).get_json()['id']
+    upload = client.post(f'/api/cats/{cat_id}/photos', data={'photo': (io.BytesIO(photo()), 'cat.jpg')},
+                         content_type='multipart/form-data')
+    assert upload.status_code == 200
+    batch = client.post('/api/sightings/batch', json={'items': [
+        {'cat_id': cat_id, 'location': '东门', 'idempotency_key': 'k'}]}).get_json()
+    assert batch['created'] == 1
+    replay = client.post('/api/sightings/batch', json={'items': [
+        {'cat_id': cat_id, 'location': '东门', 'idempotency_key': 'k'}]}).get_json()
+    assert replay['duplicate'] == 1
+
+    body = client.get('/api/sync').get_json()
+    assert [cat['id'] for cat in body['upserts']['cats']] == [cat_id]
+    assert len(body['upserts']['sightings']) == 1
@@ -0,0 +1,24 @@
+"""事件列表（/api/events）：since_id 增量游标"""
+def add_reports(client, create_cat, count):
+    cat_id = create_cat('小黑')
+    body = client.post('/api/health_reports/batch', json=[
+        {'cat_id': cat_id, 'type': 'injury', 'severity': 'low', 'note': f'第 {i} 次'} for i in range(count)
+    ]).get_json()
+    assert body['created'] == count
+
+def test_since_id_returns_newer_events_in_id_order(client, create_cat):
+    add_reports(client, create_cat, 5)
+    ids = sorted(event['id'] for event in client.get('/api/events').get_json())
+
+    # 按 id 升序，客户端用最后一条的 id 作为下一页的游标
+    page = client.get(f'/api/events?since_id={ids[0]}&limit=2').get_json()
+    assert [event['id'] for event in page] == ids[1:3]
+    page = client.get(f'/api/events?since_id={page[-1]["id"]}').get_json()
+    assert [event['id'] for event in page] == ids[3:]
+    assert client.get(f'/api/events?since_id={ids[-1]}').get_json() == []
+
+def test_limit_is_clamped(client, create_cat):
+    add_reports(client, create_cat, 3)
+    # LIMIT -1 在 SQLite 中表示不限制，不能借此取回全部事件
+    assert len(client.get('/api/events?limit=-1').get_json()) == 1
+    assert len(client.get('/api/events?since_id=0&limit=0').get_json()) == 1
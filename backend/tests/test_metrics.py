@@ -0,0 +1,63 @@
+"""多进程指标：已退出 worker 的计数并入累计值，/metrics 的计数不会减少"""
+import json
+import re
+import subprocess
+import sys
+
+import pytest
+
+import metrics
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path / 'metrics'))
+    (tmp_path / 'metrics').mkdir()
+    return tmp_path / 'metrics'
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+def write_snapshot(metrics_dir, pid, retries, token=None):
+    data = {'cathub_ai_retries_total': [[['worker-test'], retries]],
+            metrics._PROCESS_KEY: token or f'{pid}-test'}
+    (metrics_dir / f'metrics_{pid}.json').write_text(json.dumps(data))
+
+def retries_total():
+    match = re.search(r'^cathub_ai_retries_total\{provider="worker-test"\} (\S+)$', metrics.render_latest(), re.M)
+    return float(match.group(1)) if match else 0
+
+def test_exited_worker_counts_are_kept(metrics_dir):
+    pid = exited_pid()
+    write_snapshot(metrics_dir, pid, 3)
+    assert retries_total() == 3
+
+    metrics.collect_exited()
+    assert not (metrics_dir / f'metrics_{pid}.json').exists()
+    assert retries_total() == 3
+
+    # 再有 worker 退出时累加，不会减少
+    other = exited_pid()
+    write_snapshot(metrics_dir, other, 2)
+    metrics.retire(other)
+    assert retries_total() == 5
+
+def test_snapshot_already_folded_is_not_counted_twice(metrics_dir):
+    pid = exited_pid()
+    write_snapshot(metrics_dir, pid, 4)
+    snapshot = (metrics_dir / f'metrics_{pid}.json').read_text()
+    metrics.collect_exited()
+
+    # 并入累计值之后、删除之前被读者看到的快照
+    (metrics_dir / f'metrics_{pid}.json').write_text(snapshot)
+    assert retries_total() == 4
+    metrics.collect_exited()
+    assert retries_total() == 4
+
+def test_reused_pid_is_counted_separately(metrics_dir):
+    pid = exited_pid()
+    write_snapshot(metrics_dir, pid, 1, token='first')
+    metrics.retire(pid)
+    write_snapshot(metrics_dir, pid, 2, token='second')
+    assert retries_total() == 3
@@ -0,0 +1,38 @@
+"""附近查询（/api/cats/nearby、/api/events/nearby）：半径过滤、按距离排序、R*Tree 与范围扫描"""
+import pytest
+
+import server
+
+@pytest.fixture(params=['rtree', 'range_scan'])
+def cats_around(request, app, state, create_cat):
+    """在 (30, 120) 以北约 111 米、556 米、2.2 公里各有一只猫出没"""
+    cats = {}
+    with app.app_context():
+        for name, dlat in (('远', 0.02), ('近', 0.001), ('中', 0.005)):
+            cats[name] = create_cat(name)
+            server.record_sightings([{'id': cats[name], 'name': name}], name, 30.0 + dlat, 120.0)
+    state.deferred_writes.flush(timeout=5)
+    if request.param == 'range_scan':
+        # 模拟没有编译 R*Tree 的 SQLite：对经纬度列做范围扫描
+        state.geo_index_available = False
+    return cats
+
+def test_nearby_cats_filtered_by_radius_and_sorted(client, cats_around):
+    body = client.get('/api/cats/nearby?lat=30&lng=120&radius_m=1000').get_json()
+    assert [cat['name'] for cat in body] == ['近', '中']
+    assert body[0]['distance_m'] == pytest.approx(111.2, abs=0.5)
+    assert body[0]['distance_m'] < body[1]['distance_m'] < 1000
+
+    assert [cat['name'] for cat in client.get('/api/cats/nearby?lat=30&lng=120&radius_m=5000&limit=1').get_json()] == ['近']
+    assert len(client.get('/api/cats/nearby?lat=30&lng=120&radius_m=5000').get_json()) == 3
+
+def test_nearby_events(client, cats_around):
+    body = client.get('/api/events/nearby?lat=30&lng=120&radius_m=600').get_json()
+    assert [event['location'] for event in body] == ['近', '中']
+    assert all(event['event_type'] == 'sighting' for event in body)
+
+def test_nearby_rejects_invalid_arguments(client):
+    assert client.get('/api/cats/nearby?lng=120').status_code == 400
+    assert client.get('/api/cats/nearby?lat=91&lng=120').status_code == 400
+    assert client.get('/api/events/nearby?lat=30&lng=120&radius_m=0').status_code == 400
+    assert client.get(f'/api/events/nearby?lat=30&lng=120&radius_m={server.NEARBY_MAX_RADIUS_M + 1}').status_code == 400
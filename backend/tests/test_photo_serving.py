@@ -0,0 +1,49 @@
+"""照片下载（/uploads）：Range 分段、If-None-Match 重新验证、下载名额"""
+import io
+
+def upload(client, cat_id, data):
+    response = client.post(f'/api/cats/{cat_id}/photos', data={'photo': (io.BytesIO(data), 'cat.jpg')},
+                           content_type='multipart/form-data')
+    assert response.status_code in (200, 201), response.get_json()
+    return response.get_json()['path']
+
+def get(client, key, headers=None):
+    # 读完响应体并关闭（归还下载名额），相当于服务器发送完毕
+    return client.get(f'/uploads/{key}', headers=headers, buffered=True)
+
+def test_range_requests(client, create_cat, photo):
+    key = upload(client, create_cat(), photo())
+    full = get(client, key)
+    assert full.status_code == 200 and full.headers['Accept-Ranges'] == 'bytes'
+    assert full.headers['Cache-Control'].endswith('immutable')
+
+    part = get(client, key, {'Range': 'bytes=0-9'})
+    assert part.status_code == 206
+    assert part.data == full.data[:10]
+    assert part.headers['Content-Range'] == f'bytes 0-9/{len(full.data)}'
+
+    tail = get(client, key, {'Range': 'bytes=-4'})
+    assert tail.status_code == 206 and tail.data == full.data[-4:]
+    assert get(client, key, {'Range': f'bytes={len(full.data)}-'}).status_code == 416
+
+def test_if_none_match(client, create_cat, photo):
+    key = upload(client, create_cat(), photo())
+    etag = get(client, key).headers['ETag']
+    response = get(client, key, {'If-None-Match': etag})
+    assert response.status_code == 304 and response.data == b''
+    assert response.headers['ETag'] == etag
+    assert get(client, key, {'If-None-Match': '"other"'}).status_code == 200
+
+def test_busy_downloads_return_503(make_app, photo):
+    flask_app = make_app(photo_max_concurrent=1, photo_queue_seconds=0)
+    client = flask_app.test_client()
+    cat_id = client.post('/api/cats', json={'name': '雪球', 'pattern': '三花'}).get_json()['id']
+    key = upload(client, cat_id, photo())
+
+    # 未读完的响应一直占着唯一的名额；重新验证（304）不占名额
+    held = client.get(f'/uploads/{key}', buffered=False)
+    busy = get(client, key)
+    assert busy.status_code == 503 and busy.headers['Retry-After'] == '1'
+    assert get(client, key, {'If-None-Match': held.headers['ETag']}).status_code == 304
+    held.close()
+    assert get(client, key).status_code == 200
@@ -0,0 +1,83 @@
+"""照片去重存储：触发器维护的引用计数、垃圾回收的保留期"""
+import functools
+import io
+import os
+import time
+
+import photo_store
+import server
+
+def refcount(state, key):
+    conn = state.database.connect()
+    try:
+        row = conn.execute('SELECT refcount FROM photo_blobs WHERE digest = ?',
+                           (photo_store.digest_of(key),)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+def execute(state, sql, params=()):
+    with server.unit_of_work(state.database) as conn:
+        conn.execute(sql, params)
+
+def upload(client, cat_id, data):
+    response = client.post(f'/api/cats/{cat_id}/photos',
+                           data={'photo': (io.BytesIO(data), 'cat.jpg')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+def collect(state, grace_seconds):
+    return photo_store.collect_garbage(functools.partial(server.unit_of_work, state.database),
+                                       state.storage, grace_seconds=grace_seconds)
+
+def make_old(state, key, age_seconds):
+    past = time.time() - age_seconds
+    os.utime(state.storage.local_path(key), (past, past))
+
+def test_same_photo_is_stored_once_and_counted_per_reference(client, state, create_cat, photo):
+    first, second = create_cat('雪球'), create_cat('煤球')
+    key = upload(client, first, photo())['path']
+    assert upload(client, second, photo())['path'] == key
+    assert refcount(state, key) == 2
+
+    # 同一只猫重复上传不增加引用
+    assert upload(client, first, photo())['duplicate'] is True
+    assert refcount(state, key) == 2
+
+def test_triggers_follow_updates_and_deletes(client, state, create_cat, photo):
+    cat_id = create_cat()
+    key = upload(client, cat_id, photo())['path']
+    client.post('/api/sightings', json={'cat_id': cat_id, 'photo': key, 'location': '东门'})
+    assert refcount(state, key) == 2
+
+    assert client.put(f'/api/cats/{cat_id}', json={'photos': []}).status_code == 200
+    assert refcount(state, key) == 1
+
+    execute(state, 'DELETE FROM sightings WHERE photo = ?', (key,))
+    assert refcount(state, key) == 0
+
+def test_gc_keeps_recent_and_referenced_photos(client, state, create_cat, photo):
+    cat_id = create_cat()
+    referenced = upload(client, cat_id, photo((10, 200, 10)))['path']
+    orphan, _ = photo_store.put(state.storage, photo((10, 10, 200)), '.jpg')
+
+    # 没有引用但还在保留期内（例如识别中的临时照片）
+    assert collect(state, grace_seconds=3600) == (0, 0)
+    assert state.storage.stat(orphan) is not None
+
+    make_old(state, orphan, 7200)
+    make_old(state, referenced, 7200)
+    deleted, freed = collect(state, grace_seconds=3600)
+    assert deleted == 1 and freed > 0
+    assert state.storage.stat(orphan) is None
+    assert state.storage.stat(referenced) is not None
+
+def test_reupload_refreshes_grace_period(state, photo):
+    key, existed = photo_store.put(state.storage, photo(), '.jpg')
+    assert not existed
+    make_old(state, key, 7200)
+
+    assert photo_store.put(state.storage, photo(), '.jpg') == (key, True)
+    assert collect(state, grace_seconds=3600) == (0, 0)
+    assert state.storage.stat(key) is not None
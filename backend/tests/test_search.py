@@ -0,0 +1,40 @@
+"""全文搜索（/api/search）：FTS5 与 LIKE 回退，是否有索引按应用判断"""
+import server
+
+def names(response):
+    assert response.status_code == 200, response.get_json()
+    return [item['name'] for item in response.get_json()['items']]
+
+def drop_fts(flask_app):
+    """模拟没有 FTS5 的 SQLite：删除索引表和同步触发器"""
+    with server.unit_of_work(flask_app.extensions['cathub'].database) as conn:
+        for table in ('cats', 'events'):
+            for suffix in ('insert', 'delete', 'update'):
+                conn.execute(f'DROP TRIGGER IF EXISTS {table}_fts_{suffix}')
+            conn.execute(f'DROP TABLE IF EXISTS {table}_fts')
+
+def add_cats(client):
+    client.post('/api/cats', json={'name': '大橘子', 'pattern': '橘猫'})
+    client.post('/api/cats', json={'name': '雪球', 'pattern': '白猫', 'notes': '喜欢大橘子'})
+
+def test_search_long_and_short_terms(client):
+    add_cats(client)
+    # 名字命中的权重高于备注
+    assert names(client.get('/api/search?q=大橘子')) == ['大橘子', '雪球']
+    assert names(client.get('/api/search?q=白猫')) == ['雪球']
+    assert names(client.get('/api/search?q=大橘子 白猫')) == ['雪球']
+    assert client.get('/api/search').status_code == 400
+    assert client.get('/api/search?q=x&type=dogs').status_code == 400
+
+def test_fts_availability_is_per_app(make_app, tmp_path):
+    with_fts = make_app()
+    without_fts = make_app(database=str(tmp_path / 'no_fts.db'))
+    drop_fts(without_fts)
+    for flask_app in (with_fts, without_fts):
+        add_cats(flask_app.test_client())
+
+    # 先查有索引的应用，没有索引的应用不会去查不存在的 *_fts 表；反过来也不会让前者退化为 LIKE
+    assert names(with_fts.test_client().get('/api/search?q=大橘子')) == ['大橘子', '雪球']
+    assert sorted(names(without_fts.test_client().get('/api/search?q=大橘子'))) == ['大橘子', '雪球']
+    assert with_fts.extensions['cathub'].search_index_available is True
+    assert without_fts.extensions['cathub'].search_index_available is False
@@ -0,0 +1,45 @@
+"""统计（/api/stats）：按天 / 小时分桶、按猫细分、出没时段热力图"""
+# 北京时间 2023-11-15 00:00，正好是一个按天分桶的边界
+DAY = 1699977600
+
+def series(client, **params):
+    response = client.get('/api/stats', query_string={'from': DAY, 'to': DAY + 2 * 86400, **params})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['series']
+
+def add_sightings(client, create_cat):
+    """两只猫：大橘 当天 1 点两次、次日 2 点一次，雪球 当天 1 点一次"""
+    orange, snowball = create_cat('大橘'), create_cat('雪球')
+    response = client.post('/api/sightings/batch', json=[
+        {'cat_id': orange, 'ts': DAY + 3600},
+        {'cat_id': orange, 'ts': DAY + 3700},
+        {'cat_id': orange, 'ts': DAY + 86400 + 7200},
+        {'cat_id': snowball, 'ts': DAY + 3650},
+    ])
+    assert response.status_code == 200, response.get_json()
+    return orange, snowball
+
+def test_daily_buckets_and_by_cat(client, create_cat):
+    orange, snowball = add_sightings(client, create_cat)
+    assert series(client, metric='sighting') == [
+        {'bucket': DAY, 'count': 3}, {'bucket': DAY + 86400, 'count': 1}]
+    assert series(client, metric='sighting', by='cat') == [
+        {'bucket': DAY, 'cat_id': orange, 'count': 2},
+        {'bucket': DAY, 'cat_id': snowball, 'count': 1},
+        {'bucket': DAY + 86400, 'cat_id': orange, 'count': 1}]
+    assert series(client, metric='sighting', cat_id=snowball) == [{'bucket': DAY, 'count': 1}]
+    assert series(client, metric='feed') == []
+
+def test_hour_of_day_folds_buckets(client, create_cat):
+    add_sightings(client, create_cat)
+    assert series(client, metric='sighting', interval='hour') == [
+        {'bucket': DAY + 3600, 'count': 3}, {'bucket': DAY + 86400 + 7200, 'count': 1}]
+    assert series(client, metric='sighting', interval='hour', hour_of_day=1) == [
+        {'bucket': 1, 'count': 3}, {'bucket': 2, 'count': 1}]
+
+def test_stats_rejects_invalid_arguments(client):
+    assert client.get('/api/stats?metric=naps').status_code == 400
+    assert client.get('/api/stats?metric=feed&interval=week').status_code == 400
+    assert client.get('/api/stats?metric=feed&interval=day&hour_of_day=1').status_code == 400
+    assert client.get(f'/api/stats?metric=feed&from={DAY}&to={DAY}').status_code == 400
+    assert client.get('/api/stats?metric=feed&by=reporter').status_code == 400
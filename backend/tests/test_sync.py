@@ -0,0 +1,79 @@
+"""增量同步（/api/sync）：按提交顺序的序号、分页、墓碑"""
+import server
+
+def sync(client, since='0', **params):
+    response = client.get('/api/sync', query_string={'since': since, **params})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+def ids(body, entity):
+    return [row['id'] for row in body['upserts'].get(entity, [])]
+
+def test_full_sync_then_only_newer_changes(client, create_cat):
+    first = create_cat('雪球')
+    full = sync(client)
+    assert ids(full, 'cats') == [first]
+    assert full['has_more'] is False
+    assert sync(client, full['token'])['upserts'] == {}
+
+    second = create_cat('煤球')
+    client.put(f'/api/cats/{first}', json={'name': '雪球二号'})
+    delta = sync(client, full['token'])
+    assert ids(delta, 'cats') == [first, second]
+    assert {cat['id']: cat['name'] for cat in delta['upserts']['cats']}[first] == '雪球二号'
+    assert int(delta['token']) > int(full['token'])
+
+def test_record_changed_twice_appears_once_at_latest_seq(client, create_cat):
+    first, second = create_cat('雪球'), create_cat('煤球')
+    token = sync(client)['token']
+    client.put(f'/api/cats/{first}', json={'name': '雪球二号'})
+    client.put(f'/api/cats/{second}', json={'name': '煤球二号'})
+    client.put(f'/api/cats/{first}', json={'name': '雪球三号'})
+
+    # 每页一条：先拿到 second，first 排在它最近一次修改的位置
+    page = sync(client, token, limit=1)
+    assert ids(page, 'cats') == [second] and page['has_more'] is True
+    page = sync(client, page['token'], limit=1)
+    assert ids(page, 'cats') == [first] and page['has_more'] is False
+    assert page['upserts']['cats'][0]['name'] == '雪球三号'
+
+def test_pages_cover_every_change_in_seq_order(client, create_cat):
+    for name in ('甲', '乙', '丙'):
+        cat_id = create_cat(name)
+        client.post('/api/sightings', json={'cat_id': cat_id, 'location': '东门'})
+
+    tokens, seen = ['0'], []
+    while True:
+        page = sync(client, tokens[-1], limit=2)
+        seen.extend((entity, row['id']) for entity, rows in page['upserts'].items() for row in rows)
+        tokens.append(page['token'])
+        if not page['has_more']:
+            break
+    assert [int(t) for t in tokens] == sorted(int(t) for t in tokens)
+    assert len(seen) == len(set(seen))
+    assert sum(1 for entity, _ in seen if entity == 'cats') == 3
+    assert sum(1 for entity, _ in seen if entity == 'sightings') == 3
+
+def test_deleted_record_becomes_tombstone(client, state, create_cat):
+    cat_id = create_cat()
+    sighting_id = client.post('/api/sightings', json={'cat_id': cat_id, 'location': '东门'}).get_json()['id']
+    token = sync(client)['token']
+
+    with server.unit_of_work(state.database) as conn:
+        conn.execute('DELETE FROM sightings WHERE id = ?', (sighting_id,))
+    delta = sync(client, token)
+    assert delta['deletes'] == {'sightings': [sighting_id]}
+    assert 'sightings' not in delta['upserts']
+
+    # 从头同步的客户端也能看到墓碑，不会拿到已删除的记录
+    full = sync(client)
+    assert full['deletes'] == {'sightings': [sighting_id]}
+    assert ids(full, 'cats') == [cat_id]
+
+def test_invalid_and_future_tokens(client, create_cat):
+    create_cat()
+    assert client.get('/api/sync?since=abc').status_code == 400
+    token = int(sync(client)['token'])
+    response = client.get(f'/api/sync?since={token + 100}')
+    assert response.status_code == 410
+    assert response.get_json()['token'] == '0'
@@ -0,0 +1,59 @@
+"""写后队列：同一 key 的合并、关闭时刷完、关闭后改为同步写入"""
+import contextlib
+
+import server
+import write_behind
+
+def make_queue(batches, **kwargs):
+    """apply 把每次写入的 {kind: [row, ...]} 记到 batches 里"""
+    @contextlib.contextmanager
+    def transaction():
+        yield None
+
+    kwargs.setdefault('flush_interval', 0.2)
+    return write_behind.WriteBehindQueue(lambda conn, writes: batches.append(writes), transaction, **kwargs)
+
+def test_same_key_coalesces_to_last_write():
+    batches = []
+    q = make_queue(batches)
+    assert q.submit([('last_seen', 1, 'first'), ('event', None, 'e1')])
+    assert q.submit([('last_seen', 1, 'second'), ('last_seen', 2, 'other'), ('event', None, 'e2')])
+    assert q.flush(timeout=5)
+    q.close()
+
+    assert len(batches) == 1
+    assert sorted(batches[0]['last_seen']) == ['other', 'second']
+    assert batches[0]['event'] == ['e1', 'e2']
+
+def test_close_flushes_pending_writes():
+    batches = []
+    # 刷新间隔比测试长，只有 close 会让写线程把这批写掉
+    q = make_queue(batches, flush_interval=60)
+    assert q.submit([('event', None, 'e1')])
+    q.close(timeout=5)
+
+    assert batches == [{'event': ['e1']}]
+    assert not q.submit([('event', None, 'e2')])
+
+def test_shutdown_flushes_recorded_sightings(app, create_cat):
+    cat_id = create_cat()
+    match = {'id': cat_id, 'name': '雪球'}
+    with app.app_context():
+        server.record_sightings([match], '东门', 30.1, 120.1)
+        server.record_sightings([match], '西门', 30.2, 120.2)
+    server.shutdown(app)
+
+    client = app.test_client()
+    cat = client.get(f'/api/cats/{cat_id}').get_json()
+    assert cat['last_seen_location'] == '西门'
+    sightings = [e for e in client.get('/api/events').get_json() if e['event_type'] == 'sighting']
+    assert len(sightings) == 2
+
+def test_sightings_written_synchronously_after_shutdown(app, create_cat):
+    cat_id = create_cat()
+    server.shutdown(app)
+    with app.app_context():
+        server.record_sightings([{'id': cat_id, 'name': '雪球'}], '北门', None, None)
+
+    cat = app.test_client().get(f'/api/cats/{cat_id}').get_json()
+    assert cat['last_seen_location'] == '北门'
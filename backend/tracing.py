@@ -0,0 +1,175 @@
+"""
+轻量级请求追踪
+- 每个请求一个 Trace，代码里用 `with span('阶段名'):` 记录各阶段耗时，可以嵌套
+- 只有请求带 ?debug_timing=1 或开启了导出（TRACE_EXPORT_PATH）时才真正记录，
+  其他情况下 span() 只是一次 ContextVar 读取
+- 可导出为 OpenTelemetry（OTLP/JSON）兼容格式，每行一个 trace，便于离线分析
+"""
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from app_logging import get_logger
+
+logger = get_logger('tracing')
+
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH', '')
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 1.0))
+MAX_SPANS_PER_TRACE = int(os.environ.get('TRACE_MAX_SPANS', 500))
+SERVICE_NAME = 'cathub-backend'
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_export_lock = threading.Lock()
+
+class Span:
+    __slots__ = ('span_id', 'parent', 'name', 'attributes', 'start_ns', 'end_ns', 'children')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.name = name
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.children = []
+
+    @property
+    def duration_ms(self):
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def to_tree(self):
+        node = {'name': self.name, 'duration_ms': round(self.duration_ms, 2)}
+        if self.attributes:
+            node['attributes'] = self.attributes
+        if self.children:
+            node['children'] = [c.to_tree() for c in self.children]
+        return node
+
+class Trace:
+    def __init__(self, name, attributes=None):
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(name, attributes=attributes)
+        self.span_count = 1
+        self.dropped_spans = 0
+
+    def finish(self):
+        if self.root.end_ns is None:
+            self.root.end_ns = time.time_ns()
+
+    def server_timing(self):
+        """生成 Server-Timing 响应头：按名称汇总根节点下的直接子阶段"""
+        totals = {}
+        for child in self.root.children:
+            totals[child.name] = totals.get(child.name, 0.0) + child.duration_ms
+        parts = [f'{_server_timing_token(name)};dur={ms:.1f}' for name, ms in totals.items()]
+        parts.append(f'total;dur={self.root.duration_ms:.1f}')
+        return ', '.join(parts)
+
+    def to_tree(self):
+        tree = self.root.to_tree()
+        tree['trace_id'] = self.trace_id
+        if self.dropped_spans:
+            tree['dropped_spans'] = self.dropped_spans
+        return tree
+
+    def to_otlp(self):
+        """OpenTelemetry OTLP/JSON 格式（ExportTraceServiceRequest）"""
+        spans = []
+        stack = [self.root]
+        while stack:
+            s = stack.pop()
+            entry = {
+                'traceId': self.trace_id,
+                'spanId': s.span_id,
+                'name': s.name,
+                'kind': 2 if s is self.root else 1,  # SERVER / INTERNAL
+                'startTimeUnixNano': str(s.start_ns),
+                'endTimeUnixNano': str(s.end_ns or s.start_ns),
+                'attributes': [_otlp_attribute(k, v) for k, v in s.attributes.items()],
+            }
+            if s.parent is not None:
+                entry['parentSpanId'] = s.parent.span_id
+            spans.append(entry)
+            stack.extend(s.children)
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otlp_attribute('service.name', SERVICE_NAME)]},
+                'scopeSpans': [{'scope': {'name': 'cathub.tracing'}, 'spans': spans}],
+            }]
+        }
+
+def _server_timing_token(name):
+    return ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+def should_export():
+    return bool(TRACE_EXPORT_PATH) and random.random() < TRACE_SAMPLE_RATE
+
+def start_trace(name, **attributes):
+    """开始一个新 trace，返回 (trace, token)，结束时调用 end_trace(token)"""
+    trace = Trace(name, attributes)
+    token = (_current_trace.set(trace), _current_span.set(trace.root))
+    return trace, token
+
+def end_trace(token):
+    trace_token, span_token = token
+    trace = _current_trace.get()
+    _current_span.reset(span_token)
+    _current_trace.reset(trace_token)
+    if trace is not None:
+        trace.finish()
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+@contextmanager
+def span(name, **attributes):
+    """记录一个阶段；没有活动 trace 时不做任何事"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    if trace.span_count >= MAX_SPANS_PER_TRACE:
+        trace.dropped_spans += 1
+        yield None
+        return
+    parent = _current_span.get()
+    s = Span(name, parent=parent, attributes=attributes)
+    parent.children.append(s)
+    trace.span_count += 1
+    token = _current_span.set(s)
+    try:
+        yield s
+    finally:
+        s.end_ns = time.time_ns()
+        _current_span.reset(token)
+
+def export(trace):
+    """把 trace 以 OTLP/JSON 追加写入 TRACE_EXPORT_PATH（每行一个）"""
+    if not TRACE_EXPORT_PATH:
+        return
+    line = json.dumps(trace.to_otlp(), ensure_ascii=False)
+    try:
+        with _export_lock:
+            with open(TRACE_EXPORT_PATH, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+    except OSError as e:
+        logger.warning("导出 trace 失败: %s", e)
@@ -0,0 +1,203 @@
+"""
+写后队列（write-behind）
+- 非关键写入（识别后的 last_seen 更新、目击事件）不在请求线程里等 SQLite 写锁，
+  而是放进本进程的有界队列，由一个后台写线程定期合并成一个事务批量写入
+- 同一个 key 的写入会合并，只保留最后一次（例如同一只猫在一批里被多次目击）
+- 有界队列提供背压：队列满时 submit 最多等待 ENQUEUE_TIMEOUT 秒，仍然放不进去就返回 False，
+  由调用方改为同步写入，数据不会丢
+- 进程退出时（atexit / gunicorn worker_exit）把队列里剩下的写入刷完
+- 按 pid 懒启动写线程，gunicorn preload 后 fork 出的每个 worker 各有一个
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+import db
+from app_logging import get_logger
+from metrics import WRITE_BEHIND_FALLBACKS, WRITE_BEHIND_FLUSH_DURATION, WRITE_BEHIND_WRITES
+
+logger = get_logger('write_behind')
+
+WRITE_BEHIND_ENABLED = os.environ.get('CATHUB_WRITE_BEHIND', '1') != '0'
+QUEUE_SIZE = int(os.environ.get('CATHUB_WRITE_BEHIND_QUEUE_SIZE', 1000))
+FLUSH_INTERVAL_SECONDS = float(os.environ.get('CATHUB_WRITE_BEHIND_FLUSH_SECONDS', 0.5))
+MAX_BATCH = int(os.environ.get('CATHUB_WRITE_BEHIND_MAX_BATCH', 500))
+ENQUEUE_TIMEOUT = float(os.environ.get('CATHUB_WRITE_BEHIND_ENQUEUE_TIMEOUT', 0.05))
+# 数据库被锁（其他进程长事务）、PostgreSQL 死锁或连接中断时的重试次数
+WRITE_RETRIES = 3
+
+_STOP = object()
+
+class WriteBehindQueue:
+    """单写线程的写后队列
+
+    apply(conn, writes) 负责真正写入：writes 是 {kind: [row, ...]}，
+    transaction() 返回一个提供连接并在退出时提交/回滚的上下文管理器。
+    """
+
+    def __init__(self, apply, transaction, maxsize=QUEUE_SIZE,
+                 flush_interval=FLUSH_INTERVAL_SECONDS, max_batch=MAX_BATCH):
+        self._apply = apply
+        self._transaction = transaction
+        self._maxsize = maxsize
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._closed = False
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._queue = queue.Queue(maxsize=self._maxsize)
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            self._closed = False
+            self._pid = pid
+
+    def submit(self, writes):
+        """提交一组写入 [(kind, key, row), ...]，key 为 None 的不合并
+
+        成功放入队列返回 True；未启用、已关闭或队列持续已满时返回 False，调用方应同步写入。
+        """
+        if not WRITE_BEHIND_ENABLED or not writes:
+            return False
+        self._ensure_started()
+        if self._closed:
+            return False
+        try:
+            self._queue.put(list(writes), timeout=ENQUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            WRITE_BEHIND_FALLBACKS.inc()
+            logger.warning("写后队列已满，改为同步写入", extra={'queue_size': self._maxsize})
+            return False
+
+    def flush(self, timeout=None):
+        """等待已提交的写入全部落盘（测试和关闭时使用）"""
+        if self._pid != os.getpid() or self._queue is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=10):
+        """停止接收新写入，刷完队列后结束写线程"""
+        pid = os.getpid()
+        if self._pid != pid:
+            # 本进程还没有启动写线程：只标记关闭，之后的 submit 不会再启动新的写线程
+            with self._lock:
+                self._pid, self._queue, self._thread, self._closed = pid, None, None, True
+            return
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("写后队列关闭超时，可能有写入未完成", extra={'pending': self._queue.qsize()})
+
+    def _run(self):
+        q = self._queue
+        while True:
+            first = q.get()
+            groups = [first]
+            # 凑一批：等到刷新间隔结束或攒够 max_batch 组
+            deadline = time.monotonic() + self._flush_interval
+            while first is not _STOP and len(groups) < self._max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group = q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                groups.append(group)
+                if group is _STOP:
+                    break
+
+            stop = any(g is _STOP for g in groups)
+            self._write([g for g in groups if g is not _STOP])
+            for _ in groups:
+                q.task_done()
+            if stop:
+                # 关闭时把停止标记之后还没取出的写入也刷掉
+                rest = []
+                while True:
+                    try:
+                        rest.append(q.get_nowait())
+                    except queue.Empty:
+                        break
+                self._write([g for g in rest if g is not _STOP])
+                for _ in rest:
+                    q.task_done()
+                return
+
+    def _write(self, groups):
+        if not groups:
+            return
+        writes = {}
+        keyed = {}
+        coalesced = {}
+        for group in groups:
+            for kind, key, row in group:
+                if key is None:
+                    writes.setdefault(kind, []).append(row)
+                else:
+                    # 同一 key 后提交的覆盖先提交的
+                    rows = keyed.setdefault(kind, {})
+                    if key in rows:
+                        coalesced[kind] = coalesced.get(kind, 0) + 1
+                    rows[key] = row
+        for kind, rows in keyed.items():
+            writes.setdefault(kind, []).extend(rows.values())
+
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                with WRITE_BEHIND_FLUSH_DURATION.time():
+                    with self._transaction() as conn:
+                        self._apply(conn, writes)
+                break
+            except Exception as e:
+                if attempt == WRITE_RETRIES or not db.is_transient(e):
+                    self._record_failure(writes, e)
+                    return
+                time.sleep(0.1 * (attempt + 1))
+
+        for kind, rows in writes.items():
+            WRITE_BEHIND_WRITES.inc(len(rows), kind=kind, outcome='written')
+        for kind, count in coalesced.items():
+            WRITE_BEHIND_WRITES.inc(count, kind=kind, outcome='coalesced')
+
+    def _record_failure(self, writes, error):
+        for kind, rows in writes.items():
+            WRITE_BEHIND_WRITES.inc(len(rows), kind=kind, outcome='failed')
+        logger.error("写后队列批量写入失败: %s", error,
+                     extra={'rows': sum(len(rows) for rows in writes.values())})
+
+_queues = []
+
+def create_queue(apply, transaction, **kwargs):
+    """创建写后队列，并在进程退出时自动刷完"""
+    q = WriteBehindQueue(apply, transaction, **kwargs)
+    _queues.append(q)
+    return q
+
+def close_all(timeout=10):
+    for q in _queues:
+        q.close(timeout)
+
+atexit.register(close_all)